@@ -1,11 +1,12 @@
 import time
+from typing import Optional
 
 import telebot
 
 from kaban.settings import (
     API, USERS, HELP, SHORTCUT_LEN,
-    ADD_FEED, INSERT_FEED, GO_BACK,
-    CMD_ADD, CMD_INSERT, CMD_CANCEL,
+    SHOW_HELP, ADD_FEED, INSERT_FEED, GO_BACK,
+    CMD_HELP, CMD_ADD, CMD_INSERT, CMD_CANCEL,
     LIST_FEEDS, DELETE_FEED, ADD_SHORTCUT,
     CMD_LIST, PATTERN_DELETE, PATTERN_SHORTCUT,
     SWITCH_SUMMARY, SWITCH_DATE, SWITCH_LINK,
@@ -41,7 +42,7 @@ def get_bot():
                "if there is no immediate response. (´･ᴗ･ ` )"
         send_message(bot, uid, text)
 
-    @bot.message_handler(commands=['help'])
+    @bot.message_handler(commands=[SHOW_HELP])
     def help(message):
         send_message(bot, message.chat.id, HELP)
 
@@ -62,7 +63,7 @@ def get_bot():
         elif check_out:
             feed = message.text.strip()
             try:
-                check_out_feed(feed, uid)
+                feed = check_out_feed(feed, uid)
             except DataAlreadyExists:
                 text = "I already watch this feed for you!"
             except FeedFormatError:
@@ -167,3 +168,23 @@ def get_bot():
             help(message)
 
     return bot
+
+
+def quick_reply(update: telebot.types.Update) -> Optional[dict]:
+    """ The reply to a command that needs no work and no waiting,
+        as a Bot API method for the body of the webhook response,
+        see flask_config.inbox. None if the update should go
+        through the receiver thread as usual.
+        It runs in the webhook's thread, so it doesn't change the USERS. """
+    message = update.message
+    if not message or not message.text: return None
+    uid = message.chat.id
+
+    if message.text == CMD_HELP:
+        text = HELP
+    elif message.text == CMD_LIST and not USERS.get(uid):
+        text = list_feeds(uid)
+    else:
+        return None
+
+    return {'method': 'sendMessage', 'chat_id': uid, 'text': text}
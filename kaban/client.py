@@ -0,0 +1,166 @@
+import socket
+import threading
+import time
+from typing import Dict
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError, ConnectTimeoutError
+from urllib3.util.connection import allowed_gai_family
+
+from kaban.settings import (
+    USER_AGENT, HTTP_HOST_POOLS, HOST_MAX_CONNECTIONS,
+    DNS_CACHE_TTL, DNS_CACHE_SIZE
+)
+
+
+def host_of(url: str) -> str: return urlsplit(url).netloc.lower()
+
+
+class DNSCache:
+    """ Resolved addresses live [ttl] seconds, so the feeds of a big host
+        don't resolve its name on every new connection.
+        Only the connections of the feeds' SESSION use it, see FeedAdapter """
+    def __init__(self, ttl=DNS_CACHE_TTL, size=DNS_CACHE_SIZE, resolver=socket.getaddrinfo):
+        self.ttl = ttl
+        self.size = size
+        self.resolver = resolver
+        self.addresses: Dict[tuple, tuple] = {}
+        self.lock = threading.Lock()
+
+    def getaddrinfo(self, *args, **kwargs):
+        key = args + tuple(sorted(kwargs.items()))
+        now = time.monotonic()
+        with self.lock:
+            expires, addresses = self.addresses.get(key, (0, None))
+        if expires > now:
+            return addresses
+
+        addresses = self.resolver(*args, **kwargs)
+        with self.lock:
+            if len(self.addresses) >= self.size:
+                self.addresses = {k: v for k, v in self.addresses.items() if v[0] > now}
+            self.addresses[key] = (now + self.ttl, addresses)
+        return addresses
+
+
+class HostLimits:
+    """ No more than [limit] requests to one host at a time. """
+    def __init__(self, limit=HOST_MAX_CONNECTIONS):
+        self.limit = limit
+        self.slots: Dict[str, threading.BoundedSemaphore] = {}
+        self.lock = threading.Lock()
+
+    def slot(self, url: str) -> threading.BoundedSemaphore:
+        host = host_of(url)
+        with self.lock:
+            if host not in self.slots:
+                self.slots[host] = threading.BoundedSemaphore(self.limit)
+            return self.slots[host]
+
+
+class HttpMetrics:
+    """ Requests, opened connections and response latency of every host. """
+    def __init__(self):
+        self.hosts: Dict[str, Dict[str, float]] = {}
+        self.lock = threading.Lock()
+
+    def record(self, url: str, latency: float, connections: int):
+        """ [connections] is the number of connections
+            the host's pool has opened so far. """
+        host = host_of(url)
+        with self.lock:
+            stats = self.hosts.setdefault(host, {'requests': 0, 'latency': 0.0, 'connections': 0})
+            stats['requests'] += 1
+            stats['latency'] += latency
+            stats['connections'] = connections
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        with self.lock:
+            return {
+                host: {
+                    'requests': stats['requests'],
+                    'reused': max(stats['requests'] - stats['connections'], 0),
+                    'latency': stats['latency'] / stats['requests'],
+                }
+                for host, stats in self.hosts.items()
+            }
+
+    def __str__(self):
+        report = self.report()
+        requests_ = sum(stats['requests'] for stats in report.values())
+        reused = sum(stats['reused'] for stats in report.values())
+        latency = sum(stats['latency'] * stats['requests'] for stats in report.values())
+        latency = latency / requests_ if requests_ else 0
+        return f"{len(report)} hosts, {requests_} requests, " \
+               f"{reused} on reused connections, {latency:.2f}s latency"
+
+
+class CachedDNSConnection(HTTPConnection):
+    """ Connects to the addresses from the DNS_CACHE, one after another
+        like urllib3's create_connection. The host name stays
+        for the Host header, TLS SNI and the certificate check. """
+    def _new_conn(self):
+        dns_host = self._dns_host
+        try:
+            addresses = DNS_CACHE.getaddrinfo(dns_host, self.port, allowed_gai_family(), socket.SOCK_STREAM)
+        except OSError:
+            addresses = []
+        if not addresses:
+            # the usual resolution raises the usual error
+            return super()._new_conn()
+
+        try:
+            for *_, address in addresses:
+                self._dns_host = address[0]
+                try:
+                    return super()._new_conn()
+                except (NewConnectionError, ConnectTimeoutError) as exc:
+                    error = exc
+            raise error
+        finally:
+            self._dns_host = dns_host
+
+
+class CachedDNSSConnection(CachedDNSConnection, HTTPSConnection): pass
+
+
+class CachedDNSPool(HTTPConnectionPool):
+    ConnectionCls = CachedDNSConnection
+
+
+class CachedDNSSPool(HTTPSConnectionPool):
+    ConnectionCls = CachedDNSSConnection
+
+
+class FeedAdapter(HTTPAdapter):
+    """ An adapter whose connections resolve the hosts through the DNS_CACHE,
+        the rest of the process resolves them as usual. """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': CachedDNSPool, 'https': CachedDNSSPool}
+
+
+def new_session() -> requests.Session:
+    """ A keep-alive pool for each of the last [HTTP_HOST_POOLS] hosts. """
+    session = requests.Session()
+    adapter = FeedAdapter(pool_connections=HTTP_HOST_POOLS, pool_maxsize=HOST_MAX_CONNECTIONS)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = USER_AGENT
+    return session
+
+
+def open_connections(response: requests.Response) -> int:
+    """ How many connections the pool that gave the response has opened. """
+    pool = getattr(response.raw, '_pool', None)
+    return getattr(pool, 'num_connections', 1)
+
+
+DNS_CACHE = DNSCache()
+SESSION = new_session()
+HOST_LIMITS = HostLimits()
+HTTP_METRICS = HttpMetrics()
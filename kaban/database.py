@@ -30,6 +30,86 @@ class FeedsDB(SQLAlchemyBase):
         return f"<feed entry #{self.id!r}>"
 
 
+# the columns of FeedsDB loaded by the updater
+SUBSCRIPTION = (
+    FeedsDB.id, FeedsDB.uid, FeedsDB.feed,
+    FeedsDB.last_posts, FeedsDB.last_check,
+    FeedsDB.summary, FeedsDB.date, FeedsDB.link, FeedsDB.short,
+)
+
+
+class FeedStateDB(SQLAlchemyBase):
+    """ State of a distinct feed, shared by all its subscribers. """
+    __tablename__ = "feed_state"
+    id = sql.Column(sql.Integer, primary_key=True)
+    url = sql.Column(sql.Text, unique=True, nullable=False)
+    etag = sql.Column(sql.Text, nullable=True, default=None)
+    modified = sql.Column(sql.Text, nullable=True, default=None)
+    posts_to_store = sql.Column(sql.Integer, nullable=True, default=None)
+    failures = sql.Column(sql.Integer, nullable=True, default=0)
+    last_error = sql.Column(sql.Text, nullable=True, default=None)
+    retry_at = sql.Column(sql.DateTime, nullable=True, default=None)
+    body_hash = sql.Column(sql.LargeBinary(16), nullable=True, default=None)
+    next_poll = sql.Column(sql.DateTime, nullable=True, default=None)
+    hub = sql.Column(sql.Text, nullable=True, default=None)
+    topic = sql.Column(sql.Text, nullable=True, default=None)
+    websub_secret = sql.Column(sql.Text, nullable=True, default=None)
+    lease_until = sql.Column(sql.DateTime, nullable=True, default=None)
+    websub_token = sql.Column(sql.Text, nullable=True, default=None)
+    websub_mode = sql.Column(sql.Text, nullable=True, default=None)
+    websub_base = sql.Column(sql.Text, nullable=True, default=None)
+    def __str__(self):
+        return f"<feed state #{self.id!r}>"
+
+
+class SeenPostsDB(SQLAlchemyBase):
+    """ Digests of the posts already sent to a subscription, see helpers.post_digest """
+    __tablename__ = "seen_posts"
+    __table_args__ = (sql.UniqueConstraint('entry_id', 'digest'),)
+    id = sql.Column(sql.Integer, primary_key=True)
+    entry_id = sql.Column(sql.Integer, sql.ForeignKey('feeds.id'), nullable=False)
+    digest = sql.Column(sql.LargeBinary(16), nullable=False)
+    def __str__(self):
+        return f"<seen post #{self.id!r}>"
+
+
+class PendingPostsDB(SQLAlchemyBase):
+    """ New posts of a subscription that aren't sent yet, see UpdaterThread._resume """
+    __tablename__ = "pending_posts"
+    __table_args__ = (sql.UniqueConstraint('entry_id', 'digest'),)
+    id = sql.Column(sql.Integer, primary_key=True)
+    entry_id = sql.Column(sql.Integer, sql.ForeignKey('feeds.id'), nullable=False)
+    digest = sql.Column(sql.LargeBinary(16), nullable=False)
+    post = sql.Column(sql.Text, nullable=False)
+    def __str__(self):
+        return f"<pending post #{self.id!r}>"
+
+
+class OutboxDB(SQLAlchemyBase):
+    """ Posts waiting for the delivery, see sender.SenderThread
+        A delivered post is deleted, one that couldn't be delivered is marked dead.
+        The ids are never reused, the sender reads the rows past the last one it took. """
+    __tablename__ = "outbox"
+    __table_args__ = {'sqlite_autoincrement': True}
+    id = sql.Column(sql.Integer, primary_key=True)
+    uid = sql.Column(sql.Integer, nullable=False)
+    text = sql.Column(sql.Text, nullable=False)
+    dead_at = sql.Column(sql.DateTime, nullable=True, default=None)
+    def __str__(self):
+        return f"<outbox message #{self.id!r}>"
+
+
+class PushedFeedsDB(SQLAlchemyBase):
+    """ Feeds pushed by the WebSub hubs, the updater reads them as the polled ones """
+    __tablename__ = "pushed_feeds"
+    id = sql.Column(sql.Integer, primary_key=True)
+    url = sql.Column(sql.Text, nullable=False)
+    content = sql.Column(sql.LargeBinary, nullable=False)
+    content_type = sql.Column(sql.Text, nullable=True, default=None)
+    def __str__(self):
+        return f"<pushed feed #{self.id!r}>"
+
+
 class WebhookDB(SQLAlchemyBase):
     __tablename__ = "webhook"
     id = sql.Column(sql.Integer, primary_key=True)
@@ -38,5 +118,21 @@ class WebhookDB(SQLAlchemyBase):
         return f"<web message #{self.id!r}>"
 
 
-if not DB_URI.exists():
-    SQLAlchemyBase.metadata.create_all(db)
+def add_new_columns(engine: Engine):
+    """ create_all() doesn't touch the existing tables,
+        so the columns added later (always nullable) are added here. """
+    inspector = sql.inspect(engine)
+    with engine.begin() as connection:
+        for table in SQLAlchemyBase.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(engine.dialect)
+                    connection.execute(sql.text(
+                        f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+                    ))
+
+
+# creates only the tables that don't exist yet
+SQLAlchemyBase.metadata.create_all(db)
+add_new_columns(db)
@@ -0,0 +1,159 @@
+from datetime import datetime
+import json
+import time
+from typing import Iterator
+from xml.etree import ElementTree
+
+import feedparser
+from feedparser.datetimes import _parse_date
+from feedparser.util import FeedParserDict
+
+from kaban.settings import (
+    FAST_FEED_PARSER, FAST_PARSER_MIN_ENTRIES, FAST_PARSER_CHUNK, Feed
+)
+
+
+ATOM = '{http://www.w3.org/2005/Atom}'
+
+
+class FastParseError(Exception): pass
+
+
+def parse_feed(content: bytes, headers: dict = None, since: datetime = None) -> Feed:
+    """ Parses a downloaded feed with the fast parser, if it's on,
+        or with the feedparser, if the fast parser can't handle the document. """
+    if FAST_FEED_PARSER:
+        try:
+            return fast_parse(content, since)
+        except FastParseError:
+            pass
+    return feedparser.parse(content, response_headers=headers)
+
+
+def fast_parse(content: bytes, since: datetime = None,
+               min_entries=FAST_PARSER_MIN_ENTRIES) -> Feed:
+    """ Reads only the fields the bot uses from an RSS 2.0, Atom or JSON Feed
+        document. Stops at the first entry published before [since],
+        but not before [min_entries] entries are read. """
+    parsed_feed = FeedParserDict(bozo=0, entries=[], feed=FeedParserDict(links=[]))
+    if content.lstrip()[:1] == b'{':
+        entries = _json_entries(content, parsed_feed.feed.links)
+    else:
+        entries = _xml_entries(content, parsed_feed.feed.links)
+
+    try:
+        for entry in entries:
+            parsed_feed.entries.append(entry)
+            if since and len(parsed_feed.entries) >= min_entries \
+                    and _is_older(entry, since):
+                break
+    except (ElementTree.ParseError, ValueError, TypeError, AttributeError) as exc:
+        raise FastParseError from exc
+
+    if not parsed_feed.entries:
+        raise FastParseError
+    return parsed_feed
+
+
+def _is_older(entry: FeedParserDict, since: datetime) -> bool:
+    if not entry.get('published_parsed'): return False
+    published = datetime.fromtimestamp(time.mktime(entry.published_parsed))
+    return published <= since
+
+
+def _new_entry(title=None, summary=None, link=None, published=None, guid=None) -> FeedParserDict:
+    """ The fields are named as the feedparser names them. """
+    entry = FeedParserDict()
+    if title is not None: entry['title'] = title.strip()
+    if summary is not None: entry['summary'] = summary
+    if link: entry['link'] = link.strip()
+    if guid: entry['id'] = guid.strip()
+    if published:
+        entry['published'] = published.strip()
+        entry['published_parsed'] = _parse_date(entry.published)
+    return entry
+
+
+def _xml_entries(content: bytes, links: list) -> Iterator[FeedParserDict]:
+    """ Parses the document piece by piece,
+        every entry is dropped from the tree as soon as it's read.
+        The atom:links of the feed itself go to [links]. """
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    root = None
+    depth = 0
+    for i in range(0, len(content), FAST_PARSER_CHUNK):
+        parser.feed(content[i:i + FAST_PARSER_CHUNK])
+        for event, element in parser.read_events():
+            if root is None:
+                root = element
+                if element.tag not in ('rss', f'{ATOM}feed'):
+                    raise FastParseError
+            elif element.tag in ('item', f'{ATOM}entry'):
+                depth += 1 if event == 'start' else -1
+            elif event == 'end' and element.tag == f'{ATOM}link' and not depth:
+                links.append(FeedParserDict(rel=element.get('rel', 'alternate'),
+                                            href=element.get('href')))
+
+            if event == 'end' and element.tag == 'item':
+                yield _rss_entry(element)
+                element.clear()
+            elif event == 'end' and element.tag == f'{ATOM}entry':
+                yield _atom_entry(element)
+                element.clear()
+    parser.close()
+
+
+def _rss_entry(item: ElementTree.Element) -> FeedParserDict:
+    return _new_entry(
+        title=item.findtext('title'),
+        summary=item.findtext('description'),
+        link=item.findtext('link'),
+        published=item.findtext('pubDate'),
+        guid=item.findtext('guid'),
+    )
+
+
+def _atom_entry(entry: ElementTree.Element) -> FeedParserDict:
+    link = None
+    for element in entry.iter(f'{ATOM}link'):
+        if element.get('rel', 'alternate') == 'alternate':
+            link = element.get('href')
+            break
+
+    summary = entry.find(f'{ATOM}summary')
+    if summary is None:
+        summary = entry.find(f'{ATOM}content')
+
+    title = entry.find(f'{ATOM}title')
+    return _new_entry(
+        title=None if title is None else ''.join(title.itertext()),
+        summary=None if summary is None else ''.join(summary.itertext()),
+        link=link,
+        published=entry.findtext(f'{ATOM}published') or entry.findtext(f'{ATOM}updated'),
+        guid=entry.findtext(f'{ATOM}id'),
+    )
+
+
+def _json_entries(content: bytes, links: list) -> Iterator[FeedParserDict]:
+    """ JSON Feed, https://jsonfeed.org/version/1.1 """
+    try:
+        document = json.loads(content)
+    except ValueError as exc:
+        raise FastParseError from exc
+    if not str(document.get('version', '')).startswith('https://jsonfeed.org/version/'):
+        raise FastParseError
+
+    for hub in document.get('hubs', []):
+        links.append(FeedParserDict(rel='hub', href=hub.get('url')))
+    if document.get('feed_url'):
+        links.append(FeedParserDict(rel='self', href=document['feed_url']))
+
+    for item in document.get('items', []):
+        yield _new_entry(
+            title=item.get('title'),
+            summary=item.get('summary') or item.get('content_html') or item.get('content_text'),
+            link=item.get('url'),
+            published=item.get('date_published') or item.get('date_modified'),
+            guid=None if item.get('id') is None else str(item['id']),
+        )
+
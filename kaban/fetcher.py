@@ -0,0 +1,274 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import hashlib
+import queue
+import threading
+import time
+from typing import Iterable, Iterator, Tuple, Union, Optional, Dict
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from urllib3.util.request import ACCEPT_ENCODING
+
+from kaban.settings import (
+    FEEDS_FETCH_WORKERS, FEED_FETCH_TIMEOUT, FEEDS_CYCLE_DEADLINE, FETCHED_QUEUE_SIZE,
+    FEED_CONNECT_TIMEOUT, FEED_READ_TIMEOUT, FEED_MAX_SIZE, FEED_CHUNK_SIZE,
+    FEED_CACHE_TTL, FEED_CACHE_SIZE, TRACKING_PARAMS, PERMANENT_REDIRECTS,
+    Feed, FeedValidators, FeedNotModified, FeedTooLarge
+)
+from kaban.fastparser import parse_feed
+from kaban.client import SESSION, HOST_LIMITS, HTTP_METRICS, open_connections
+
+
+def canonical_feed(feed: str) -> str:
+    """ The URL of a feed to store and to fetch, without trivial differences:
+        the case of the scheme and host, default ports,
+        tracking parameters and fragments. """
+    parts = urlsplit(feed.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if netloc.endswith(':80') and scheme == 'http' or \
+            netloc.endswith(':443') and scheme == 'https':
+        netloc = netloc.rsplit(':', 1)[0]
+
+    query = '&'.join(
+        param for param in parts.query.split('&')
+        if param and not TRACKING_PARAMS.fullmatch(param.split('=', 1)[0])
+    )
+    return urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+
+def feed_key(feed: str) -> str:
+    """ The identity of a feed: its canonical URL without the scheme
+        and the trailing slash, so http and https, /feed and /feed/ are one feed.
+        The key groups the subscriptions, it's never fetched. """
+    parts = urlsplit(canonical_feed(feed))
+    return urlunsplit(('', parts.netloc, parts.path.rstrip('/') or '/', parts.query, ''))
+
+
+def moved_to(response: requests.Response) -> Optional[str]:
+    """ The new home of a feed that has moved permanently.
+        Redirects are followed until the first temporary one. """
+    location = None
+    targets = [hop.url for hop in response.history[1:]] + [response.url]
+    for hop, target in zip(response.history, targets):
+        if hop.status_code not in PERMANENT_REDIRECTS: break
+        location = canonical_feed(target)
+    return location
+
+
+def websub_links(parsed_feed: Feed, response: requests.Response) -> Tuple[Optional[str], Optional[str]]:
+    """ The WebSub hub of a feed and the topic URL to subscribe to.
+        The Link header takes precedence over the links of the document. """
+    links = {
+        link.get('rel'): link.get('href')
+        for link in parsed_feed.get('feed', {}).get('links', [])
+    }
+    links.update((rel, link.get('url')) for rel, link in response.links.items())
+    if not links.get('hub'): return None, None
+    return links['hub'], links.get('self') or response.url
+
+
+class FeedCache:
+    """ Parsed feeds shared by the /add checks and the first post of a new feed,
+        so a feed isn't downloaded again a moment later. The updater always
+        downloads, with its validators, see iter_feeds.
+        A feed lives [ttl] seconds; the least recently used go first
+        when there are more than [size] of them. """
+    def __init__(self, ttl=FEED_CACHE_TTL, size=FEED_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self.feeds: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self): return len(self.feeds)
+
+    def get(self, url: str) -> Optional[Feed]:
+        key = feed_key(url)
+        with self.lock:
+            if key in self.feeds:
+                stored, parsed_feed = self.feeds[key]
+                if time.monotonic() - stored < self.ttl:
+                    self.feeds.move_to_end(key)
+                    self.hits += 1
+                    return parsed_feed
+                self.feeds.pop(key)
+            self.misses += 1
+            return None
+
+    def put(self, url: str, parsed_feed: Feed):
+        key = feed_key(url)
+        with self.lock:
+            self.feeds[key] = (time.monotonic(), parsed_feed)
+            self.feeds.move_to_end(key)
+            while len(self.feeds) > self.size:
+                self.feeds.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.feeds.clear()
+            self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.feeds)}
+
+
+FEED_CACHE = FeedCache()
+
+
+def fetch_feed(url: str, etag: str = None, modified: str = None,
+               body_hash: bytes = None, since: datetime = None, parse=None) -> Feed:
+    """ Downloads a feed and parses it, see fastparser.parse_feed
+        [parse] replaces parse_feed, see workers.FeedWorkers
+        Sends the validators of the previous download, if any,
+        and raises FeedNotModified on 304 instead of parsing.
+        The same goes for a body with the same hash as the previous one,
+        for the servers that don't support the validators.
+        The connections are kept alive in the shared SESSION,
+        see client.py """
+    headers = {'Accept-Encoding': ACCEPT_ENCODING}
+    if etag: headers['If-None-Match'] = etag
+    if modified: headers['If-Modified-Since'] = modified
+
+    with HOST_LIMITS.slot(url):
+        start = time.monotonic()
+        response = SESSION.get(
+            url, stream=True, headers=headers,
+            timeout=(FEED_CONNECT_TIMEOUT, FEED_READ_TIMEOUT)
+        )
+        try:
+            HTTP_METRICS.record(url, time.monotonic() - start, open_connections(response))
+            if response.status_code == 304:
+                # an unread body would close the connection
+                read_body(response)
+                raise FeedNotModified
+            response.raise_for_status()
+            content = read_body(response)
+        finally:
+            response.close()
+
+    new_hash = hashlib.blake2b(content, digest_size=16).digest()
+    if new_hash == body_hash:
+        raise FeedNotModified
+
+    parsed_feed: Feed = (parse or parse_feed)(content, dict(response.headers), since)
+    parsed_feed['href'] = response.url
+    parsed_feed['etag'] = response.headers.get('ETag')
+    parsed_feed['modified'] = response.headers.get('Last-Modified')
+    parsed_feed['moved_to'] = moved_to(response)
+    parsed_feed['body_hash'] = new_hash
+    parsed_feed['hub'], parsed_feed['topic'] = websub_links(parsed_feed, response)
+    return parsed_feed
+
+
+def read_body(response: requests.Response, max_size=FEED_MAX_SIZE,
+              timeout=FEED_FETCH_TIMEOUT) -> bytes:
+    """ Reads a streamed response in chunks, the body is decompressed on the way.
+        Raises FeedTooLarge as soon as the body grows over [max_size],
+        and requests.Timeout if the whole download takes longer than [timeout]. """
+    length = response.headers.get('Content-Length')
+    if length and length.isdigit() and int(length) > max_size:
+        raise FeedTooLarge(length)
+
+    end = time.monotonic() + timeout
+    body = bytearray()
+    for chunk in response.iter_content(chunk_size=FEED_CHUNK_SIZE):
+        body += chunk
+        if len(body) > max_size:
+            raise FeedTooLarge(len(body))
+        if time.monotonic() > end:
+            raise requests.Timeout('download is too slow')
+    return bytes(body)
+
+
+def get_feed(url: str) -> Feed:
+    """ Takes a feed from the FEED_CACHE, or downloads it.
+        Only feeds with posts are cached. """
+    parsed_feed = FEED_CACHE.get(url)
+    if parsed_feed is None:
+        parsed_feed = fetch_feed(url)
+        if parsed_feed.entries:
+            FEED_CACHE.put(url, parsed_feed)
+    return parsed_feed
+
+
+def get_https_feed(feed: str) -> Tuple[str, Feed]:
+    """ Tries the https version of an http feed first.
+        Returns the URL that worked together with the feed. """
+    if feed.startswith('http://'):
+        secure = 'https://' + feed[len('http://'):]
+        try:
+            parsed_feed = get_feed(secure)
+            if parsed_feed.entries:
+                return secure, parsed_feed
+        except Exception:
+            pass
+    return feed, get_feed(feed)
+
+
+def iter_feeds(urls: Iterable[str], validators: FeedValidators = None,
+               since: Dict[str, datetime] = None, workers=FEEDS_FETCH_WORKERS,
+               deadline=FEEDS_CYCLE_DEADLINE, queue_size=FETCHED_QUEUE_SIZE,
+               fetch=None, sources: Dict[str, str] = None,
+               compact=None) -> Iterator[Tuple[str, Union[Feed, Exception]]]:
+    """ Downloads many feeds at once and yields them as they come.
+        At most [queue_size] downloaded feeds wait for the consumer,
+        the downloaders pause when the queue is full.
+        [since] is the oldest last check of each feed, the parsing stops there.
+        [fetch] replaces fetch_feed, see workers.FeedWorkers
+        [sources] is the URL to download for each of [urls], when they are
+        the feeds' keys, see feed_key; the feeds are yielded by [urls].
+        [compact] is called with a feed and its [since] in the download thread,
+        so only what it returns waits in the queue, not the parsed document.
+        Failures are yielded in place of the feed; the feeds that aren't
+        ready before the deadline get a TimeoutError. The deadline counts
+        only the time spent waiting for the downloads, not the consumer's. """
+    urls = list(urls)
+    validators = validators or {}
+    since = since or {}
+    sources = sources or {}
+    fetched = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def download(url: str):
+        if stop.is_set(): return
+        try:
+            result = (fetch or fetch_feed)(
+                sources.get(url, url), *validators.get(url, (None, None, None)), since.get(url)
+            )
+            if compact: result = compact(result, since.get(url))
+        except Exception as error:
+            result = error
+        while not stop.is_set():
+            try:
+                fetched.put((url, result), timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fetcher')
+    left = set(urls)
+    try:
+        for url in urls:
+            pool.submit(download, url)
+
+        while left:
+            start = time.monotonic()
+            try:
+                ready = [fetched.get(timeout=max(deadline, 0))]
+            except queue.Empty:
+                break
+            deadline -= time.monotonic() - start
+            left.discard(ready[0][0])
+            # popped, so this frame doesn't keep the feed while the consumer works
+            yield ready.pop()
+
+        for url in left:
+            yield url, TimeoutError('cycle deadline')
+    finally:
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
@@ -4,16 +4,19 @@ import telebot
 import flask
 from flask import Flask, request
 
-from kaban.database import SQLSession, WebhookDB
+from kaban.database import SQLSession, WebhookDB, FeedStateDB, PushedFeedsDB
 from kaban.settings import (
-    NEW_MESSAGES_EVENT, BANNED,
-    WEBHOOK_ENDPOINT, WebhookRequestError
+    NEW_MESSAGES_EVENT, UPDATE_FEEDS_EVENT, BANNED, WEBHOOK_REPLY,
+    WEBHOOK_ENDPOINT, WEBSUB_ENDPOINT, FEED_MAX_SIZE, WebhookRequestError
 )
-from kaban.log import log
+from kaban.websub import check_signature, lease_until, end_subscription
+from kaban.bot_config import quick_reply
+from kaban.log import log, info
 
 
-def get_app():
-    """ Will return webhook application. """
+def get_app(sender=None):
+    """ Will return webhook application.
+        The [sender] thread lets simple commands be answered in the response. """
     app = Flask('__main__')
     app.config.update(
         ENV='production',
@@ -26,7 +29,10 @@ def get_app():
     @app.route(WEBHOOK_ENDPOINT, methods=['POST'])
     def inbox():
         """ Checks requests and passes them into the WebhookDB.
-            The db serves as a reliable request queue. """
+            The db serves as a reliable request queue.
+            A simple command is answered right in the response, if it's on,
+            nothing is queued and the sender has nothing for the chat,
+            so the reply doesn't overtake an earlier one or break the chat's limit. """
         ip = request.environ.get('REMOTE_ADDR')
         if ip in BANNED:
             flask.abort(403)
@@ -36,7 +42,7 @@ def get_app():
                 raise WebhookRequestError
             try:
                 data = request.get_data().decode('utf-8')
-                telebot.types.Update.de_json(data)
+                update = telebot.types.Update.de_json(data)
             except Exception:
                 raise WebhookRequestError
 
@@ -46,6 +52,11 @@ def get_app():
             flask.abort(403)
 
         else:
+            if WEBHOOK_REPLY and sender and not NEW_MESSAGES_EVENT.is_set():
+                reply = quick_reply(update)
+                if reply and sender.reply_slot(reply['chat_id']):
+                    return flask.jsonify(reply)
+
             with SQLSession() as session:
                 new_message = WebhookDB(data=data)
                 session.add(new_message)
@@ -53,6 +64,58 @@ def get_app():
             NEW_MESSAGES_EVENT.set()
             return "", 200
 
+    @app.route(f'{WEBSUB_ENDPOINT}/<token>', methods=['GET'])
+    def websub_verify(token):
+        """ A hub checks that the subscription was asked for.
+            Only the mode the bot is waiting for is accepted. """
+        mode = request.args.get('hub.mode')
+        topic = request.args.get('hub.topic')
+        with SQLSession() as session:
+            state = session.query(FeedStateDB).filter(FeedStateDB.websub_token == token).first()
+            if not state or not state.hub or topic != state.topic:
+                flask.abort(404)
+
+            if mode == 'subscribe' and state.websub_mode == 'subscribe':
+                state.lease_until = lease_until(request.args.get('hub.lease_seconds'))
+                state.websub_mode = None
+            elif mode == 'unsubscribe' and state.websub_mode == 'unsubscribe' or \
+                    mode == 'denied' and state.websub_mode == 'subscribe':
+                end_subscription(state)
+            else:
+                flask.abort(404)
+            session.commit()
+
+        info(f'websub - {mode} {topic}')
+        return request.args.get('hub.challenge', ''), 200
+
+    @app.route(f'{WEBSUB_ENDPOINT}/<token>', methods=['POST'])
+    def websub_inbox(token):
+        """ A hub pushes new content of a feed.
+            The PushedFeedsDB is a queue for the updater, like the WebhookDB.
+            A chunked push has no length, so the body is read with the cap. """
+        if (request.content_length or 0) > FEED_MAX_SIZE:
+            flask.abort(413)
+
+        content = request.stream.read(FEED_MAX_SIZE + 1)
+        if len(content) > FEED_MAX_SIZE:
+            flask.abort(413)
+        with SQLSession() as session:
+            state = session.query(FeedStateDB).filter(FeedStateDB.websub_token == token).first()
+            if not state or not state.websub_secret:
+                flask.abort(410)
+            # a wrong signature is acknowledged, but the content is dropped
+            if check_signature(state.websub_secret, content,
+                               request.headers.get('X-Hub-Signature')):
+                session.add(PushedFeedsDB(
+                    url=state.url, content=content,
+                    content_type=request.headers.get('content-type')
+                ))
+                session.commit()
+                UPDATE_FEEDS_EVENT.set()
+            else:
+                log.warning(f'websub - wrong signature, {state.url}')
+        return "", 202
+
     @app.route('/ping', methods=['GET'])
     def ping():
         return "pong", 200
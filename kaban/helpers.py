@@ -1,20 +1,23 @@
 from datetime import datetime
+import functools
 import hashlib
+from html.parser import HTMLParser
+import random
 import time
+from typing import Optional, Tuple
 
-import feedparser
-from bs4 import BeautifulSoup
 from telebot.apihelper import ApiTelegramException
 
 from kaban.settings import (
-    EXIT_EVENT, NEW_MESSAGES_EVENT,
-    SHORTCUT_LEN, FEED_SUMMARY_LEN, TIME_FORMAT,
+    EXIT_EVENT, NEW_MESSAGES_EVENT, UPDATE_FEEDS_EVENT, OUTBOX,
+    SHORTCUT_LEN, FEED_SUMMARY_LEN, FEED_SUMMARY_CHUNK, TIME_FORMAT, RENDER_CACHE_SIZE,
     WRONG_TOKEN, UID_NOT_FOUND, BOT_BLOCKED, BOT_TIMEOUT,
     CMD_SUMMARY, CMD_DATE, CMD_LINK,
     FeedFormatError, DataAlreadyExists, FeedPreprocessError,
     Feed, Command
 )
-from kaban.database import SQLSession, FeedsDB
+from kaban.database import SQLSession, FeedsDB, SeenPostsDB, PendingPostsDB, OutboxDB
+from kaban.fetcher import get_feed, get_https_feed, canonical_feed, feed_key
 from kaban.log import log, info
 
 
@@ -23,47 +26,52 @@ def exit_signal(signal_=None, frame=None):
     if signal_: print()
     EXIT_EVENT.set()
     NEW_MESSAGES_EVENT.set()
+    UPDATE_FEEDS_EVENT.set()
 
 
 def send_message(bot, uid: int, text: str):
-    """ Final point. Handles errors in requests to Telegram. """
-    retry = None
-    while True:
-        try:
-            bot_sender(bot, uid, text)
+    """ Queues a message, the sender thread delivers it
+        within Telegram's limits, see sender.py """
+    OUTBOX.put((bot, uid, text))
 
-        except ApiTelegramException as error:
-            if WRONG_TOKEN.search(error.description):
-                log.critical(f'wrong telegram token - {error}')
-                exit_signal()
 
-            elif UID_NOT_FOUND.search(error.description):
-                retry = 1 if retry is None else retry - 1
-                if resend_message(retry, sleep=5, delete_uid=uid): continue
-                else: log.warning('user/chat not found; uid deleted')
+def deliver_message(bot, uid: int, text: str, attempt: int = 0) -> Tuple[bool, Optional[float]]:
+    """ Final point. Handles errors in requests to Telegram.
+        Doesn't wait for a retry: returns whether the message is delivered
+        and the delay before the next attempt, None if the message is done with.
+        The sender thread puts the message off, see sender.py """
+    delay = None
+    try:
+        bot_sender(bot, uid, text)
+        return True, None
 
-            elif BOT_BLOCKED.search(error.description):
-                retry = 3 if retry is None else retry - 1
-                if resend_message(retry, sleep=10, delete_uid=uid): continue
-                else: log.warning('bot blocked; uid deleted')
+    except ApiTelegramException as error:
+        if WRONG_TOKEN.search(error.description):
+            log.critical(f'wrong telegram token - {error}')
+            exit_signal()
 
-            elif BOT_TIMEOUT.search(error.description):
-                retry = 1 if retry is None else retry - 1
-                if resend_message(retry, sleep=10): continue
-                else: log.warning('telegram timeout')
+        elif UID_NOT_FOUND.search(error.description):
+            delay = retry_delay(attempt, retries=1, base=5, delete_uid=uid)
+            if delay is None: log.warning('user/chat not found; uid deleted')
 
-            else:
-                retry = 3 if retry is None else retry - 1
-                if resend_message(retry, sleep=2): continue
-                else: log.warning('undefined telegram problem')
+        elif BOT_BLOCKED.search(error.description):
+            delay = retry_delay(attempt, retries=3, base=10, delete_uid=uid)
+            if delay is None: log.warning('bot blocked; uid deleted')
 
-        except Exception as exc:
-            retry = 1 if retry is None else retry - 1
-            if resend_message(retry, sleep=5): continue
-            else: log.exception(exc)
+        elif BOT_TIMEOUT.search(error.description):
+            retry_after = (error.result_json or {}).get('parameters', {}).get('retry_after')
+            delay = retry_delay(attempt, retries=3, base=10, retry_after=retry_after)
+            if delay is None: log.warning('telegram timeout')
+
+        else:
+            delay = retry_delay(attempt, retries=3, base=2)
+            if delay is None: log.warning('undefined telegram problem')
 
-        time.sleep(0.1)
-        break
+    except Exception as exc:
+        delay = retry_delay(attempt, retries=1, base=5)
+        if delay is None: log.exception(exc)
+
+    return False, delay
 
 
 def bot_sender(bot, uid, text):
@@ -71,74 +79,234 @@ def bot_sender(bot, uid, text):
     bot.send_message(uid, text)
 
 
-def resend_message(attempt: int, sleep: int, delete_uid=None) -> bool:
-    """ Will try to send message again [attempt] times after [sleep].
-        Request to delete user if needed. """
-    if attempt == 0:
+def retry_delay(attempt: int, retries: int, base: float,
+                delete_uid=None, retry_after: float = None) -> Optional[float]:
+    """ The delay before the next of [retries] attempts: as long as Telegram asks,
+        or [base] seconds doubled with every attempt, with a jitter.
+        None when the attempts are over; request to delete user if needed. """
+    if attempt >= retries:
         if delete_uid: delete_user(delete_uid)
-        else: pass
-        return False
+        return None
+    if retry_after:
+        return float(retry_after)
+    return base * 2 ** attempt * random.uniform(0.5, 1.5)
+
+
+class Post:
+    """ An entry of a feed reduced to what a message needs, see compact_post """
+    __slots__ = ('title', 'digest', 'summary', 'link', 'published')
+
+    def __init__(self, title: str, digest: bytes, summary: Optional[str] = None,
+                 link: Optional[str] = None, published: Optional[float] = None):
+        self.title = title
+        self.digest = digest
+        self.summary = summary
+        self.link = link
+        self.published = published
+
+    def __eq__(self, other):
+        return isinstance(other, Post) and \
+            all(getattr(self, key) == getattr(other, key) for key in self.__slots__)
+
+    def __hash__(self): return hash(self.digest)
+
+    def __repr__(self): return f"<post {self.title!r}>"
+
+
+def compact_post(post: Feed) -> Post:
+    """ Keeps only the fields a message needs, so the parsed document
+        doesn't have to live until the post is sent. """
+    try:
+        published = time.mktime(post.published_parsed)
+    except (AttributeError, TypeError, ValueError, OverflowError):
+        published = None
+    link = getattr(post, 'link', None)
+    return Post(
+        title=getattr(post, 'title', None) or '',
+        digest=post_digest(post),
+        summary=summary_text(getattr(post, 'summary', None)),
+        link=link if isinstance(link, str) and link else None,
+        published=published,
+    )
+
+
+class TextStripper(HTMLParser):
+    """ Collects the visible text of an HTML document, entities decoded.
+        Stops as soon as there is more than [limit] characters of it,
+        the rest of the document is never parsed.
+        Whitespace between tags becomes one space or line break, as with BeautifulSoup. """
+    HIDDEN = {'script', 'style', 'template'}
+    PRESERVED = {'pre', 'textarea'}
+    SPACES = ' \n\t\f\r'
+
+    def __init__(self, limit: int):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.limit = limit
+        self.parts = []
+        self.size = 0
+        # whitespace of the current text node, it's kept until the node has some text
+        self.spaces = []
+        self.has_text = False
+        self.hidden = 0
+        self.preserved = 0
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        self._end_node()
+        if tag in self.HIDDEN: self.hidden += 1
+        if tag in self.PRESERVED: self.preserved += 1
+
+    def handle_endtag(self, tag):
+        self._end_node()
+        if tag in self.HIDDEN and self.hidden: self.hidden -= 1
+        if tag in self.PRESERVED and self.preserved: self.preserved -= 1
+
+    def handle_comment(self, data): self._end_node()
+
+    def handle_decl(self, decl): self._end_node()
+
+    def handle_pi(self, data): self._end_node()
+
+    def unknown_decl(self, data):
+        self._end_node()
+        if data.startswith('CDATA['):
+            self.handle_data(data[6:])
+            self._end_node()
+
+    def handle_data(self, data):
+        if self.hidden or self.done: return
+        if not self.has_text and not data.strip(self.SPACES):
+            self.spaces.append(data)
+            return
+        self.has_text = True
+        self._add(''.join(self.spaces) + data)
+        self.spaces = []
+
+    def _end_node(self):
+        if self.spaces:
+            spaces = ''.join(self.spaces)
+            if not self.preserved: spaces = '\n' if '\n' in spaces else ' '
+            self._add(spaces)
+        self.spaces = []
+        self.has_text = False
+
+    def _add(self, data: str):
+        # leading whitespace doesn't count
+        if not self.parts: data = data.lstrip()
+        if not data: return
+        self.parts.append(data)
+        self.size += len(data)
+        # trailing whitespace doesn't count either
+        if self.size > self.limit and self.text()[self.limit:].strip():
+            self.done = True
+
+    def text(self) -> str: return ''.join(self.parts)
+
+
+def summary_text(summary: Optional[str]) -> Optional[str]:
+    """ The summary as plain text, cut to FEED_SUMMARY_LEN characters. """
+    if not isinstance(summary, str): return None
+    stripper = TextStripper(FEED_SUMMARY_LEN)
+    for start in range(0, len(summary), FEED_SUMMARY_CHUNK):
+        stripper.feed(summary[start:start + FEED_SUMMARY_CHUNK])
+        if stripper.done: break
     else:
-        time.sleep(sleep)
-        return True
+        stripper.close()
+    text = stripper.text().rstrip()
+    if not text: return None
+    return text[:FEED_SUMMARY_LEN] + ("..." if stripper.done else "")
 
 
-def send_a_post(bot, post: Feed, db_entry, feed: str):
+def send_a_post(bot, post: Post, db_entry, feed: str):
     """ Makes a post from some feed and sends it to a uid. """
+    send_message(bot, db_entry.uid, post_text(post, db_entry, feed))
+
+
+def post_text(post: Post, db_entry, feed: str) -> str:
+    """ The message of a post, as the options of a subscription say. """
+    summary, link = db_entry.summary, db_entry.link
+    if summary and not post.summary:
+        feed_switcher(db_entry.uid, CMD_SUMMARY, feed, silent=True)
+        summary = False
+    if link and not post.link:
+        feed_switcher(db_entry.uid, CMD_LINK, feed, silent=True)
+        link = False
+
+    return render_post(post, db_entry.short, bool(summary), bool(db_entry.date), bool(link))
+
+
+@functools.lru_cache(maxsize=RENDER_CACHE_SIZE)
+def render_post(post: Post, short: Optional[str], summary: bool, date: bool, link: bool) -> str:
+    """ The text of a post is made once for all the subscribers
+        with the same shortcut and options. """
     text = ""
-    if db_entry.short:
-        text += f"{db_entry.short}: "
+    if short:
+        text += f"{short}: "
 
     text += post.title + "\n"
 
-    if db_entry.summary:
-        try:
-            summary_text = BeautifulSoup(post.summary, features='html.parser').text.strip()
-            if not summary_text: raise AttributeError
-        except (AttributeError, TypeError):
-            feed_switcher(db_entry.uid, CMD_SUMMARY, feed, silent=True)
-        else:
-            s = summary_text[:FEED_SUMMARY_LEN]
-            s += "..." if len(summary_text) > FEED_SUMMARY_LEN else ""
-            text += "\n" + s + "\n"
+    if summary:
+        text += "\n" + post.summary + "\n"
 
-    if db_entry.date:
-        published = datetime.fromtimestamp(
-            time.mktime(post.published_parsed)
-        ).strftime(TIME_FORMAT)
-        text += "\n" + published + "\n"
+    if date:
+        text += "\n" + published_text(post.published) + "\n"
+
+    if link:
+        text += post.link + "\n"
+
+    return text
 
-    if db_entry.link:
-        try:
-            if not post.link: raise TypeError
-        except (AttributeError, TypeError):
-            feed_switcher(db_entry.uid, CMD_LINK, feed, silent=True)
-        else:
-            text += post.link + "\n"
 
-    send_message(bot, db_entry.uid, text)
+@functools.lru_cache(maxsize=RENDER_CACHE_SIZE)
+def published_text(published: float) -> str:
+    return datetime.fromtimestamp(published).strftime(TIME_FORMAT)
 
 
-def check_out_feed(feed: str, uid: int, first_time=True):
+def post_digest(post: Feed) -> bytes:
+    """ A fixed-width key of a post: its guid or link, or the title if there is none. """
+    for key in ('id', 'link'):
+        value = getattr(post, key, None)
+        if isinstance(value, str) and value.strip():
+            break
+    else:
+        value = getattr(post, 'title', None) or ''
+    return hashlib.md5(value.strip().encode()).digest()
+
+
+def find_feed(session, uid: int, feed: str) -> Optional[FeedsDB]:
+    """ The user's subscription to a feed, however its URL is spelled,
+        see fetcher.feed_key """
+    db_entry = session.query(FeedsDB).filter(FeedsDB.uid == uid, FeedsDB.feed == feed).first()
+    if db_entry: return db_entry
+
+    key = feed_key(feed)
+    for db_entry in session.scalars(session.query(FeedsDB).filter(FeedsDB.uid == uid)):
+        if feed_key(db_entry.feed) == key:
+            return db_entry
+    return None
+
+
+def check_out_feed(feed: str, uid: int, first_time=True) -> str:
     """ Raises an exception if this user has already added this feed.
-        Checks feed's availability and format correctness. """
+        Checks feed's availability and format correctness.
+        The first time returns the canonical URL of the feed:
+        https if it works, the new location if the feed has moved. """
     if first_time:
         try:
-            parsed_feed = feedparser.parse(feed)
+            feed, parsed_feed = get_https_feed(canonical_feed(feed))
             post = parsed_feed.entries[0]
             if not parsed_feed.href or not post.published_parsed or not post.title:
                 raise FeedFormatError
+            feed = parsed_feed.moved_to or feed
         except (AttributeError, IndexError, FeedFormatError):
             raise FeedFormatError
         except Exception as exc:
             raise Exception from exc
 
     with SQLSession() as session:
-        db_entry = session.query(FeedsDB).filter(
-            FeedsDB.uid == uid, FeedsDB.feed == feed
-        ).first()
-        if db_entry:
+        if find_feed(session, uid, feed):
             raise DataAlreadyExists
+    return feed
 
 
 def add_new_feed(bot, uid: int, feed: str) -> str:
@@ -155,6 +323,8 @@ def add_new_feed(bot, uid: int, feed: str) -> str:
                "The feed will be automatically deleted if problems continue."
     else:
         return "New web feed added!"
+    finally:
+        UPDATE_FEEDS_EVENT.set()
 
 
 def new_feed_preprocess(bot, uid: int, feed: str):
@@ -167,16 +337,12 @@ def new_feed_preprocess(bot, uid: int, feed: str):
                 FeedsDB.feed == feed,
             ).first()
 
-            top_post = feedparser.parse(feed).entries[0]
+            top_post = compact_post(get_feed(feed).entries[0])
             send_a_post(bot, top_post, db_entry, feed)
 
-            title = hashlib.md5(
-                top_post.title.strip().encode()
-            ).hexdigest()
-            top_post_date = datetime.fromtimestamp(
-                time.mktime(top_post.published_parsed)
-            )
-            db_entry.last_posts = title
+            top_post_date = datetime.fromtimestamp(top_post.published)
+            session.add(SeenPostsDB(entry_id=db_entry.id, digest=top_post.digest))
+            db_entry.last_posts = ''
             db_entry.last_check = top_post_date
             session.commit()
     except Exception:
@@ -187,10 +353,10 @@ def new_feed_preprocess(bot, uid: int, feed: str):
 def delete_a_feed(feed: str, uid: int, silent=False) -> str:
     """ Delete some entry from the feeds db. """
     with SQLSession() as session:
-        db_entry = session.query(FeedsDB).filter(
-            FeedsDB.uid == uid, FeedsDB.feed == feed
-        ).first()
+        db_entry = find_feed(session, uid, feed)
         if db_entry:
+            session.query(SeenPostsDB).filter(SeenPostsDB.entry_id == db_entry.id).delete()
+            session.query(PendingPostsDB).filter(PendingPostsDB.entry_id == db_entry.id).delete()
             session.delete(db_entry)
             session.commit()
             info('db - entry removed')
@@ -228,10 +394,7 @@ def feed_shortcut(uid: int, shortcut: str, feed: str) -> str:
         shortcut = None if len(shortcut) == 0 else shortcut
 
     with SQLSession() as session:
-        db_entry = session.query(FeedsDB).filter(
-            FeedsDB.uid == uid,
-            FeedsDB.feed == feed,
-        ).first()
+        db_entry = find_feed(session, uid, feed)
         db_entry.short = shortcut
         session.commit()
 
@@ -242,10 +405,7 @@ def feed_switcher(uid: int, command: Command, feed: str, silent=False):
     """ Changes post style. """
     text = ''
     with SQLSession() as session:
-        db_entry = session.query(FeedsDB).filter(
-            FeedsDB.uid == uid,
-            FeedsDB.feed == feed,
-        ).first()
+        db_entry = find_feed(session, uid, feed)
         if command == CMD_SUMMARY:
             db_entry.summary = not db_entry.summary
             text = 'Summary switched.'
@@ -260,8 +420,13 @@ def feed_switcher(uid: int, command: Command, feed: str, silent=False):
 
 
 def delete_user(uid: int):
-    """ Takes all the feeds associated with some id and requests deletion. """
+    """ Takes all the feeds associated with some id and requests deletion.
+        The undelivered posts go too, the sender thread drops
+        the ones it has already taken. """
     with SQLSession() as session:
         result = session.query(FeedsDB).filter(FeedsDB.uid == uid)
         for entry in session.scalars(result):
             delete_a_feed(entry.feed, uid, silent=True)
+        session.query(OutboxDB).filter(OutboxDB.uid == uid).delete()
+        session.commit()
+    OUTBOX.put((None, uid, None))
@@ -0,0 +1,144 @@
+from datetime import datetime
+import heapq
+import random
+import statistics
+import threading
+import time
+from typing import Dict, Iterable, List
+from urllib.parse import urlsplit
+
+from kaban.settings import (
+    FEEDS_UPDATE_TIMEOUT, FEED_MIN_INTERVAL,
+    FEED_MAX_INTERVAL, FEED_POLL_JITTER,
+    HOST_BREAKER_THRESHOLD, HOST_BREAKER_COOLDOWN
+)
+
+
+class FeedScheduler:
+    """ A priority queue of feeds ordered by the time of their next poll.
+        The interval of each feed follows the gaps between its posts,
+        bounded by [min_interval, max_interval]; a feed with nothing new
+        slows down. Jitter spreads the polls of similar feeds in time. """
+    def __init__(self, min_interval=FEED_MIN_INTERVAL, max_interval=FEED_MAX_INTERVAL,
+                 jitter=FEED_POLL_JITTER, default_interval=FEEDS_UPDATE_TIMEOUT):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.default_interval = default_interval
+
+        self.queue: List[tuple] = []
+        self.due: Dict[str, float] = {}
+        self.intervals: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def __len__(self): return len(self.due)
+
+    def sync(self, urls: Iterable[str], due: Dict[str, float] = None):
+        """ New feeds are due at once, or at the time from [due],
+            the deleted ones are forgotten. """
+        urls = set(urls)
+        due = due or {}
+        now = time.time()
+        with self.lock:
+            for url in urls - self.due.keys():
+                self.intervals.setdefault(url, self.default_interval)
+                self._push(url, due.get(url, now))
+            for url in self.due.keys() - urls:
+                self.due.pop(url)
+                self.intervals.pop(url, None)
+
+    def pop_due(self, now: float = None) -> List[str]:
+        """ Takes all the feeds whose time has come out of the queue. """
+        now = time.time() if now is None else now
+        urls = []
+        with self.lock:
+            while self.queue and self.queue[0][0] <= now:
+                due, url = heapq.heappop(self.queue)
+                # outdated records are skipped instead of being removed
+                if self.due.get(url) == due:
+                    self.due[url] = None
+                    urls.append(url)
+        return urls
+
+    def reschedule(self, url: str, published: List[datetime] = None):
+        """ Puts a polled feed back into the queue.
+            [published] are the dates of the feed's posts,
+            nothing means that there was nothing new. """
+        with self.lock:
+            if url not in self.due: return
+
+            interval = self.intervals.get(url, self.default_interval)
+            if published:
+                interval = self._estimate(published)
+            else:
+                interval *= 1.5
+
+            interval = min(max(interval, self.min_interval), self.max_interval)
+            self.intervals[url] = interval
+            spread = interval * self.jitter
+            self._push(url, time.time() + interval + random.uniform(-spread, spread))
+
+    def postpone(self, url: str, delay: float):
+        """ Puts a feed back into the queue after [delay] seconds,
+            its interval stays the same. """
+        with self.lock:
+            if url not in self.due: return
+            self._push(url, time.time() + delay)
+
+    def wait_time(self, now: float = None) -> float:
+        """ Seconds until the next feed is due. """
+        now = time.time() if now is None else now
+        with self.lock:
+            while self.queue and self.due.get(self.queue[0][1]) != self.queue[0][0]:
+                heapq.heappop(self.queue)
+            if not self.queue:
+                return self.default_interval
+            return max(self.queue[0][0] - now, 0)
+
+    def _push(self, url: str, due: float):
+        self.due[url] = due
+        heapq.heappush(self.queue, (due, url))
+
+    @staticmethod
+    def _estimate(published: List[datetime]) -> float:
+        """ The median gap between posts; the time since the last post
+            counts as a gap too, so a dormant feed is polled less often. """
+        dates = sorted(published, reverse=True)
+        gaps = [(datetime.now() - dates[0]).total_seconds()]
+        gaps += [(newer - older).total_seconds() for newer, older in zip(dates, dates[1:])]
+        return statistics.median(gaps)
+
+
+class CircuitBreaker:
+    """ Stops polling a host for [cooldown] seconds after [threshold]
+        failures in a row. When the cooldown is over, a single failure
+        opens the breaker again, a success closes it. """
+    def __init__(self, threshold=HOST_BREAKER_THRESHOLD, cooldown=HOST_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures: Dict[str, int] = {}
+        self.opened: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def host(url: str) -> str: return urlsplit(url).netloc.lower()
+
+    def open_for(self, url: str, now: float = None) -> float:
+        """ Seconds until the host of the feed may be polled again. """
+        now = time.time() if now is None else now
+        return max(self.opened.get(self.host(url), now) - now, 0)
+
+    def success(self, url: str):
+        host = self.host(url)
+        with self.lock:
+            self.failures.pop(host, None)
+            self.opened.pop(host, None)
+
+    def failure(self, url: str):
+        host = self.host(url)
+        with self.lock:
+            failures = self.failures.get(host, 0) + 1
+            if failures >= self.threshold:
+                self.opened[host] = time.time() + self.cooldown
+                failures = self.threshold - 1
+            self.failures[host] = failures
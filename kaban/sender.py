@@ -0,0 +1,279 @@
+from collections import deque
+from datetime import datetime, timedelta
+import heapq
+import itertools
+import queue
+import threading
+import time
+from typing import Dict, List, Tuple, Deque, Optional
+
+from kaban.settings import (
+    OUTBOX, SEND_GLOBAL_RATE, SEND_CHAT_RATE, OUTBOX_BATCH_SIZE, OUTBOX_FLUSH_INTERVAL,
+    OUTBOX_DEAD_TTL
+)
+from kaban.helpers import exit_signal, deliver_message
+from kaban.database import SQLSession, OutboxDB
+from kaban.log import log, info
+
+
+class TokenBucket:
+    """ [rate] tokens a second, no more than [capacity] saved up. """
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, now: float = None) -> float:
+        """ Seconds until a token is there. """
+        self._refill(time.monotonic() if now is None else now)
+        return max(1 - self.tokens, 0) / self.rate
+
+    def take(self, now: float = None):
+        self._refill(time.monotonic() if now is None else now)
+        self.tokens -= 1
+
+    def is_full(self, now: float = None) -> bool:
+        self._refill(time.monotonic() if now is None else now)
+        return self.tokens >= self.capacity
+
+
+class SenderThread(threading.Thread):
+    """ Delivers the queued messages as fast as Telegram allows:
+        [global_rate] messages a second in all and [chat_rate] to one chat.
+        Every chat has its own line, so a chat that has to wait
+        doesn't hold up the others; the order within a chat is kept.
+        A failed message waits for its retry at the head of its chat's line.
+
+        The posts come from the outbox table, written by the updater
+        together with the state of the subscriptions. They are taken
+        in batches, and the delivered and the dead ones are marked
+        in batches too, so a crash may send again only the posts
+        delivered within the last [flush_interval] seconds.
+        The dead posts are kept for [dead_ttl] seconds. """
+    def __init__(self, bot=None):
+        threading.Thread.__init__(self)
+
+        self.bot = bot
+        self.exception = None
+        self.exit = exit_signal
+        self.deliver = deliver_message
+
+        self.outbox = OUTBOX
+        self.global_bucket = TokenBucket(SEND_GLOBAL_RATE)
+        self.chat_rate = SEND_CHAT_RATE
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        # (bot, text, attempt, outbox row id or None)
+        self.chats: Dict[int, Deque[tuple]] = {}
+        # (time, order, uid) of the chats that have messages
+        self.ready: List[Tuple[float, int, int]] = []
+        self.order = itertools.count()
+        self.stopping = threading.Event()
+        # the chats and the buckets are shared with the webhook, see reply_slot
+        self.lock = threading.Lock()
+
+        self.batch_size = OUTBOX_BATCH_SIZE
+        self.flush_interval = OUTBOX_FLUSH_INTERVAL
+        self.more_rows = True
+        self.last_row = 0
+        self.rows_taken = 0
+        self.delivered: List[int] = []
+        self.dead: List[int] = []
+        self.flushed_at = time.monotonic()
+        self.dead_ttl = OUTBOX_DEAD_TTL
+
+    def __str__(self): return "sender thread"
+
+    def run(self):
+        try:
+            while not (self.stopping.is_set() and not self.chats and self.outbox.empty()):
+                self._step()
+            self._flush()
+        except Exception as error:
+            self.exception = error
+            self.exit()
+
+    def _step(self):
+        """ Sends the message of the chat that is ready first,
+            or waits for it and for new messages. """
+        self._take_new()
+        self._take_rows()
+        if time.monotonic() - self.flushed_at >= self.flush_interval:
+            self._flush()
+
+        wait = self.ready[0][0] - time.monotonic() if self.ready else None
+        if self.delivered or self.dead:
+            flush_in = self.flushed_at + self.flush_interval - time.monotonic()
+            wait = flush_in if wait is None else min(wait, flush_in)
+        if wait is None or wait > 0:
+            try:
+                message = self.outbox.get(timeout=wait)
+            except queue.Empty:
+                return
+            self._add_new(message)
+            return
+
+        _, _, uid = heapq.heappop(self.ready)
+        bot, text, attempt, row = self.chats[uid][0]
+        if row is not None and self.stopping.is_set():
+            # it stays in the outbox table till the next start
+            self._next(uid)
+            return
+
+        with self.lock:
+            wait = self.global_bucket.wait_time()
+        if wait > 0: time.sleep(wait)
+
+        with self.lock:
+            self.global_bucket.take()
+            self.chat_buckets[uid].take()
+        delivered, delay = self.deliver(bot, uid, text, attempt)
+
+        if delay is not None and not self.stopping.is_set():
+            self.chats[uid][0] = (bot, text, attempt + 1, row)
+            heapq.heappush(self.ready, (time.monotonic() + delay, next(self.order), uid))
+            return
+
+        if delay is not None and row is None:
+            log.warning(f'sender - no retries after the stop, a message to {uid} is dropped')
+        elif delay is None and row is not None:
+            (self.delivered if delivered else self.dead).append(row)
+            if len(self.delivered) + len(self.dead) >= self.batch_size:
+                self._flush()
+        self._next(uid)
+
+    def _next(self, uid: int):
+        """ The head of a chat's line is done with. """
+        with self.lock:
+            if self.chats[uid].popleft()[3] is not None:
+                self.rows_taken -= 1
+            if self.chats[uid]:
+                self._schedule(uid)
+            else:
+                self.chats.pop(uid)
+
+    def _take_new(self):
+        while True:
+            try:
+                message = self.outbox.get_nowait()
+            except queue.Empty:
+                return
+            self._add_new(message)
+
+    def _add_new(self, message: Optional[tuple]):
+        # None only wakes the thread up: new posts in the outbox table or the stop()
+        if message is None:
+            self.more_rows = True
+        elif message[2] is None:
+            self._drop(message[1])
+        else:
+            self._add(*message)
+
+    def _drop(self, uid: int):
+        """ The user is deleted, the chat's line goes.
+            Its posts are already gone from the outbox table. """
+        with self.lock:
+            line = self.chats.pop(uid, ())
+        for _, _, _, row in line:
+            if row is not None: self.rows_taken -= 1
+        self.ready = [item for item in self.ready if item[2] != uid]
+        heapq.heapify(self.ready)
+
+    def _take_rows(self):
+        """ The next batch of the outbox table, when the posts
+            taken before are mostly sent. """
+        if not self.more_rows or self.stopping.is_set() or \
+                self.rows_taken > self.batch_size // 2:
+            return
+
+        with SQLSession() as session:
+            rows = session.query(OutboxDB.id, OutboxDB.uid, OutboxDB.text).filter(
+                OutboxDB.id > self.last_row, OutboxDB.dead_at.is_(None)
+            ).order_by(OutboxDB.id).limit(self.batch_size).all()
+
+        self.more_rows = len(rows) == self.batch_size
+        for row, uid, text in rows:
+            self._add(self.bot, uid, text, row)
+        if rows:
+            self.last_row = rows[-1][0]
+            self.rows_taken += len(rows)
+
+    def _flush(self):
+        """ Deletes the delivered posts from the outbox table
+            and marks the dead ones, with a single commit.
+            The new dead posts push out the ones older than [dead_ttl]. """
+        if self.delivered or self.dead:
+            now = datetime.now()
+            with SQLSession() as session:
+                session.query(OutboxDB).filter(
+                    OutboxDB.id.in_(self.delivered)
+                ).delete(synchronize_session=False)
+                session.query(OutboxDB).filter(
+                    OutboxDB.id.in_(self.dead)
+                ).update({OutboxDB.dead_at: now}, synchronize_session=False)
+                purged = 0
+                if self.dead:
+                    purged = session.query(OutboxDB).filter(
+                        OutboxDB.dead_at < now - timedelta(seconds=self.dead_ttl)
+                    ).delete(synchronize_session=False)
+                session.commit()
+            if self.dead: log.warning(f'sender - {len(self.dead)} posts are dead-lettered')
+            if purged: info(f'sender - {purged} old dead posts purged')
+        self.delivered, self.dead = [], []
+        self.flushed_at = time.monotonic()
+
+    def _add(self, bot, uid: int, text: str, row: Optional[int] = None):
+        with self.lock:
+            if uid not in self.chats:
+                self.chats[uid] = deque()
+                if uid not in self.chat_buckets:
+                    self._forget_idle_chats()
+                    self.chat_buckets[uid] = TokenBucket(self.chat_rate)
+                self._schedule(uid)
+            self.chats[uid].append((bot, text, 0, row))
+
+    def reply_slot(self, uid: int) -> bool:
+        """ Whether the webhook may answer a chat in its response, see flask_config.inbox:
+            nothing for the chat waits here or in the outbox table, and the limits
+            allow a message right now. The message is counted against them. """
+        with self.lock:
+            if uid in self.chats or self.more_rows or \
+                    not self.outbox.empty() or self.stopping.is_set():
+                return False
+            now = time.monotonic()
+            bucket = self.chat_buckets.get(uid)
+            if bucket and bucket.wait_time(now) > 0 or self.global_bucket.wait_time(now) > 0:
+                return False
+            if not bucket:
+                self._forget_idle_chats()
+                bucket = self.chat_buckets[uid] = TokenBucket(self.chat_rate)
+            bucket.take(now)
+            self.global_bucket.take(now)
+            return True
+
+    def _schedule(self, uid: int):
+        now = time.monotonic()
+        ready_at = now + self.chat_buckets[uid].wait_time(now)
+        heapq.heappush(self.ready, (ready_at, next(self.order), uid))
+
+    def _forget_idle_chats(self, limit=1000):
+        """ A full bucket is the same as a new one. """
+        if len(self.chat_buckets) < limit: return
+        now = time.monotonic()
+        self.chat_buckets = {
+            uid: bucket for uid, bucket in self.chat_buckets.items()
+            if uid in self.chats or not bucket.is_full(now)
+        }
+
+    def stop(self):
+        """ The queued messages are sent before the thread ends,
+            the posts of the outbox table wait for the next start. """
+        self.stopping.set()
+        self.outbox.put(None)
+        threading.Thread.join(self)
+        if self.exception:
+            raise self.exception
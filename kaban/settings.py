@@ -2,8 +2,9 @@ from logging import RootLogger
 import os
 import pathlib
 import re
+from queue import Queue
 from threading import Event
-from typing import Dict, Union, List
+from typing import Dict, Union, List, Tuple, Optional, Set
 
 import sqlalchemy
 from feedparser.util import FeedParserDict
@@ -20,8 +21,11 @@ class BannedIp(List[str]): pass
 
 class Feed(FeedParserDict): pass
 
-class UpdPost(Dict[str, Union[str, Feed]]):
-    """ {'str-title-md5': Feed} """
+class Subscription(sqlalchemy.engine.Row):
+    """ FeedsDB columns used by the updater, see database.SUBSCRIPTION """
+
+class UpdPost(Dict[str, Union[bytes, object, Subscription]]):
+    """ {'digest': b'md5', 'post': helpers.Post, 'entry': Subscription} """
 
 class UpdPostList(List[UpdPost]):
     """ [UpdPost,] """
@@ -32,6 +36,15 @@ class UpdFeeds(Dict[str, UpdPostList]):
 class UpdPosts(Dict[int, UpdFeeds]):
     """ {int-uid: UpdFeeds} """
 
+class FeedSubscribers(Dict[str, List[Subscription]]):
+    """ {'str-feed-key': [Subscription,]} """
+
+class FeedValidators(Dict[str, Tuple[Optional[str], Optional[str], Optional[bytes]]]):
+    """ {'str-feed-key': ('str-etag', 'str-last-modified', b'blake2b-body-hash')} """
+
+class SeenPosts(Dict[int, Set[bytes]]):
+    """ {int-FeedsDB.id: {b'md5',}} """
+
 class Key(str): pass
 
 class Command(str): pass
@@ -51,12 +64,52 @@ else:
     MASTER_UID = os.environ['MASTER']
 
 FEEDS_UPDATE_TIMEOUT = 3600
+FEED_MIN_INTERVAL = 300
+FEED_MAX_INTERVAL = 6 * 3600
+FEED_POLL_JITTER = 0.1
+FEEDS_SCHEDULER_TICK = 30
+FEEDS_LOAD_CHUNK = 1000
+FORWARD_BATCH_SIZE = 10
+FORWARD_BATCH_WINDOW = 30
+SEND_GLOBAL_RATE = 30
+SEND_CHAT_RATE = 1
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_FLUSH_INTERVAL = 1
+OUTBOX_DEAD_TTL = 7 * 24 * 3600
+FEEDS_FETCH_WORKERS = 16
+FEED_WORKER_PROCESSES = 0
+FEED_FETCH_TIMEOUT = 30
+FEED_CONNECT_TIMEOUT = 10
+FEED_READ_TIMEOUT = 20
+FEED_MAX_SIZE = 10 * 2**20
+FEED_CHUNK_SIZE = 64 * 2**10
+HTTP_HOST_POOLS = 64
+HOST_MAX_CONNECTIONS = 4
+DNS_CACHE_TTL = 300
+DNS_CACHE_SIZE = 1024
+FEEDS_CYCLE_DEADLINE = 1800
+FETCHED_QUEUE_SIZE = 32
+FEED_CACHE_TTL = 300
+FEED_CACHE_SIZE = 64
+FEED_RETRY_BASE = 600
+FEED_RETRY_MAX = 24 * 3600
+FEED_MAX_FAILURES = 15
+HOST_BREAKER_THRESHOLD = 5
+HOST_BREAKER_COOLDOWN = 900
+FAST_FEED_PARSER = True
+FAST_PARSER_MIN_ENTRIES = 5
+FAST_PARSER_CHUNK = 16 * 1024
+USER_AGENT = "kaban-chan (+https://t.me/KabanChan_bot)"
+TRACKING_PARAMS = re.compile(r'utm_\w+|fbclid|gclid|yclid|mc_cid|mc_eid|_ga|_hsenc|_hsmi')
+PERMANENT_REDIRECTS = (301, 308)
 
 TIME_FORMAT = 'on %A, in %-d day of %B %Y, at %-H:%M %z'
 
 NOTIFICATIONS: Path = BASE_DIR / "resources" / "notifications.txt"
 
 FEED_SUMMARY_LEN = 400
+FEED_SUMMARY_CHUNK = 1024
+RENDER_CACHE_SIZE = 1024
 SHORTCUT_LEN = 30
 
 USERS: UsersInMemory = {}
@@ -65,6 +118,11 @@ BANNED: BannedIp = []
 HOOK_READY_TO_WORK: Event = Event()
 EXIT_EVENT: Event = Event()
 NEW_MESSAGES_EVENT: Event = Event()
+UPDATE_FEEDS_EVENT: Event = Event()
+
+# (bot, uid, text) for the sender thread, None wakes it up to read the outbox table,
+# (None, uid, None) drops the queued messages of a deleted user
+OUTBOX: Queue = Queue()
 
 
 # Exceptions
@@ -74,9 +132,12 @@ class WebhookRequestError(Exception): pass
 class FeedLoadError(Exception): pass
 class FeedFormatError(Exception): pass
 class FeedPreprocessError(Exception): pass
+class FeedNotModified(Exception): pass
+class FeedTooLarge(Exception): pass
 
 
 # Telebot commands
+SHOW_HELP = Key("help")
 ADD_FEED = Key("add")
 INSERT_FEED = Key("confirm")
 GO_BACK = Key("cancel")
@@ -87,6 +148,7 @@ SWITCH_SUMMARY = Key("summary")
 SWITCH_DATE = Key("date")
 SWITCH_LINK = Key("link")
 
+CMD_HELP = Command(f"/{SHOW_HELP}")
 CMD_ADD = Command(f"/{ADD_FEED}")
 CMD_INSERT = Command(f"/{INSERT_FEED}")
 CMD_CANCEL = Command(f"/{GO_BACK}")
@@ -128,7 +190,12 @@ EXIT_NOTE = "Sorry, but I go to sleep~ See you later (´• ω •`)ﾉﾞ"
 PORT = 5000
 ADDRESS = '0.0.0.0'
 WEBHOOK_ENDPOINT = "/hook"
+# simple commands are answered in the webhook response, see bot_config.quick_reply
+WEBHOOK_REPLY = False
 WEBHOOK_WAS_SET = re.compile(r'was set|already set')
+WEBSUB_ENDPOINT = "/websub"
+WEBSUB_LEASE = 10 * 24 * 3600
+WEBSUB_RENEW_MARGIN = 24 * 3600
 REPLIT_URL = "https://kaban-chan.kitavoronok.repl.co"
 
 if REPLIT:
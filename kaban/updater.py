@@ -1,25 +1,47 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import hashlib
+import json
 import threading
 import time
+from typing import Dict, Iterator, Union, Optional, Tuple, List, Set
 
-import feedparser
+from feedparser.util import FeedParserDict
+import sqlalchemy as sql
 
 from kaban.settings import (
-    EXIT_EVENT, FEEDS_UPDATE_TIMEOUT, NOTIFICATIONS, FeedLoadError,
-    UpdPosts, UpdFeeds, UpdPostList, UpdPost, Feed
+    EXIT_EVENT, UPDATE_FEEDS_EVENT, OUTBOX, FEEDS_SCHEDULER_TICK,
+    FEEDS_LOAD_CHUNK, FORWARD_BATCH_SIZE, FORWARD_BATCH_WINDOW, NOTIFICATIONS,
+    FEED_RETRY_BASE, FEED_RETRY_MAX, FEED_MAX_FAILURES, FEED_WORKER_PROCESSES,
+    FeedLoadError, FeedNotModified,
+    UpdPosts, UpdPostList, UpdPost, Feed,
+    FeedSubscribers, FeedValidators, Subscription, SeenPosts
+)
+from kaban.helpers import (
+    exit_signal, send_message, post_text, delete_a_feed, compact_post, Post
+)
+from kaban.fetcher import iter_feeds, feed_key
+from kaban.fastparser import parse_feed
+from kaban.scheduler import FeedScheduler, CircuitBreaker
+from kaban.client import HTTP_METRICS
+from kaban.workers import FeedWorkers
+from kaban.websub import WEBSUB
+from kaban.database import (
+    SQLSession, FeedsDB, FeedStateDB, SeenPostsDB, PendingPostsDB, PushedFeedsDB, OutboxDB,
+    SUBSCRIPTION, POSTS_TO_STORE
 )
-from kaban.helpers import exit_signal, send_message, send_a_post
-from kaban.database import SQLSession, FeedsDB, POSTS_TO_STORE
 from kaban.log import log, info
 
 
+FETCHED_FIELDS = ('etag', 'modified', 'body_hash', 'moved_to', 'hub', 'topic')
+
+
 class UpdaterThread(threading.Thread):
     """ Note
     A web feed doesn't guarantee a strict sequence and order.
     Many of them update a post's publication date each time they update the post's text,
     causing all posts to reorder unpredictably.
-    I tried to solve this problem by memorizing titles of N posts in md5.
+    I tried to solve this problem by memorizing N posts in md5,
+    see helpers.post_digest & database.SeenPostsDB.
     """
     def __init__(self, bot):
         threading.Thread.__init__(self)
@@ -29,33 +51,93 @@ class UpdaterThread(threading.Thread):
 
         self.exit = exit_signal
         self.send_message = send_message
-        self.send_a_post = send_a_post
+        self.post_text = post_text
+        self.delete_a_feed = delete_a_feed
+        self.key = feed_key
+        self.iter_feeds = iter_feeds
 
         self.exit_event = EXIT_EVENT
-        self.timeout = FEEDS_UPDATE_TIMEOUT
+        self.update_event = UPDATE_FEEDS_EVENT
+        self.outbox = OUTBOX
+        self.tick = FEEDS_SCHEDULER_TICK
+        self.scheduler = FeedScheduler()
+        self.breaker = CircuitBreaker()
+        self.workers = FeedWorkers(FEED_WORKER_PROCESSES) if FEED_WORKER_PROCESSES else None
+        self.websub = WEBSUB
         self.posts_to_store = POSTS_TO_STORE
         self.notifications = NOTIFICATIONS
+        self.new_validators: FeedValidators = {}
+        self.depths: Dict[str, int] = {}
+        self.seen: SeenPosts = {}
+        self.failures: Dict[str, int] = {}
+        self.retry_at: Dict[str, float] = {}
+        self.health: Dict[str, Tuple[int, Optional[str], Optional[datetime]]] = {}
+        self.moved: Dict[str, Tuple[str, List[int]]] = {}
+        self.polled: Set[str] = set()
+        self.hubs: Dict[str, Tuple[str, str]] = {}
+        self.leases: Dict[str, float] = {}
+        self.next_polls: Dict[str, float] = {}
+        self.retry_base = FEED_RETRY_BASE
+        self.retry_max = FEED_RETRY_MAX
+        self.max_failures = FEED_MAX_FAILURES
+        self.load_chunk = FEEDS_LOAD_CHUNK
+        self.batch_size = FORWARD_BATCH_SIZE
+        self.batch_window = FORWARD_BATCH_WINDOW
 
     def __str__(self): return "updater thread"
 
     def run(self):
-        """ Checks feeds for updates from time to time. """
+        """ Checks the feeds that are due for an update.
+            Sleeps until the next feed is due, or until a new feed is added. """
         try:
             self._notifications()
+            self._resume()
 
             while True:
-                new_posts: UpdPosts = {}
-                self._load(new_posts)
-                self._forward(new_posts)
-                del new_posts
+                for new_posts in self._load():
+                    self._forward(new_posts)
+                    self._save_feed_states()
                 self._test()
 
-                if self.exit_event.wait(self.timeout):
+                self.update_event.wait(max(self.scheduler.wait_time(), self.tick))
+                if self.exit_event.is_set():
                     break
+                self.update_event.clear()
 
         except Exception as error:
             self.exception = error
             self.exit()
+        finally:
+            if self.workers: self.workers.shutdown()
+
+    def _resume(self):
+        """ Picks up after an interrupted run: restores the schedule of the feeds,
+            so only the feeds that are due are polled, and sends the posts
+            that had been found, but weren't sent. """
+        with SQLSession() as session:
+            polls = session.query(FeedStateDB.url, FeedStateDB.next_poll).filter(
+                FeedStateDB.next_poll.is_not(None)
+            )
+            self.next_polls = {url: next_poll.timestamp() for url, next_poll in polls}
+
+            pending = session.query(
+                PendingPostsDB.entry_id, PendingPostsDB.digest, PendingPostsDB.post
+            ).order_by(PendingPostsDB.id).all()
+            if not pending: return
+
+            ids = {entry_id for entry_id, _, _ in pending}
+            entries = session.query(*SUBSCRIPTION).filter(FeedsDB.id.in_(ids))
+            entries = {entry.id: entry for entry in entries}
+
+        new_posts: UpdPosts = {}
+        for entry_id, digest, post in pending:
+            if entry_id not in entries: continue
+            entry = entries[entry_id]
+            new_post: UpdPost = {'digest': digest, 'post': self._load_post(post, digest), 'entry': entry}
+            new_posts.setdefault(entry.uid, {}).setdefault(entry.feed, []).append(new_post)
+
+        info(f'resuming - {len(pending)} unsent posts')
+        self._forward(new_posts)
 
     def _notifications(self):
         """ Sends messages to users from a file.
@@ -77,106 +159,523 @@ class UpdaterThread(threading.Thread):
         with open(self.notifications, 'w') as f: f.write('')
         info("notifications sent out")
 
-    def _load(self, new_posts: UpdPosts):
-        """ Loads new posts from all feeds into memory. """
-        self._populate_user_ids(new_posts)
-        self._populate_user_feeds(new_posts)
-        self._populate_feed_posts(new_posts)
-
-    def _populate_user_ids(self, new_posts: UpdPosts):
-        """ Subfunction of _load(), loads all uids. """
+    def _load(self) -> Iterator[UpdPosts]:
+        """ Loads new posts from the due feeds, one feed at a time.
+            Feeds come in as soon as they are downloaded, so the mailing
+            of the first feed starts while the others are still on the way.
+            Each distinct feed is fetched once for all its subscribers.
+            The feeds pushed by the WebSub hubs go first. """
+        yield from self._load_pushed()
+
+        subscribers: FeedSubscribers = {}
+        self._populate_subscriptions(subscribers)
+        self._pick_due_feeds(subscribers)
+        if not subscribers: return
+
+        validators = self._load_feed_states()
+        self._hold_back_failing(subscribers)
+        self._hold_back_pushed(subscribers)
+        if not subscribers: return
+
+        self.seen = self._load_seen(subscribers)
+
+        since = {url: self._since(subs) for url, subs in subscribers.items()}
+        # a feed is grouped by its key, but downloaded by the URL it was added with
+        sources = {url: subs[0].feed for url, subs in subscribers.items()}
+        fetch = self.workers.fetch if self.workers else None
+        for url, fetched in self.iter_feeds(subscribers, validators, since, fetch=fetch,
+                                            sources=sources, compact=self._compact_feed):
+            new_posts: UpdPosts = {}
+            self._populate_feed_posts(new_posts, url, subscribers[url], fetched)
+            # only the compact posts live on during the mailing
+            del fetched
+            self._queue_posts(new_posts)
+            self.polled.add(url)
+            yield new_posts
+
+        self._subscribe_hubs()
+        self._save_schedule()
+        info(f'http - {HTTP_METRICS}')
+
+    def _populate_subscriptions(self, subscribers: FeedSubscribers):
+        """ Subfunction of _load(), loads all the subscriptions
+            with a single query, streamed in chunks. """
         with SQLSession() as session:
-            for db_entry in session.scalars(session.query(FeedsDB)):
-                new_posts[db_entry.uid] = {}
+            entries = session.query(*SUBSCRIPTION).yield_per(self.load_chunk)
+            for entry in entries:
+                subscribers.setdefault(self.key(entry.feed), []).append(entry)
+
+    def _pick_due_feeds(self, subscribers: FeedSubscribers):
+        """ Subfunction of _load(), leaves only the feeds that are due for an update. """
+        self.scheduler.sync(subscribers, self.next_polls)
+        self.next_polls = {}
+        due_feeds = set(self.scheduler.pop_due())
+        for url in subscribers.keys() - due_feeds:
+            subscribers.pop(url)
+
+    def _hold_back_failing(self, subscribers: FeedSubscribers):
+        """ Subfunction of _load(), postpones the feeds that wait for a retry
+            and the feeds of the hosts that fail too often. """
+        now = time.time()
+        for url in list(subscribers):
+            wait = max(self.retry_at.get(url, now) - now, self.breaker.open_for(url, now))
+            if wait > 0:
+                self.scheduler.postpone(url, wait)
+                subscribers.pop(url)
+
+    def _hold_back_pushed(self, subscribers: FeedSubscribers):
+        """ Subfunction of _load(), a feed pushed by a hub isn't polled
+            until its lease is about to end. Then it's polled once more
+            and subscribed again; if the hub doesn't renew the lease,
+            the feed stays with the polling. """
+        now = time.time()
+        for url in list(subscribers):
+            wait = self.leases.get(url, now) - self.websub.margin - now
+            if wait > 0:
+                self.scheduler.postpone(url, wait)
+                subscribers.pop(url)
+
+    def _load_pushed(self) -> Iterator[UpdPosts]:
+        """ Subfunction of _load(), the content pushed by the hubs
+            goes through the same check as a downloaded feed. """
+        with SQLSession() as session:
+            pushed = session.query(
+                PushedFeedsDB.id, PushedFeedsDB.url,
+                PushedFeedsDB.content, PushedFeedsDB.content_type
+            ).order_by(PushedFeedsDB.id).all()
+        if not pushed: return
+
+        subscribers: FeedSubscribers = {}
+        self._populate_subscriptions(subscribers)
+        for url in subscribers.keys() - {url for _, url, _, _ in pushed}:
+            subscribers.pop(url)
+        validators = self._load_feed_states()
+        self.seen = self._load_seen(subscribers)
+
+        for push_id, url, content, content_type in pushed:
+            fetched = None
+            if url not in subscribers:
+                try: self.websub.unsubscribe(url)
+                except Exception as error: log.warning(f'websub - failed to unsubscribe {url}, {error}')
+            else:
+                try:
+                    since = self._since(subscribers[url])
+                    fetched = self._compact_feed(
+                        parse_feed(content, {'content-type': content_type}, since), since
+                    )
+                except Exception as error:
+                    # a broken push isn't the feed's failure, the polling will catch up
+                    log.warning(f'websub - failed to parse pushed feed - {url}, {error}')
+            if fetched is not None:
+                # the validators stay those of the last download
+                fetched['etag'], fetched['modified'], \
+                    fetched['body_hash'] = validators.get(url, (None, None, None))
+                fetched['moved_to'] = fetched['hub'] = None
+                new_posts: UpdPosts = {}
+                self._populate_feed_posts(new_posts, url, subscribers[url], fetched)
+                del fetched
+                self._queue_posts(new_posts)
+                yield new_posts
 
-    def _populate_user_feeds(self, new_posts: UpdPosts):
-        """ Subfunction of _load(), loads all feeds. """
-        for uid in new_posts:
-            dict_of_feeds: UpdFeeds = {}
             with SQLSession() as session:
-                entries = session.query(FeedsDB).filter(FeedsDB.uid == uid)
-                for db_entry in session.scalars(entries):
-                    dict_of_feeds[db_entry.feed] = []
-            new_posts[uid] = dict_of_feeds
+                session.query(PushedFeedsDB).filter(PushedFeedsDB.id == push_id).delete()
+                session.commit()
+
+    def _subscribe_hubs(self):
+        """ Subfunction of _load(), asks the hubs of the polled feeds
+            to push them from now on, see websub.py """
+        for url, (hub, topic) in self.hubs.items():
+            try: self.websub.subscribe(url, hub, topic)
+            except Exception as error: log.warning(f'websub - failed to subscribe {url}, {error}')
+        self.hubs = {}
+
+    def _populate_feed_posts(self, new_posts: UpdPosts, url: str,
+                             subs: list, fetched: Union[Feed, Exception]):
+        """ Subfunction of _load(), loads lists of new posts
+            of every subscriber of a downloaded feed, see _compact_feed """
+        for entry in subs:
+            new_posts.setdefault(entry.uid, {})[entry.feed] = []
 
-    def _populate_feed_posts(self, new_posts: UpdPosts):
-        """ Subfunction of _load(), loads lists of new posts. """
-        for uid in new_posts:
-            for feed in new_posts[uid]:
-                posts_to_send: UpdPostList = []
-                try:
-                    parsed_feed: Feed = feedparser.parse(feed)
-                    if not parsed_feed.entries or not parsed_feed.entries[0].title:
-                        raise FeedLoadError
+        try:
+            if isinstance(fetched, Exception):
+                raise fetched
+            if not fetched.loaded:
+                raise FeedLoadError
+        except FeedNotModified:
+            self._feed_is_alive(url)
+            self.scheduler.reschedule(url)
+            return
+        except (AttributeError, IndexError, FeedLoadError):
+            log.warning(f'failed to load feed - {url}')
+            self._feed_has_failed(url, subs, FeedLoadError.__name__)
+            return
+        except TimeoutError:
+            # the cycle is over before the feed's turn, it's not the feed's fault
+            self.scheduler.reschedule(url)
+            return
+        except Exception as error:
+            log.warning(f'failed to fetch feed - {url}, {error}')
+            self._feed_has_failed(url, subs, type(error).__name__)
+            return
+
+        self._feed_is_alive(url)
+        self.new_validators[url] = (fetched.etag, fetched.modified, fetched.body_hash)
+        moved = [entry.id for entry in subs if fetched.moved_to not in (None, entry.feed)]
+        if moved:
+            self.moved[url] = (fetched.moved_to, moved)
+        if fetched.hub:
+            self.hubs[url] = (fetched.hub, fetched.topic)
+        self.scheduler.reschedule(url, fetched.dates)
+        posts = fetched.posts
+
+        for entry in subs:
+            posts_to_send: UpdPostList = []
+            try:
+                self._populate_list_of_posts(
+                    posts_to_send, posts, entry
+                )
+            except Exception as error:
+                log.warning(f'failed to check feed - {entry.feed}, {error}')
+            finally:
+                new_posts[entry.uid][entry.feed] = posts_to_send
+
+    def _feed_is_alive(self, url: str):
+        """ Forgets the failures of a feed. """
+        self.breaker.success(url)
+        if self.failures.pop(url, 0) or url in self.retry_at:
+            self.retry_at.pop(url, None)
+            self.health[url] = (0, None, None)
+
+    def _feed_has_failed(self, url: str, subs: list, error: str):
+        """ Postpones the next attempt exponentially,
+            a feed that fails for too long gets deleted. """
+        self.breaker.failure(url)
+        failures = self.failures.get(url, 0) + 1
+        if failures >= self.max_failures:
+            self._prune(url, subs)
+            return
+
+        delay = min(self.retry_base * 2 ** (failures - 1), self.retry_max)
+        delay = max(delay, self.scheduler.intervals.get(url, 0))
+        self.failures[url] = failures
+        self.health[url] = (failures, error, datetime.now() + timedelta(seconds=delay))
+        self.scheduler.postpone(url, delay)
+
+    def _prune(self, url: str, subs: list):
+        """ Deletes a dead feed from all its subscribers and lets them know. """
+        log.warning(f'feed deleted after {self.max_failures} failures - {url}')
+        for entry in subs:
+            self.delete_a_feed(entry.feed, entry.uid, silent=True)
+            self.send_message(
+                self.bot, entry.uid,
+                f"The web feed couldn't be read for too long and has been deleted: {entry.feed}"
+            )
+        with SQLSession() as session:
+            session.query(FeedStateDB).filter(FeedStateDB.url == url).delete()
+            session.commit()
+
+        self.failures.pop(url, None)
+        self.retry_at.pop(url, None)
+        self.health.pop(url, None)
+        self.new_validators.pop(url, None)
+
+    @staticmethod
+    def _since(subs: list) -> Optional[datetime]:
+        """ The oldest last check among the subscribers of a feed,
+            the older posts don't need to be parsed. """
+        checks = [entry.last_check for entry in subs if entry.last_check]
+        return min(checks) if checks else None
+
+    @classmethod
+    def _compact_feed(cls, parsed_feed: Feed, since: Optional[datetime]) -> Feed:
+        """ Runs in the download thread, see fetcher.iter_feeds: only the compact posts,
+            their dates and the feed's validators and links are kept, so the parsed
+            document is gone before the feed waits in the queue. """
+        fetched = FeedParserDict({key: getattr(parsed_feed, key, None) for key in FETCHED_FIELDS})
+        try:
+            entries = parsed_feed.entries
+            fetched['loaded'] = bool(entries and entries[0].title)
+        except (AttributeError, IndexError):
+            fetched['loaded'] = False
+        if fetched.loaded:
+            fetched['dates'] = cls._published_dates(entries)
+            fetched['posts'] = cls._compact_posts(entries, since)
+        return fetched
+
+    @staticmethod
+    def _compact_posts(entries: list, since: Optional[datetime]) -> List[Post]:
+        """ The entries down to the first one that all the subscribers have seen,
+            see helpers.compact_post """
+        posts = []
+        for entry in entries:
+            post = compact_post(entry)
+            posts.append(post)
+            if since and post.published is not None and \
+                    datetime.fromtimestamp(post.published) <= since:
+                break
+        return posts
 
-                    self._populate_list_of_posts(
-                        posts_to_send, parsed_feed.entries, uid, feed
+    @staticmethod
+    def _published_dates(posts: list) -> list:
+        """ Publication dates of the posts that have one. """
+        dates = []
+        for post in posts:
+            try:
+                dates.append(datetime.fromtimestamp(time.mktime(post.published_parsed)))
+            except (AttributeError, TypeError, ValueError, OverflowError):
+                continue
+        return dates
+
+    def _load_feed_states(self) -> FeedValidators:
+        """ Subfunction of _load(), loads ETag, Last-Modified & the body hash
+            of all feeds, their depth of the seen posts memory, their failures
+            and the leases of the WebSub subscriptions. """
+        validators: FeedValidators = {}
+        self.depths = {}
+        self.failures = {}
+        self.retry_at = {}
+        self.leases = {}
+        with SQLSession() as session:
+            states = session.query(
+                FeedStateDB.url, FeedStateDB.etag, FeedStateDB.modified, FeedStateDB.body_hash,
+                FeedStateDB.posts_to_store, FeedStateDB.failures, FeedStateDB.retry_at,
+                FeedStateDB.lease_until
+            )
+            for url, etag, modified, body_hash, depth, failures, retry_at, lease in states:
+                validators[url] = (etag, modified, body_hash)
+                if depth: self.depths[url] = depth
+                if failures: self.failures[url] = failures
+                if retry_at: self.retry_at[url] = retry_at.timestamp()
+                if lease: self.leases[url] = lease.timestamp()
+        return validators
+
+    def _load_seen(self, subscribers: FeedSubscribers) -> SeenPosts:
+        """ Subfunction of _load(), loads the digests of the posts
+            already sent to the subscriptions of the due feeds. """
+        entries = {entry.id: entry for subs in subscribers.values() for entry in subs}
+        ids = list(entries)
+        seen: SeenPosts = {i: set() for i in ids}
+
+        with SQLSession() as session:
+            for i in range(0, len(ids), self.load_chunk):
+                digests = session.query(SeenPostsDB.entry_id, SeenPostsDB.digest).filter(
+                    SeenPostsDB.entry_id.in_(ids[i:i + self.load_chunk])
+                )
+                for entry_id, digest in digests:
+                    seen[entry_id].add(digest)
+                # found before a restart, will be sent by _resume()
+                pending = session.query(PendingPostsDB.entry_id, PendingPostsDB.digest).filter(
+                    PendingPostsDB.entry_id.in_(ids[i:i + self.load_chunk])
+                )
+                for entry_id, digest in pending:
+                    seen[entry_id].add(digest)
+
+            # converts the old ' /// '-joined column
+            for entry_id, entry in entries.items():
+                if not entry.last_posts.strip(): continue
+                for title in entry.last_posts.split(' /// '):
+                    try: digest = bytes.fromhex(title.strip())
+                    except ValueError: continue
+                    if digest not in seen[entry_id]:
+                        seen[entry_id].add(digest)
+                        session.add(SeenPostsDB(entry_id=entry_id, digest=digest))
+                session.execute(
+                    sql.update(FeedsDB).where(FeedsDB.id == entry_id).values(last_posts='')
+                )
+            session.commit()
+
+        return seen
+
+    def _queue_posts(self, new_posts: UpdPosts):
+        """ Subfunction of _load(), keeps the new posts of a feed
+            until they are sent, see _resume() """
+        pending = [
+            PendingPostsDB(entry_id=post['entry'].id, digest=post['digest'],
+                           post=self._dump_post(post['post']))
+            for feeds in new_posts.values() for posts in feeds.values() for post in posts
+        ]
+        if not pending: return
+
+        with SQLSession() as session:
+            session.add_all(pending)
+            session.commit()
+
+    @staticmethod
+    def _dump_post(post: Post) -> str:
+        """ The digest has its own column. """
+        return json.dumps({
+            'title': post.title, 'summary': post.summary,
+            'link': post.link, 'published': post.published,
+        })
+
+    @staticmethod
+    def _load_post(text: str, digest: bytes) -> Post:
+        return Post(digest=digest, **json.loads(text))
+
+    def _save_schedule(self):
+        """ Saves the time of the next poll of the polled feeds,
+            so a restart doesn't poll them all at once. """
+        if not self.polled: return
+
+        with SQLSession() as session:
+            states = session.query(FeedStateDB).filter(FeedStateDB.url.in_(self.polled))
+            states = {state.url: state for state in states}
+            for url in self.polled:
+                due = self.scheduler.due.get(url)
+                if due is None: continue
+                if url not in states:
+                    states[url] = FeedStateDB(url=url)
+                    session.add(states[url])
+                states[url].next_poll = datetime.fromtimestamp(due)
+            session.commit()
+
+        self.polled = set()
+
+    def _save_feed_states(self):
+        """ Saves validators of the feeds downloaded in full, the failures
+            and the new addresses of the moved feeds.
+            It's done after the mailing, so an interrupted cycle
+            will download its unsent feeds once again. """
+        urls = self.new_validators.keys() | self.health.keys()
+        if urls:
+            with SQLSession() as session:
+                states = session.query(FeedStateDB).filter(FeedStateDB.url.in_(urls))
+                states = {state.url: state for state in states}
+                for url in urls:
+                    if url not in states:
+                        states[url] = FeedStateDB(url=url)
+                        session.add(states[url])
+                    if url in self.new_validators:
+                        states[url].etag, states[url].modified, \
+                            states[url].body_hash = self.new_validators[url]
+                    if url in self.health:
+                        states[url].failures, states[url].last_error, \
+                            states[url].retry_at = self.health[url]
+                session.commit()
+
+        self.new_validators = {}
+        self.health = {}
+        self._move_feeds()
+        if len(self.polled) >= self.batch_size:
+            self._save_schedule()
+
+    def _move_feeds(self):
+        """ Rewrites the subscriptions of the permanently moved feeds,
+            so the redirect isn't followed on every poll.
+            A user subscribed to both addresses keeps only the new one.
+            The state of the feed moves too, unless only the spelling
+            of its URL has changed, see fetcher.feed_key """
+        for url, (new_url, ids) in self.moved.items():
+            info(f'feed moved - {url} -> {new_url}')
+            new_key = self.key(new_url)
+            with SQLSession() as session:
+                for entry in session.query(FeedsDB).filter(FeedsDB.id.in_(ids)).all():
+                    others = session.query(FeedsDB.feed).filter(
+                        FeedsDB.uid == entry.uid, FeedsDB.id != entry.id
                     )
-                except (AttributeError, IndexError, FeedLoadError):
-                    log.warning(f'failed to load feed - {feed}')
-                except Exception as error:
-                    log.warning(f'feedparser fail - {error}')
-                finally:
-                    new_posts[uid][feed] = posts_to_send
+                    if any(self.key(feed) == new_key for feed in session.scalars(others)):
+                        session.query(SeenPostsDB).filter(SeenPostsDB.entry_id == entry.id).delete()
+                        session.query(PendingPostsDB).filter(PendingPostsDB.entry_id == entry.id).delete()
+                        session.delete(entry)
+                    else:
+                        entry.feed = new_url
+
+                state = None
+                if new_key != url:
+                    state = session.query(FeedStateDB).filter(FeedStateDB.url == url).first()
+                if state and session.query(FeedStateDB.id).filter(FeedStateDB.url == new_key).first():
+                    session.delete(state)
+                elif state:
+                    state.url = new_key
+                session.commit()
+
+        self.moved = {}
 
     def _populate_list_of_posts(self, posts_to_send: UpdPostList,
-                                posts: list, uid: int, feed: str):
+                                posts: List[Post], entry: Subscription):
         """ Subfunction of _load(), loads new posts from a feed. """
-        with SQLSession() as session:
-            db_entry = session.query(FeedsDB).filter(
-                FeedsDB.uid == uid,
-                FeedsDB.feed == feed
-            ).first()
-
-            old_posts = set(db_entry.last_posts.split(' /// '))
-            feed_last_check = db_entry.last_check
+        seen = self.seen.setdefault(entry.id, set())
 
         for post in posts:
-            published = datetime.fromtimestamp(
-                time.mktime(post.published_parsed)
-            )
-            if published <= feed_last_check:
+            published = datetime.fromtimestamp(post.published)
+            if published <= entry.last_check:
                 break
             else:
-                title = hashlib.md5(
-                    post.title.strip().encode()
-                ).hexdigest()
+                digest = post.digest
+                # the old column has md5 of titles
+                title = hashlib.md5(post.title.strip().encode()).digest()
 
-                if title in old_posts: continue
+                if digest in seen or title in seen: continue
                 else:
-                    new_post: UpdPost = {'title': title, 'post': post}
+                    seen.add(digest)
+                    new_post: UpdPost = {'digest': digest, 'post': post, 'entry': entry}
                     posts_to_send.append(new_post)
 
     def _forward(self, new_posts: UpdPosts):
         """ Organizes new posts mailing in order.
             The order of the posts should be reversed
-            to keep feed's original sequence."""
+            to keep feed's original sequence.
+            The posts go to the outbox table in batches, each with the state
+            of its subscription, so a crash neither loses nor repeats a post. """
         for uid in new_posts:
             for feed in new_posts[uid]:
-                for post in reversed(new_posts[uid][feed]):
-                    self._updater(uid, feed, post)
+                batch: UpdPostList = []
+                texts: List[str] = []
+                batch_start = time.monotonic()
 
-    def _updater(self, uid: int, feed: str, post: UpdPost):
+                for post in reversed(new_posts[uid][feed]):
+                    texts.append(self._updater(uid, feed, post))
+                    batch.append(post)
+                    if len(batch) >= self.batch_size or \
+                            time.monotonic() - batch_start >= self.batch_window:
+                        self._save_posts(batch, texts)
+                        batch, texts = [], []
+                        batch_start = time.monotonic()
+
+                self._save_posts(batch, texts)
+                if new_posts[uid][feed]:
+                    self._forget_old_posts(new_posts[uid][feed][0]['entry'].id, feed)
+
+    def _updater(self, uid: int, feed: str, post: UpdPost) -> str:
         """ A bottom function.
-            Forwards a post to the post sender function.
-            Save changes to the database. """
-        with SQLSession() as session:
-            db_entry = session.query(FeedsDB).filter(
-                FeedsDB.uid == uid,
-                FeedsDB.feed == feed
-            ).first()
+            Makes the message of a post, the sender thread delivers it.
+            The subscription was loaded by _load(), it isn't queried again. """
+        return self.post_text(post['post'], post['entry'], feed)
 
-            published = datetime.fromtimestamp(
-                time.mktime(post['post'].published_parsed)
-            )
-            old_posts = db_entry.last_posts.split(' /// ')
-            l = [post['title']] + old_posts
-            new_last_posts = ' /// '.join(l[:self.posts_to_store])
+    def _save_posts(self, posts: UpdPostList, texts: List[str]):
+        """ Puts a batch of posts of one subscription to the outbox table
+            and saves the subscription's state with a single commit. """
+        if not posts: return
 
-            self.send_a_post(self.bot, post['post'], db_entry, feed)
+        entry: Subscription = posts[0]['entry']
+        published = datetime.fromtimestamp(posts[-1]['post'].published)
+        with SQLSession() as session:
+            session.add_all(OutboxDB(uid=entry.uid, text=text) for text in texts)
+            session.add_all(
+                SeenPostsDB(entry_id=entry.id, digest=post['digest']) for post in posts
+            )
+            session.execute(
+                sql.update(FeedsDB).where(FeedsDB.id == entry.id).values(last_check=published)
+            )
+            session.query(PendingPostsDB).filter(
+                PendingPostsDB.entry_id == entry.id,
+                PendingPostsDB.digest.in_([post['digest'] for post in posts])
+            ).delete(synchronize_session=False)
+            session.commit()
+        # wakes the sender thread up
+        self.outbox.put(None)
 
-            db_entry.last_posts = new_last_posts
-            db_entry.last_check = published
+    def _forget_old_posts(self, entry_id: int, feed: str):
+        """ Keeps only the latest digests of a subscription. """
+        depth = self.depths.get(self.key(feed), self.posts_to_store)
+        with SQLSession() as session:
+            keep = session.query(SeenPostsDB.id).filter(
+                SeenPostsDB.entry_id == entry_id
+            ).order_by(SeenPostsDB.id.desc()).limit(depth)
+            session.query(SeenPostsDB).filter(
+                SeenPostsDB.entry_id == entry_id,
+                SeenPostsDB.id.not_in(keep.scalar_subquery())
+            ).delete(synchronize_session=False)
             session.commit()
 
     def _test(self):
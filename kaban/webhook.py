@@ -11,6 +11,7 @@ from kaban.settings import (
     REPLIT, REPLIT_URL
 )
 from kaban.helpers import exit_signal
+from kaban.websub import WEBSUB
 
 
 class WebhookThread(threading.Thread):
@@ -31,6 +32,7 @@ class WebhookThread(threading.Thread):
         self.ready = HOOK_READY_TO_WORK
         self.replit = REPLIT
         self.replit_url = REPLIT_URL
+        self.websub = WEBSUB
 
         try:
             self.server = make_server(
@@ -57,10 +59,12 @@ class WebhookThread(threading.Thread):
 
     def _make_tunnel(self):
         if self.replit:
-            self.url = self.replit_url + self.endpoint
+            base_url = self.replit_url
         else:
             tunnel = ngrok.connect(self.server_port, bind_tls=True)
-            self.url = tunnel.public_url + self.endpoint
+            base_url = tunnel.public_url
+        self.websub.start(base_url)
+        self.url = base_url + self.endpoint
 
     def _set_webhook(self):
         telebot.TeleBot(self.tg_api).remove_webhook()
@@ -0,0 +1,124 @@
+from datetime import datetime, timedelta
+import hashlib
+import hmac
+import secrets
+from typing import Optional
+
+import sqlalchemy as sql
+
+from kaban.settings import (
+    WEBSUB_ENDPOINT, WEBSUB_LEASE, WEBSUB_RENEW_MARGIN,
+    FEED_CONNECT_TIMEOUT, FEED_READ_TIMEOUT
+)
+from kaban.database import SQLSession, FeedStateDB
+from kaban.client import SESSION
+from kaban.log import info
+
+
+SIGNATURES = {'sha1': hashlib.sha1, 'sha256': hashlib.sha256,
+              'sha384': hashlib.sha384, 'sha512': hashlib.sha512}
+
+
+def check_signature(secret: str, body: bytes, signature: Optional[str]) -> bool:
+    """ X-Hub-Signature: method=hexdigest, HMAC of the body with the secret. """
+    method, _, digest = (signature or '').partition('=')
+    if method not in SIGNATURES: return False
+    expected = hmac.new(secret.encode(), body, SIGNATURES[method]).hexdigest()
+    return hmac.compare_digest(expected, digest)
+
+
+def lease_until(lease_seconds: Optional[str]) -> datetime:
+    try: seconds = int(lease_seconds)
+    except (TypeError, ValueError): seconds = WEBSUB_LEASE
+    return datetime.now() + timedelta(seconds=seconds)
+
+
+WEBSUB_FIELDS = ('websub_secret', 'websub_token', 'websub_mode', 'websub_base', 'lease_until')
+
+
+def end_subscription(state: FeedStateDB):
+    """ The feed goes back to the polling. """
+    state.hub = state.topic = None
+    for field in WEBSUB_FIELDS:
+        setattr(state, field, None)
+
+
+class WebSub:
+    """ WebSub subscriptions, https://www.w3.org/TR/websub/
+        A hub verifies the intent at the callback and then pushes the feed there,
+        see flask_config. The subscription lives in the feed's FeedStateDB row,
+        an unguessable token of the row makes the callback's URL.
+        The mode the bot has asked the hub for waits in the row,
+        the hub's verification is accepted only for that mode. """
+    def __init__(self, lease=WEBSUB_LEASE, margin=WEBSUB_RENEW_MARGIN):
+        # the public address of the app, it's known after the tunnel is made
+        self.base_url: Optional[str] = None
+        self.lease = lease
+        self.margin = margin
+
+    def callback(self, token: str) -> str:
+        return f'{self.base_url}{WEBSUB_ENDPOINT}/{token}'
+
+    def start(self, base_url: str):
+        """ Sets the public address of the app. The subscriptions made
+            at another address have dead callbacks: their leases end,
+            so the feeds are polled and subscribed again. """
+        self.base_url = base_url
+        with SQLSession() as session:
+            stale = session.query(FeedStateDB).filter(
+                FeedStateDB.websub_secret.is_not(None),
+                sql.or_(FeedStateDB.websub_base.is_(None), FeedStateDB.websub_base != base_url)
+            ).update(dict.fromkeys(WEBSUB_FIELDS), synchronize_session=False)
+            session.commit()
+        if stale: info(f'websub - {stale} subscriptions of the old address ended')
+
+    def subscribe(self, url: str, hub: str, topic: str) -> bool:
+        """ Asks the hub to push the feed. The lease starts
+            when the hub verifies the intent, not here. """
+        if not self.base_url: return False
+
+        with SQLSession() as session:
+            state = session.query(FeedStateDB).filter(FeedStateDB.url == url).first()
+            if not state:
+                state = FeedStateDB(url=url)
+                session.add(state)
+            state.hub, state.topic = hub, topic
+            state.websub_secret = state.websub_secret or secrets.token_hex(20)
+            state.websub_token = state.websub_token or secrets.token_urlsafe(20)
+            state.websub_mode, state.websub_base = 'subscribe', self.base_url
+            session.commit()
+            token, secret = state.websub_token, state.websub_secret
+
+        return self._request(hub, {
+            'hub.mode': 'subscribe',
+            'hub.topic': topic,
+            'hub.callback': self.callback(token),
+            'hub.secret': secret,
+            'hub.lease_seconds': str(self.lease),
+        })
+
+    def unsubscribe(self, url: str) -> bool:
+        """ For a feed that has no subscribers left. """
+        if not self.base_url: return False
+
+        with SQLSession() as session:
+            state = session.query(FeedStateDB).filter(FeedStateDB.url == url).first()
+            if not state or not state.hub or not state.websub_token: return False
+            state.websub_mode = 'unsubscribe'
+            session.commit()
+            hub, topic, token = state.hub, state.topic, state.websub_token
+
+        return self._request(hub, {
+            'hub.mode': 'unsubscribe',
+            'hub.topic': topic,
+            'hub.callback': self.callback(token),
+        })
+
+    @staticmethod
+    def _request(hub: str, data: dict) -> bool:
+        response = SESSION.post(hub, data=data, timeout=(FEED_CONNECT_TIMEOUT, FEED_READ_TIMEOUT))
+        info(f"websub - {data['hub.mode']} {data['hub.topic']}, {response.status_code}")
+        return response.ok
+
+
+WEBSUB = WebSub()
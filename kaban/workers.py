@@ -0,0 +1,75 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+import multiprocessing
+import threading
+
+from feedparser.util import FeedParserDict
+
+from kaban.settings import FEED_WORKER_PROCESSES, Feed
+from kaban.fetcher import fetch_feed
+from kaban.fastparser import parse_feed
+
+
+FEED_FIELDS = ('href', 'etag', 'modified', 'moved_to', 'body_hash', 'hub', 'topic', 'bozo')
+ENTRY_FIELDS = ('title', 'summary', 'link', 'id', 'published', 'published_parsed')
+
+
+def compact(parsed_feed: Feed) -> Feed:
+    """ Only the fields the bot uses, so little goes back to the updater.
+        The feed's links stay for the WebSub hub, see fetcher.websub_links """
+    result = FeedParserDict({key: parsed_feed.get(key) for key in FEED_FIELDS})
+    result['feed'] = FeedParserDict(links=[
+        FeedParserDict(rel=link.get('rel'), href=link.get('href'))
+        for link in parsed_feed.get('feed', {}).get('links', [])
+    ])
+    result['entries'] = [
+        FeedParserDict({key: entry[key] for key in ENTRY_FIELDS if key in entry})
+        for entry in parsed_feed.get('entries', [])
+    ]
+    return result
+
+
+def parse_compact(content: bytes, headers: dict = None, since: datetime = None) -> Feed:
+    """ Runs in a worker process. """
+    return compact(parse_feed(content, headers, since))
+
+
+class FeedWorkers:
+    """ Parses the downloaded feeds in [processes] worker processes,
+        so the parsing doesn't hold the GIL of the bot's process.
+        The downloads stay in the updater's fetcher threads, with the shared
+        SESSION, HOST_LIMITS and HTTP_METRICS; only the body goes to a worker
+        and only the compact feed comes back. """
+    def __init__(self, processes=FEED_WORKER_PROCESSES):
+        # forking a process with running threads isn't safe
+        self.context = multiprocessing.get_context('spawn')
+        self.processes = processes
+        self.pool = self._new_pool()
+        self.lock = threading.Lock()
+
+    def __len__(self): return self.processes
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.processes, mp_context=self.context)
+
+    def parse(self, content: bytes, headers: dict = None, since: datetime = None) -> Feed:
+        """ Same as fastparser.parse_feed, but in a worker. """
+        pool = self.pool
+        try:
+            return pool.submit(parse_compact, content, headers, since).result()
+        except BrokenProcessPool:
+            # a crashed worker breaks the whole pool, a new one takes the next feeds
+            with self.lock:
+                if self.pool is pool:
+                    pool.shutdown(wait=False)
+                    self.pool = self._new_pool()
+            raise
+
+    def fetch(self, url: str, etag: str = None, modified: str = None,
+              body_hash: bytes = None, since: datetime = None) -> Feed:
+        """ Same as fetcher.fetch_feed, but the parsing goes to a worker. """
+        return fetch_feed(url, etag, modified, body_hash, since, parse=self.parse)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
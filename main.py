@@ -29,6 +29,7 @@ from kaban.helpers import exit_signal
 from kaban.webhook import WebhookThread
 from kaban.updater import UpdaterThread
 from kaban.receiver import ReceiverThread
+from kaban.sender import SenderThread
 from kaban.settings import HOOK_READY_TO_WORK, EXIT_EVENT, REPLIT
 from kaban.log import log, info
 
@@ -38,7 +39,8 @@ def main():
     time.sleep(0.2)
 
     try:
-        server = WebhookThread(flask_config.get_app())
+        sender = SenderThread(bot_config.get_bot())
+        server = WebhookThread(flask_config.get_app(sender))
         receiver = ReceiverThread(bot_config.get_bot())
         updater = UpdaterThread(bot_config.get_bot())
     except Exception as exc:
@@ -46,6 +48,9 @@ def main():
         print("failed to load telebot & flask.")
         sys.exit(1)
 
+    print("starting a sender")
+    sender.start()
+
     print("starting a webhook")
     server.start()
     if HOOK_READY_TO_WORK.wait(20):
@@ -63,6 +68,7 @@ def main():
         print("All work has started (´｡• ω •｡`)")
     else:
         print("fail to start the webhook.")
+        sender.stop()
         sys.exit(2)
 
     if EXIT_EVENT.wait():
@@ -71,7 +77,8 @@ def main():
         server.shutdown()
 
     errors = False
-    for thread in [server, receiver, updater]:
+    # the sender goes last, it sends out what the others have left
+    for thread in [server, receiver, updater, sender]:
         try:
             thread.stop()
             print(f"{thread} stopped")
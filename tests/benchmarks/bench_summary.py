@@ -0,0 +1,58 @@
+""" Plain text of the feeds' summaries: the streaming stripper against BeautifulSoup.
+    Needs beautifulsoup4 (a dev package): python tests/benchmarks/bench_summary.py """
+import pathlib
+import sys
+import timeit
+
+from bs4 import BeautifulSoup
+
+BASE_DIR = pathlib.Path(__file__).resolve().parent.parent.parent
+if str(BASE_DIR) not in sys.path:
+    sys.path.append(str(BASE_DIR))
+
+from kaban.helpers import summary_text
+from kaban.settings import FEED_SUMMARY_LEN
+
+from tests.fixtures.fixtures import FEED_DATA
+
+
+PARAGRAPH = (
+    '<p>The <a href="https://example.com/?a=1&amp;b=2">company</a> has backed down '
+    'on its proposal&nbsp;&#8212; but the damage was <em>already</em> done.</p>\n'
+)
+ARTICLE = (
+    '<div class="article"><img src="https://example.com/cover.jpg" alt="cover"/>\n'
+    '<script type="text/javascript">window.ads = {"slot": "<p>top</p>"};</script>\n'
+    + PARAGRAPH * 200 + '<figure><figcaption>Photo &copy; someone</figcaption></figure></div>'
+)
+SUMMARIES = {
+    'fixture summaries': [entry['summary'] for entry in FEED_DATA['entries']],
+    'short html': [PARAGRAPH * 2] * 10,
+    'full articles': [ARTICLE] * 10,
+}
+
+
+def bs4_summary_text(summary):
+    """ The previous implementation. """
+    text = BeautifulSoup(summary, features='html.parser').text.strip()
+    if not text: return None
+    return text[:FEED_SUMMARY_LEN] + ("..." if len(text) > FEED_SUMMARY_LEN else "")
+
+
+def main(number=20):
+    for name, summaries in SUMMARIES.items():
+        for summary in summaries:
+            assert summary_text(summary) == bs4_summary_text(summary), summary
+
+        timings = {
+            function.__name__: min(timeit.repeat(
+                lambda: [function(summary) for summary in summaries], number=number, repeat=5
+            )) / number / len(summaries)
+            for function in (bs4_summary_text, summary_text)
+        }
+        old, new = timings['bs4_summary_text'], timings['summary_text']
+        print(f'{name:20} bs4 {old * 1e6:9.1f} us   stripper {new * 1e6:9.1f} us   x{old / new:.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,7 @@ if str(BASE_DIR) not in sys.path:
 
 from kaban.settings import MASTER_UID
 from kaban.database import SQLAlchemyBase, FeedsDB
+from kaban.fetcher import FEED_CACHE
 
 
 # last one should be the MASTER_UID
@@ -84,6 +85,9 @@ class MockDB(unittest.TestCase):
             else:
                 session.commit()
 
+    def setUp(self):
+        FEED_CACHE.clear()
+
     @classmethod
     def tearDownClass(cls):
         cls.db_uri.unlink()
@@ -102,6 +106,12 @@ MOCK_POST.link = POST_DATA['link']
 
 MOCK_FEED = Mock()
 MOCK_FEED.href = FEED_DATA['href']
+MOCK_FEED.etag = None
+MOCK_FEED.modified = None
+MOCK_FEED.moved_to = None
+MOCK_FEED.body_hash = None
+MOCK_FEED.hub = None
+MOCK_FEED.topic = None
 MOCK_FEED.entries = [MOCK_POST]
 
 
@@ -18,6 +18,7 @@ from kaban.helpers import exit_signal
 from kaban.webhook import WebhookThread
 from kaban.updater import UpdaterThread
 from kaban.receiver import ReceiverThread
+from kaban.sender import SenderThread
 from kaban.settings import (
     MASTER_UID, HOOK_READY_TO_WORK,
     HELP,
@@ -68,6 +69,7 @@ else: no_internet = False
 @patch('kaban.updater.log')
 @patch('kaban.helpers.info')
 @patch('kaban.helpers.log')
+@patch('kaban.sender.SQLSession')
 @patch('kaban.helpers.SQLSession')
 @patch('kaban.flask_config.SQLSession')
 @patch('kaban.receiver.SQLSession')
@@ -76,8 +78,8 @@ else: no_internet = False
 @unittest.skipIf(no_internet, 'no internet')
 class Integrity(MockDB):
     def test_integrity(self, mock_sender, upd_sql, rcv_sql,
-                       hook_sql, helpers_sql, *args):
-        for m in (upd_sql, rcv_sql, hook_sql, helpers_sql):
+                       hook_sql, helpers_sql, sender_sql, *args):
+        for m in (upd_sql, rcv_sql, hook_sql, helpers_sql, sender_sql):
             m.return_value = self.SQLSession()
 
         self._start()
@@ -85,6 +87,7 @@ class Integrity(MockDB):
         bot = bot_config.get_bot()
         server = WebhookThread(flask_config.get_app())
         receiver = ReceiverThread(bot)
+        sender = SenderThread(bot)
 
         updater = UpdaterThread(bot)
         updater._test = Mock()
@@ -94,6 +97,7 @@ class Integrity(MockDB):
         server.start()
         if HOOK_READY_TO_WORK.wait(20):
             time.sleep(0.5)
+            sender.start()
             receiver.start()
             updater.start()
             time.sleep(0.5)
@@ -127,7 +131,7 @@ class Integrity(MockDB):
             time.sleep(0.5)
             server.shutdown()
 
-        for thread in [server, receiver, updater]:
+        for thread in [server, receiver, updater, sender]:
             try:
                 thread.stop()
             except Exception as exc:
@@ -8,7 +8,11 @@ if str(BASE_DIR) not in sys.path:
     sys.path.append(str(BASE_DIR))
 
 from kaban.helpers import exit_signal
-from tests.units import test_helpers, test_bot_processor, test_receiver, test_updater, test_webhook
+from tests.units import (
+    test_helpers, test_bot_processor, test_receiver,
+    test_updater, test_webhook, test_fetcher, test_scheduler,
+    test_fastparser, test_client, test_workers, test_websub, test_sender
+)
 from tests.integration import integration
 
 
@@ -18,10 +22,19 @@ def execute():
     # big_suite = unittest.TestLoader().loadTestsFromModule(test_updater)
     # big_suite = unittest.TestLoader().loadTestsFromModule(test_receiver)
     # big_suite = unittest.TestLoader().loadTestsFromModule(test_bot_processor)
+    # big_suite = unittest.TestLoader().loadTestsFromModule(test_fetcher)
+    # big_suite = unittest.TestLoader().loadTestsFromModule(test_scheduler)
+    # big_suite = unittest.TestLoader().loadTestsFromModule(test_fastparser)
+    # big_suite = unittest.TestLoader().loadTestsFromModule(test_client)
+    # big_suite = unittest.TestLoader().loadTestsFromModule(test_workers)
+    # big_suite = unittest.TestLoader().loadTestsFromModule(test_websub)
+    # big_suite = unittest.TestLoader().loadTestsFromModule(test_sender)
     # big_suite = unittest.TestLoader().loadTestsFromModule(integration)
 
     test_modules = [test_helpers, test_bot_processor,
-                    test_receiver, test_updater, test_webhook]
+                    test_receiver, test_updater, test_webhook,
+                    test_fetcher, test_scheduler, test_fastparser,
+                    test_client, test_workers, test_websub, test_sender]
 
     suite_list = []
     loader = unittest.TestLoader()
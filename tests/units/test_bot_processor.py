@@ -83,6 +83,7 @@ class AddNewFeed(unittest.TestCase):
 
     def test_check_out(self, mock_sender, mock_feed_checker, *args):
         USERS.setdefault(MASTER_UID, {'AWAITING_FEED': True, 'POTENTIAL_FEED': None})
+        mock_feed_checker.return_value = TEST_DB[0]['feed']
         update = make_update(TEST_DB[0]['feed'])
         self.bot.process_new_updates([update])
 
@@ -0,0 +1,141 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pathlib
+import socket
+import sys
+import threading
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+BASE_DIR = pathlib.Path(__file__).resolve().parent.parent.parent
+if str(BASE_DIR) not in sys.path:
+    sys.path.append(str(BASE_DIR))
+
+from kaban import client, fetcher
+
+from tests.units.test_fetcher import RSS
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/rss+xml')
+        self.send_header('Content-Length', str(len(RSS)))
+        self.end_headers()
+        self.wfile.write(RSS)
+
+    def log_message(self, *args): pass
+
+
+class KeepAlive(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FeedHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.host = f'127.0.0.1:{cls.server.server_port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_connection_reuse(self):
+        fetcher.FEED_CACHE.clear()
+        for i in range(3):
+            parsed_feed = fetcher.fetch_feed(f'http://{self.host}/rss?{i}')
+            self.assertEqual(parsed_feed.entries[0].title, 'post-1')
+
+        stats = client.HTTP_METRICS.report()[self.host]
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['reused'], 2)
+        self.assertIn('3 requests', str(client.HTTP_METRICS))
+
+
+class DNSCache(unittest.TestCase):
+    def test_ttl(self):
+        resolver = Mock(return_value=[('address',)])
+        cache = client.DNSCache(ttl=0.1, resolver=resolver)
+        for _ in range(3):
+            self.assertEqual(cache.getaddrinfo('example.com', 443), [('address',)])
+        cache.getaddrinfo('example.org', 443)
+        self.assertEqual(resolver.call_count, 2)
+
+        time.sleep(0.15)
+        cache.getaddrinfo('example.com', 443)
+        self.assertEqual(resolver.call_count, 3)
+
+    def test_session_only(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FeedHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        resolver = Mock(side_effect=socket.getaddrinfo)
+        try:
+            with patch('kaban.client.DNS_CACHE', client.DNSCache(resolver=resolver)):
+                for _ in range(2):
+                    session = client.new_session()
+                    response = session.get(f'http://localhost:{server.server_port}/rss')
+                    self.assertEqual(response.content, RSS)
+                    session.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(resolver.call_count, 1)
+        self.assertEqual(resolver.call_args.args[0], 'localhost')
+        # the rest of the process isn't touched
+        self.assertEqual(socket.getaddrinfo.__module__, 'socket')
+
+    def test_next_address(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FeedHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_port
+        # nothing listens on the first one
+        addresses = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (ip, port))
+                     for ip in ('127.0.0.2', '127.0.0.1')]
+        try:
+            with patch('kaban.client.DNS_CACHE', client.DNSCache(resolver=Mock(return_value=addresses))):
+                session = client.new_session()
+                response = session.get(f'http://feeds.example:{port}/rss', timeout=5)
+                session.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(response.content, RSS)
+
+    def test_errors_are_not_cached(self):
+        resolver = Mock(side_effect=OSError)
+        cache = client.DNSCache(resolver=resolver)
+        for _ in range(2):
+            with self.assertRaises(OSError):
+                cache.getaddrinfo('example.com', 443)
+        self.assertEqual(resolver.call_count, 2)
+
+
+class HostLimits(unittest.TestCase):
+    def test_limit(self):
+        limits = client.HostLimits(limit=2)
+        self.assertIs(limits.slot('https://a.com/1'), limits.slot('https://A.com/2'))
+        self.assertIsNot(limits.slot('https://a.com/1'), limits.slot('https://b.com/1'))
+
+        active, peak = 0, 0
+        lock = threading.Lock()
+
+        def request():
+            nonlocal active, peak
+            with limits.slot('https://a.com/rss'):
+                with lock:
+                    active += 1
+                    peak = max(peak, active)
+                time.sleep(0.05)
+                with lock: active -= 1
+
+        threads = [threading.Thread(target=request) for _ in range(6)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(peak, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
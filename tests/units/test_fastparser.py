@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+import json
+import pathlib
+import sys
+import unittest
+from unittest.mock import patch
+
+import feedparser
+
+BASE_DIR = pathlib.Path(__file__).resolve().parent.parent.parent
+if str(BASE_DIR) not in sys.path:
+    sys.path.append(str(BASE_DIR))
+
+from kaban import fastparser
+from kaban.fastparser import FastParseError
+
+
+START = datetime(2022, 1, 20, 12, tzinfo=timezone.utc)
+
+
+def rss(count: int) -> bytes:
+    """ The posts are an hour apart, the newest goes first. """
+    items = ''.join(
+        f'<item><title>post-{i}</title><link>https://example.com/{i}</link>'
+        f'<description>&lt;p&gt;text {i}&lt;/p&gt;</description>'
+        f'<guid>guid-{i}</guid>'
+        f'<pubDate>{format_datetime(START - timedelta(hours=i))}</pubDate></item>'
+        for i in range(count)
+    )
+    return f'<?xml version="1.0"?><rss version="2.0"><channel>' \
+           f'<title>test</title>{items}</channel></rss>'.encode()
+
+
+ATOM = b"""<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom"><title>test</title>
+<entry><title>post-0</title><id>urn:0</id>
+<link rel="self" href="https://example.com/self"/><link href="https://example.com/0"/>
+<updated>2022-01-13T12:00:00Z</updated>
+<content type="xhtml"><div xmlns="http://www.w3.org/1999/xhtml"><p>text</p></div></content>
+</entry></feed>"""
+
+JSON_FEED = json.dumps({
+    'version': 'https://jsonfeed.org/version/1.1', 'title': 'test',
+    'items': [{'id': 1, 'url': 'https://example.com/1', 'title': 'post-1',
+               'content_html': '<p>text</p>', 'date_published': '2022-01-13T12:00:00Z'}]
+}).encode()
+
+RDF = b"""<?xml version="1.0"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns="http://purl.org/rss/1.0/">
+<item><title>post-0</title><link>https://example.com/0</link></item></rdf:RDF>"""
+
+
+class FastParse(unittest.TestCase):
+    def test_rss(self):
+        parsed_feed = fastparser.fast_parse(rss(3))
+        reference = feedparser.parse(rss(3))
+
+        self.assertEqual(len(parsed_feed.entries), 3)
+        for post, expected in zip(parsed_feed.entries, reference.entries):
+            for key in ('title', 'link', 'id', 'summary', 'published_parsed'):
+                self.assertEqual(getattr(post, key), getattr(expected, key))
+
+    def test_atom(self):
+        post = fastparser.fast_parse(ATOM).entries[0]
+        self.assertEqual(post.title, 'post-0')
+        self.assertEqual(post.link, 'https://example.com/0')
+        self.assertEqual(post.id, 'urn:0')
+        self.assertEqual(post.summary, 'text')
+        self.assertEqual(post.published_parsed, feedparser.parse(ATOM).entries[0].updated_parsed)
+
+    def test_json_feed(self):
+        post = fastparser.fast_parse(JSON_FEED).entries[0]
+        self.assertEqual(post.title, 'post-1')
+        self.assertEqual(post.link, 'https://example.com/1')
+        self.assertEqual(post.id, '1')
+        self.assertEqual(post.summary, '<p>text</p>')
+        self.assertEqual(post.published_parsed[:3], (2022, 1, 13))
+
+    def test_stops_early(self):
+        # the bot keeps the publication dates as naive UTC
+        since = (START - timedelta(hours=5)).replace(tzinfo=None)
+        parsed_feed = fastparser.fast_parse(rss(100), since, min_entries=2)
+        self.assertEqual(parsed_feed.entries[-1].title, 'post-5')
+
+        parsed_feed = fastparser.fast_parse(rss(100), since, min_entries=8)
+        self.assertEqual(len(parsed_feed.entries), 8)
+
+    def test_unknown_documents(self):
+        for content in (RDF, b'<rss><channel><item>', b'not a feed', b'{"items": []}'):
+            with self.assertRaises(FastParseError):
+                fastparser.fast_parse(content)
+
+    def test_fallback(self):
+        self.assertEqual(fastparser.parse_feed(RDF).entries[0].title, 'post-0')
+
+        with patch('kaban.fastparser.feedparser') as mock_feedparser:
+            fastparser.parse_feed(rss(1))
+            mock_feedparser.parse.assert_not_called()
+            fastparser.parse_feed(RDF)
+            mock_feedparser.parse.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
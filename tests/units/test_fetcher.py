@@ -0,0 +1,277 @@
+from copy import deepcopy
+from datetime import datetime
+import gc
+import pathlib
+import sys
+import time
+import unittest
+import weakref
+from unittest.mock import Mock, patch, ANY
+
+BASE_DIR = pathlib.Path(__file__).resolve().parent.parent.parent
+if str(BASE_DIR) not in sys.path:
+    sys.path.append(str(BASE_DIR))
+
+from kaban import fetcher
+from kaban.settings import FeedNotModified, FeedTooLarge
+
+from tests.fixtures.fixtures import reset_mock, MOCK_FEED
+
+
+RSS = b"""<?xml version="1.0"?>
+<rss version="2.0"><channel><title>test</title>
+<item><title>post-1</title><link>https://example.com/1</link>
+<pubDate>Thu, 13 Jan 2022 12:00:00 +0000</pubDate></item>
+</channel></rss>"""
+
+
+@patch('kaban.fetcher.open_connections', return_value=1)
+@patch('kaban.fetcher.SESSION')
+class FetchFeed(unittest.TestCase):
+    def test_normal_case(self, mock_session, foo):
+        response = mock_session.get.return_value
+        response.iter_content.return_value = [RSS[:50], RSS[50:]]
+        response.headers = {'content-type': 'application/rss+xml'}
+        response.url = 'https://example.com/rss'
+
+        parsed_feed = fetcher.fetch_feed('http://example.com/rss')
+        mock_session.get.assert_called_with(
+            'http://example.com/rss', stream=True, headers=ANY, timeout=ANY
+        )
+        self.assertIn('gzip', mock_session.get.call_args.kwargs['headers']['Accept-Encoding'])
+        response.close.assert_called_once()
+        self.assertEqual(parsed_feed.href, 'https://example.com/rss')
+        self.assertEqual(parsed_feed.entries[0].title, 'post-1')
+
+        reset_mock(mock_session)
+
+    def test_not_modified(self, mock_session, foo):
+        mock_session.get.return_value.status_code = 304
+        modified = 'Thu, 13 Jan 2022 12:00:00 GMT'
+        with self.assertRaises(FeedNotModified):
+            fetcher.fetch_feed('http://example.com/rss', etag='"v1"', modified=modified)
+
+        headers = mock_session.get.call_args.kwargs['headers']
+        self.assertEqual(headers['If-None-Match'], '"v1"')
+        self.assertEqual(headers['If-Modified-Since'], modified)
+
+        reset_mock(mock_session)
+
+    def test_same_body(self, mock_session, foo):
+        response = mock_session.get.return_value
+        response.iter_content.side_effect = lambda chunk_size: iter([RSS])
+        response.headers = {}
+        response.url = 'https://example.com/rss'
+
+        parsed_feed = fetcher.fetch_feed('https://example.com/rss')
+        with patch('kaban.fetcher.parse_feed') as mock_parser:
+            with self.assertRaises(FeedNotModified):
+                fetcher.fetch_feed('https://example.com/rss', body_hash=parsed_feed.body_hash)
+            mock_parser.assert_not_called()
+
+            response.iter_content.side_effect = lambda chunk_size: iter([RSS + b' '])
+            fetcher.fetch_feed('https://example.com/rss', body_hash=parsed_feed.body_hash)
+            mock_parser.assert_called_once()
+
+        reset_mock(mock_session)
+
+    def test_size_limit(self, mock_session, foo):
+        response = mock_session.get.return_value
+        response.headers = {}
+        response.iter_content.return_value = iter([b'x' * 600] * 1000)
+        with self.assertRaises(FeedTooLarge):
+            fetcher.read_body(response, max_size=1000)
+        self.assertGreater(len(list(response.iter_content.return_value)), 990)
+
+        response.headers = {'Content-Length': '5000'}
+        with self.assertRaises(FeedTooLarge):
+            fetcher.read_body(response, max_size=1000)
+
+        reset_mock(mock_session)
+
+    def test_http_error(self, mock_session, foo):
+        mock_session.get.return_value.raise_for_status.side_effect = Exception('404')
+        with self.assertRaises(Exception):
+            fetcher.fetch_feed('http://example.com/rss')
+
+        reset_mock(mock_session)
+
+
+class MovedTo(unittest.TestCase):
+    def test_redirects(self):
+        def hop(status, url):
+            return Mock(status_code=status, url=url)
+
+        response = Mock(url='https://c.com/rss', history=[])
+        self.assertIsNone(fetcher.moved_to(response))
+
+        response.history = [hop(301, 'http://a.com/rss'), hop(308, 'https://a.com/rss/')]
+        self.assertEqual(fetcher.moved_to(response), 'https://c.com/rss')
+
+        response.history = [hop(301, 'http://a.com/rss'), hop(302, 'https://b.com/rss')]
+        self.assertEqual(fetcher.moved_to(response), 'https://b.com/rss')
+
+        response.history = [hop(307, 'http://a.com/rss'), hop(301, 'https://b.com/rss')]
+        self.assertIsNone(fetcher.moved_to(response))
+
+
+class FeedCache(unittest.TestCase):
+    def test_hits_and_misses(self):
+        cache = fetcher.FeedCache(ttl=60, size=8)
+        self.assertIsNone(cache.get('https://example.com/rss'))
+        cache.put('https://example.com/rss', MOCK_FEED)
+        self.assertIs(cache.get('HTTPS://Example.com/rss#top'), MOCK_FEED)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_ttl(self):
+        cache = fetcher.FeedCache(ttl=0.1, size=8)
+        cache.put('https://example.com/rss', MOCK_FEED)
+        time.sleep(0.15)
+        self.assertIsNone(cache.get('https://example.com/rss'))
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_eviction(self):
+        cache = fetcher.FeedCache(ttl=60, size=2)
+        cache.put('https://a.com/rss', MOCK_FEED)
+        cache.put('https://b.com/rss', MOCK_FEED)
+        cache.get('https://a.com/rss')
+        cache.put('https://c.com/rss', MOCK_FEED)
+
+        self.assertIsNone(cache.get('https://b.com/rss'))
+        self.assertIs(cache.get('https://a.com/rss'), MOCK_FEED)
+        self.assertEqual(len(cache), 2)
+
+    def test_get_feed(self):
+        fetcher.FEED_CACHE.clear()
+        with patch('kaban.fetcher.fetch_feed', return_value=MOCK_FEED) as mock_fetch:
+            fetcher.get_feed('https://example.com/rss')
+            fetcher.get_feed('https://example.com/rss')
+            fetcher.get_feed('https://example.com/atom')
+        self.assertEqual(mock_fetch.call_count, 2)
+        fetcher.FEED_CACHE.clear()
+
+
+class FetchFeeds(unittest.TestCase):
+    def setUp(self):
+        fetcher.FEED_CACHE.clear()
+
+    def test_no_cache(self):
+        urls = ['https://example.com/rss']
+        with patch('kaban.fetcher.fetch_feed', return_value=MOCK_FEED) as mock_fetch:
+            fetcher.FEED_CACHE.put(urls[0], 'added a moment ago')
+            self.assertIs(dict(fetcher.iter_feeds(urls))[urls[0]], MOCK_FEED)
+            fetcher.FEED_CACHE.clear()
+            dict(fetcher.iter_feeds(urls))
+        self.assertEqual(mock_fetch.call_count, 2)
+        self.assertEqual(len(fetcher.FEED_CACHE), 0)
+
+    def test_concurrency(self):
+        def slow_fetch(url, *validators):
+            time.sleep(0.2)
+            return MOCK_FEED
+
+        urls = [f'https://example.com/{i}' for i in range(8)]
+        with patch('kaban.fetcher.fetch_feed', side_effect=slow_fetch):
+            start = time.monotonic()
+            results = dict(fetcher.iter_feeds(urls, workers=8))
+            elapsed = time.monotonic() - start
+
+        self.assertLess(elapsed, 0.2 * len(urls) / 2)
+        self.assertEqual(set(results), set(urls))
+        for url in urls:
+            self.assertIs(results[url], MOCK_FEED)
+
+    def test_failures(self):
+        def fetch(url, *validators):
+            if url.endswith('slow'): time.sleep(0.5)
+            if url.endswith('broken'): raise ValueError(url)
+            return MOCK_FEED
+
+        urls = ['https://a.com/slow', 'https://a.com/broken', 'https://a.com/fine']
+        with patch('kaban.fetcher.fetch_feed', side_effect=fetch):
+            results = dict(fetcher.iter_feeds(urls, workers=3, deadline=0.2))
+
+        self.assertIsInstance(results['https://a.com/slow'], TimeoutError)
+        self.assertIsInstance(results['https://a.com/broken'], ValueError)
+        self.assertIs(results['https://a.com/fine'], MOCK_FEED)
+
+    def test_streaming(self):
+        def fetch(url, *validators):
+            if url.endswith('slow'): time.sleep(0.3)
+            return MOCK_FEED
+
+        urls = ['https://a.com/slow', 'https://a.com/fast']
+        with patch('kaban.fetcher.fetch_feed', side_effect=fetch):
+            start = time.monotonic()
+            feeds = fetcher.iter_feeds(urls, workers=2)
+            url, result = next(feeds)
+            self.assertEqual(url, 'https://a.com/fast')
+            self.assertLess(time.monotonic() - start, 0.2)
+            self.assertEqual(next(feeds)[0], 'https://a.com/slow')
+
+    def test_deadline_counts_downloads(self):
+        def fetch(url, *validators):
+            if url.endswith('slow'): time.sleep(0.3)
+            return MOCK_FEED
+
+        urls = ['https://a.com/fast', 'https://a.com/slow']
+        with patch('kaban.fetcher.fetch_feed', side_effect=fetch):
+            feeds = fetcher.iter_feeds(urls, workers=2, deadline=0.2)
+            self.assertEqual(next(feeds)[0], 'https://a.com/fast')
+            # the mailing of the first feed takes longer than the deadline
+            time.sleep(0.4)
+            url, result = next(feeds)
+        self.assertEqual(url, 'https://a.com/slow')
+        self.assertIs(result, MOCK_FEED)
+
+    def test_compact_in_download(self):
+        parsed_feeds = {}
+
+        def fetch(url, *validators):
+            parsed_feed = deepcopy(MOCK_FEED)
+            parsed_feeds[url] = weakref.ref(parsed_feed)
+            return parsed_feed
+
+        urls = [f'https://example.com/{i}' for i in range(4)]
+        since = {url: datetime(2022, 1, i + 1) for i, url in enumerate(urls)}
+        with patch('kaban.fetcher.fetch_feed', side_effect=fetch):
+            feeds = fetcher.iter_feeds(urls, since=since, workers=2, queue_size=1,
+                                       compact=lambda parsed_feed, since: since)
+            url, result = next(feeds)
+            self.assertEqual(result, since[url])
+            time.sleep(0.1)
+            gc.collect()
+            # only the compact results wait in the queue
+            self.assertTrue(parsed_feeds)
+            self.assertTrue(all(ref() is None for ref in parsed_feeds.values()))
+            self.assertEqual(dict(feeds), {other: since[other] for other in urls if other != url})
+
+    def test_consumer_owns_the_feed(self):
+        def fetch(url, *validators):
+            return deepcopy(MOCK_FEED)
+
+        urls = [f'https://example.com/{i}' for i in range(3)]
+        with patch('kaban.fetcher.fetch_feed', side_effect=fetch):
+            feeds = fetcher.iter_feeds(urls, workers=1)
+            url, result = next(feeds)
+            ref = weakref.ref(result)
+            del result
+            gc.collect()
+            # the suspended generator doesn't keep it
+            self.assertIsNone(ref())
+            self.assertEqual(len(list(feeds)), len(urls) - 1)
+
+    def test_bounded_queue(self):
+        urls = [f'https://example.com/{i}' for i in range(10)]
+        with patch('kaban.fetcher.fetch_feed', return_value=MOCK_FEED) as mock_fetch:
+            feeds = fetcher.iter_feeds(urls, workers=2, queue_size=1)
+            next(feeds)
+            time.sleep(0.2)
+            # one feed in the consumer, one in the queue, one in each worker
+            self.assertLessEqual(mock_fetch.call_count, 4)
+            self.assertEqual(len(list(feeds)), len(urls) - 1)
+            self.assertEqual(mock_fetch.call_count, len(urls))
+
+
+if __name__ == '__main__':
+    unittest.main()
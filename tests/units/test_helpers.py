@@ -14,15 +14,15 @@ if str(BASE_DIR) not in sys.path:
     sys.path.append(str(BASE_DIR))
 
 from kaban import helpers
-from kaban.database import FeedsDB
+from kaban.database import FeedsDB, SeenPostsDB
 from kaban.settings import (
     DataAlreadyExists, FeedFormatError, FeedPreprocessError,
-    CMD_SUMMARY, CMD_DATE, CMD_LINK, SHORTCUT_LEN,
+    CMD_SUMMARY, CMD_DATE, CMD_LINK, SHORTCUT_LEN, FEED_SUMMARY_LEN,
     WRONG_TOKEN, UID_NOT_FOUND, BOT_BLOCKED, BOT_TIMEOUT
 )
 from tests.fixtures.fixtures import (
     MockDB, reset_mock, TEST_DB,
-    MOCK_DB_ENTRY, MOCK_POST, MOCK_FEED
+    MOCK_DB_ENTRY, MOCK_POST, MOCK_FEED, FEED_DATA
 )
 
 
@@ -31,14 +31,18 @@ from tests.fixtures.fixtures import (
 @patch('kaban.helpers.exit_signal')
 @patch('kaban.helpers.delete_user')
 class SendMessage(unittest.TestCase):
+    def test_queue(self, *args):
+        with patch('kaban.helpers.OUTBOX') as mock_outbox:
+            helpers.send_message('bot', 42, 'hello')
+        mock_outbox.put.assert_called_once_with(('bot', 42, 'hello'))
+
     def test_normal_case(self, *args):
         mock_bot = Mock()
-        with patch('kaban.helpers.resend_message') as mock_resend:
-            mock_resend.return_value = False
-            helpers.send_message(mock_bot, 42, 'hello')
+        with patch('kaban.helpers.retry_delay') as mock_retry:
+            self.assertEqual(helpers.deliver_message(mock_bot, 42, 'hello'), (True, None))
 
         mock_bot.send_message.assert_called_once()
-        mock_resend.assert_not_called()
+        mock_retry.assert_not_called()
 
         reset_mock(*args)
 
@@ -61,47 +65,63 @@ class SendMessage(unittest.TestCase):
                     'foo', 'bar', {'error_code': 400, 'description': _dict['descr']}
                 )
             mock_bot.send_message.side_effect = exc
-            with patch('kaban.helpers.resend_message') as mock_resend:
-                mock_resend.return_value = False
-                helpers.send_message(mock_bot, 42, 'hello')
+            with patch('kaban.helpers.retry_delay') as mock_retry:
+                mock_retry.return_value = None
+                self.assertEqual(helpers.deliver_message(mock_bot, 42, 'hello'), (False, None))
 
             if _dict['descr'] == WRONG_TOKEN.pattern:
                 mock_exit.assert_called_once()
                 mock_log.critical.assert_called_with(_dict['log'])
             elif _dict['descr'] == 'broken':
-                mock_resend.assert_called_once()
+                mock_retry.assert_called_once()
             else:
-                mock_resend.assert_called_once()
+                mock_retry.assert_called_once()
                 mock_log.warning.assert_called_with(_dict['log'])
             mock_log.reset_mock()
 
         reset_mock(foo, mock_exit, bar, mock_log)
 
-    def test_resend_message(self, mock_delete_user, foo, mock_time, bar):
+    def test_retries(self, mock_delete_user, foo, mock_time, bar):
         mock_bot = Mock()
         exc = ApiTelegramException(
             'foo', 'bar', {'error_code': 400, 'description': BOT_BLOCKED.pattern}
         )
         mock_bot.send_message.side_effect = exc
-        helpers.send_message(mock_bot, 42, 'hello')
+        delays = [helpers.deliver_message(mock_bot, 42, 'hello', attempt)[1] for attempt in range(4)]
 
-        self.assertEqual(mock_bot.send_message.call_count, 4)
-        self.assertEqual(mock_time.sleep.call_count, 4)
+        # doubles with every attempt, give or take a half
+        for attempt, delay in enumerate(delays[:3]):
+            self.assertTrue(10 * 2 ** attempt * 0.5 <= delay <= 10 * 2 ** attempt * 1.5)
+        self.assertIsNone(delays[3])
+        mock_time.sleep.assert_not_called()
         mock_delete_user.assert_called_once()
 
         reset_mock(mock_delete_user, foo, mock_time, bar)
 
+    def test_retry_after(self, *args):
+        mock_bot = Mock()
+        mock_bot.send_message.side_effect = ApiTelegramException('foo', 'bar', {
+            'error_code': 429, 'description': 'Too many requests: retry after 7',
+            'parameters': {'retry_after': 7}
+        })
+        self.assertEqual(helpers.deliver_message(mock_bot, 42, 'hello'), (False, 7))
+
+        reset_mock(*args)
+
 
 @patch('kaban.helpers.feed_switcher')
 @patch('kaban.helpers.send_message')
 class PostSender(MockDB):
     def test_normal_case(self, mock_message, mock_switcher):
         mock_db_entry = deepcopy(MOCK_DB_ENTRY)
-        mock_post = deepcopy(MOCK_POST)
+        post = helpers.compact_post(MOCK_POST)
 
-        helpers.send_a_post('bot', mock_post, mock_db_entry, 'dummy-feed')
+        helpers.send_a_post('bot', post, mock_db_entry, 'dummy-feed')
         mock_message.assert_called_with('bot', mock_db_entry.uid, ANY)
         mock_switcher.assert_not_called()
+        text = mock_message.call_args.args[2]
+        self.assertIn(post.title, text)
+        self.assertIn(post.link, text)
 
         reset_mock(mock_message, mock_switcher)
 
@@ -113,25 +133,136 @@ class PostSender(MockDB):
         mock_post.summary = None
         mock_post.link = None
 
-        helpers.send_a_post('bot', mock_post, mock_db_entry, 'dummy-feed')
+        helpers.send_a_post('bot', helpers.compact_post(mock_post), mock_db_entry, 'dummy-feed')
         mock_switcher.assert_called_with(mock_db_entry.uid, ANY, 'dummy-feed', silent=True)
         self.assertEqual(mock_switcher.call_count, 2)
 
         reset_mock(foo, mock_switcher)
 
 
-@patch('kaban.helpers.feedparser')
+    def test_render_once(self, mock_message, foo):
+        helpers.render_post.cache_clear()
+        post = helpers.compact_post(MOCK_POST)
+        entries = []
+        for uid, short in ((1, None), (2, None), (3, 'py')):
+            entry = deepcopy(MOCK_DB_ENTRY)
+            entry.uid, entry.short = uid, short
+            entries.append(entry)
+            helpers.send_a_post('bot', post, entry, 'dummy-feed')
+
+        texts = [call.args[2] for call in mock_message.call_args_list]
+        self.assertIs(texts[0], texts[1])
+        self.assertEqual(texts[2], f'py: {texts[0]}')
+        self.assertEqual(helpers.render_post.cache_info().misses, 2)
+
+        reset_mock(mock_message, foo)
+
+
+class CompactPost(unittest.TestCase):
+    def test_normal_case(self):
+        post = helpers.compact_post(MOCK_POST)
+        self.assertEqual(post.title, MOCK_POST.title)
+        self.assertEqual(post.digest, helpers.post_digest(MOCK_POST))
+        self.assertEqual(post.link, MOCK_POST.link)
+        self.assertEqual(post.published, time.mktime(MOCK_POST.published_parsed))
+        self.assertNotIn('<', post.summary)
+        self.assertFalse(hasattr(post, '__dict__'))
+
+    def test_summary(self):
+        self.assertIsNone(helpers.summary_text(None))
+        self.assertIsNone(helpers.summary_text('<p> </p>'))
+        self.assertEqual(helpers.summary_text('<p>short</p>'), 'short')
+        summary = helpers.summary_text('x' * (FEED_SUMMARY_LEN + 1))
+        self.assertEqual(summary, 'x' * FEED_SUMMARY_LEN + '...')
+        summary = helpers.summary_text('x' * FEED_SUMMARY_LEN + ' \n ')
+        self.assertEqual(summary, 'x' * FEED_SUMMARY_LEN)
+
+    def test_stripper(self):
+        html = '\n<p>Fish &amp; chips&nbsp;&#8212; <b>hot</b>!</p>\n\n<p>now</p>' \
+               '<script>var p = "<p>no</p>";</script><style>p {}</style><!-- no -->' \
+               '<pre>  a\tb</pre><p>\t</p><![CDATA[x < y]]>&foo;'
+        self.assertEqual(helpers.summary_text(html),
+                         'Fish & chips\xa0\u2014 hot!\nnow  a\tb x < y&foo;')
+        for entry in FEED_DATA['entries']:
+            self.assertEqual(helpers.summary_text(entry['summary']), entry['summary'])
+
+    def test_stripper_stops(self):
+        stripper = helpers.TextStripper(limit=10)
+        stripper.feed('<p>' + 'word ' * 2 + '\n<b>')
+        self.assertFalse(stripper.done)
+        stripper.feed('word</b>')
+        self.assertTrue(stripper.done)
+        # the rest of the document isn't looked at
+        stripper.feed('<p>more</p>')
+        self.assertNotIn('more', stripper.text())
+
+        html = '<p>' + 'word ' * 100 + '</p>' * 10 ** 5
+        with patch.object(helpers.TextStripper, 'handle_endtag') as handle_endtag:
+            summary = helpers.summary_text(html)
+        self.assertEqual(summary, ('word ' * 100)[:FEED_SUMMARY_LEN] + '...')
+        self.assertLess(handle_endtag.call_count, 1000)
+
+
+class PostDigest(unittest.TestCase):
+    def test_normal_case(self):
+        post = deepcopy(MOCK_POST)
+        digest = helpers.post_digest(post)
+        self.assertEqual(len(digest), 16)
+        self.assertEqual(digest, hashlib.md5(post.link.encode()).digest())
+
+        post.id = ' tag:example.com,2022:1 '
+        self.assertEqual(helpers.post_digest(post), hashlib.md5(b'tag:example.com,2022:1').digest())
+
+        post.id, post.link = None, ''
+        self.assertEqual(helpers.post_digest(post), hashlib.md5(post.title.strip().encode()).digest())
+
+
+class CanonicalFeed(unittest.TestCase):
+    def test_normal_case(self):
+        feed = 'https://example.com/rss'
+        self.assertEqual(helpers.canonical_feed(' HTTPS://Example.COM/rss#top '), feed)
+        self.assertEqual(helpers.canonical_feed('https://example.com'), 'https://example.com/')
+        self.assertNotEqual(helpers.canonical_feed('https://example.com/RSS'), feed)
+        self.assertEqual(helpers.canonical_feed('https://example.com:443/rss/'), feed + '/')
+        self.assertEqual(
+            helpers.canonical_feed('https://example.com/rss?utm_source=tg&fbclid=1'), feed
+        )
+        self.assertEqual(
+            helpers.canonical_feed('https://example.com/rss?a=1&utm_medium=x'), feed + '?a=1'
+        )
+        self.assertEqual(helpers.canonical_feed('http://example.com:8080/'), 'http://example.com:8080/')
+
+    def test_key(self):
+        key = '//example.com/feed'
+        for feed in ('https://example.com/feed/', 'HTTP://Example.com:80/feed',
+                     'http://example.com/feed/?utm_source=tg#top'):
+            self.assertEqual(helpers.feed_key(feed), key)
+        self.assertEqual(helpers.feed_key('https://example.com'), '//example.com/')
+        self.assertNotEqual(helpers.feed_key('https://example.com/feed?a=1'), key)
+
+
+@patch('kaban.fetcher.get_feed')
 @patch('kaban.helpers.SQLSession')
 class FeedCheckOut(MockDB):
-    def test_feed_exists(self, mock_session, mock_feedparser):
+    def test_feed_exists(self, mock_session, mock_get_feed):
         mock_session.return_value = self.SQLSession()
         with self.assertRaises(DataAlreadyExists):
             helpers.check_out_feed(
                 TEST_DB[0]['feed'], TEST_DB[0]['uid'], first_time=False
             )
-            mock_feedparser.parse.assert_not_called()
+            mock_get_feed.assert_not_called()
+
+        reset_mock(mock_session, mock_get_feed)
+
+    def test_other_spelling(self, mock_session, mock_get_feed):
+        mock_session.return_value = self.SQLSession()
+        mock_get_feed.return_value = deepcopy(MOCK_FEED)
+        feed = TEST_DB[0]['feed'].replace('https://', 'HTTP://') + '/?utm_source=tg'
+        for first_time in (True, False):
+            with self.assertRaises(DataAlreadyExists):
+                helpers.check_out_feed(feed, TEST_DB[0]['uid'], first_time=first_time)
 
-        reset_mock(mock_session, mock_feedparser)
+        reset_mock(mock_session, mock_get_feed)
 
     def test_feed_dont_exists(self, mock_session, foo):
         mock_session.return_value = self.SQLSession()
@@ -143,40 +274,60 @@ class FeedCheckOut(MockDB):
 
         reset_mock(mock_session, foo)
 
-    def test_feed_parser(self, mock_session, mock_feedparser):
+    def test_feed_parser(self, mock_session, mock_get_feed):
         mock_feed = deepcopy(MOCK_FEED)
-        mock_feedparser.parse.return_value = mock_feed
+        mock_get_feed.return_value = mock_feed
         mock_session.return_value = self.SQLSession()
 
         helpers.check_out_feed('dummy-feed', 0)
-        mock_feedparser.parse.assert_called_once()
+        mock_get_feed.assert_called_once()
+
+        reset_mock(mock_session, mock_get_feed)
+
+    def test_canonical_url(self, mock_session, mock_get_feed):
+        mock_session.return_value = self.SQLSession()
+        mock_feed = deepcopy(MOCK_FEED)
+        mock_get_feed.return_value = mock_feed
+
+        feed = helpers.check_out_feed('HTTP://Example.com/rss/?utm_source=x', 0)
+        self.assertEqual(feed, 'https://example.com/rss/')
+
+        def no_https(url):
+            if url.startswith('https'): raise ConnectionError
+            return mock_feed
+        mock_get_feed.side_effect = no_https
+        self.assertEqual(helpers.check_out_feed('http://example.com/rss', 0), 'http://example.com/rss')
+
+        mock_get_feed.side_effect = None
+        mock_feed.moved_to = 'https://example.org/feed'
+        self.assertEqual(helpers.check_out_feed('https://example.com/rss', 0), mock_feed.moved_to)
 
-        reset_mock(mock_session, mock_feedparser)
+        reset_mock(mock_session, mock_get_feed)
 
-    def test_feed_parser_errors(self, mock_session, mock_feedparser):
+    def test_feed_parser_errors(self, mock_session, mock_get_feed):
         mock_session.return_value = self.SQLSession()
 
-        mock_feedparser.parse.return_value = None
+        mock_get_feed.return_value = None
         with self.assertRaises(FeedFormatError):
             helpers.check_out_feed('dummy-feed', 0)
 
         mock_feed = deepcopy(MOCK_FEED)
         mock_feed.entries[0].published_parsed = None
         mock_feed.entries[0].title = None
-        mock_feedparser.parse.return_value = mock_feed
+        mock_get_feed.return_value = mock_feed
         with self.assertRaises(FeedFormatError):
             helpers.check_out_feed('dummy-feed', 0)
 
         mock_feed.entries = []
-        mock_feedparser.parse.return_value = mock_feed
+        mock_get_feed.return_value = mock_feed
         with self.assertRaises(FeedFormatError):
             helpers.check_out_feed('dummy-feed', 0)
 
-        mock_feedparser.parse.side_effect = Exception
+        mock_get_feed.side_effect = Exception
         with self.assertRaises(Exception):
             helpers.check_out_feed('dummy-feed', 0)
 
-        reset_mock(mock_session, mock_feedparser)
+        reset_mock(mock_session, mock_get_feed)
 
 
 @patch('kaban.helpers.info')
@@ -209,33 +360,33 @@ class AddNewFeed(MockDB):
 
 
 @patch('kaban.helpers.log')
-@patch('kaban.helpers.feedparser')
+@patch('kaban.helpers.get_feed')
 @patch('kaban.helpers.send_a_post')
 @patch('kaban.helpers.SQLSession')
 class NewFeedPreprocess(MockDB):
-    def test_normal_case(self, mock_session, mock_poster, mock_feedparser, foo):
+    def test_normal_case(self, mock_session, mock_poster, mock_get_feed, foo):
         mock_session.return_value = self.SQLSession()
         mock_post = deepcopy(MOCK_POST)
-        mock_feedparser.parse().entries = [mock_post]
-        post_title = hashlib.md5(
-            mock_post.title.strip().encode()
-        ).hexdigest()
+        mock_get_feed().entries = [mock_post]
         post_date = datetime.fromtimestamp(
             time.mktime(mock_post.published_parsed)
         )
 
         helpers.new_feed_preprocess('bot', TEST_DB[0]['uid'], TEST_DB[0]['feed'])
-        mock_poster.assert_called_with('bot', mock_post, ANY, TEST_DB[0]['feed'])
+        mock_poster.assert_called_with('bot', helpers.compact_post(mock_post), ANY, TEST_DB[0]['feed'])
 
         with self.SQLSession() as session:
             db_entry = session.query(FeedsDB).filter(
                 FeedsDB.uid == TEST_DB[0]['uid'],
                 FeedsDB.feed == TEST_DB[0]['feed'],
             ).first()
-            self.assertEqual(db_entry.last_posts, post_title)
             self.assertEqual(db_entry.last_check, post_date)
+            seen = session.query(SeenPostsDB.digest).filter(
+                SeenPostsDB.entry_id == db_entry.id
+            ).all()
+            self.assertEqual(seen, [(helpers.post_digest(mock_post),)])
 
-        reset_mock(mock_session, mock_poster, mock_feedparser, foo)
+        reset_mock(mock_session, mock_poster, mock_get_feed, foo)
 
     def test_except_case(self, mock_session, *args):
         mock_session.return_value = self.SQLSession()
@@ -333,9 +484,12 @@ class FeedSwitcher(MockDB):
 class DeleteUser(MockDB):
     def test_normal_case(self):
         with patch('kaban.helpers.SQLSession') as mock_session, \
+                patch('kaban.helpers.OUTBOX') as mock_outbox, \
                 patch('kaban.helpers.delete_a_feed') as mock_delete_a_feed:
             mock_session.return_value = self.SQLSession()
             helpers.delete_user(TEST_DB[0]['uid'])
+            # the sender drops the posts it has taken
+            mock_outbox.put.assert_called_once_with((None, TEST_DB[0]['uid'], None))
 
             expected = [TEST_DB[0]['uid'], TEST_DB[0]['uid']]
             result = [
@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta
+import pathlib
+import sys
+import time
+import unittest
+
+BASE_DIR = pathlib.Path(__file__).resolve().parent.parent.parent
+if str(BASE_DIR) not in sys.path:
+    sys.path.append(str(BASE_DIR))
+
+from kaban.scheduler import FeedScheduler, CircuitBreaker
+
+
+FEEDS = ['https://a.com/rss', 'https://b.com/rss', 'https://c.com/rss']
+
+
+class Scheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = FeedScheduler(
+            min_interval=60, max_interval=3600, jitter=0, default_interval=600
+        )
+
+    def test_new_feeds_are_due(self):
+        self.scheduler.sync(FEEDS)
+        self.assertEqual(self.scheduler.wait_time(), 0)
+        self.assertEqual(sorted(self.scheduler.pop_due()), FEEDS)
+        self.assertEqual(self.scheduler.pop_due(), [])
+
+        self.scheduler.sync(FEEDS)
+        self.assertEqual(self.scheduler.pop_due(), [])
+
+    def test_reschedule(self):
+        self.scheduler.sync(FEEDS)
+        self.scheduler.pop_due()
+        for url in FEEDS:
+            self.scheduler.reschedule(url)
+
+        self.assertEqual(self.scheduler.pop_due(), [])
+        self.assertAlmostEqual(self.scheduler.wait_time(), 900, delta=1)
+        self.assertEqual(
+            sorted(self.scheduler.pop_due(time.time() + 901)), FEEDS
+        )
+
+    def test_adaptive_interval(self):
+        now = datetime.now()
+        busy = [now - timedelta(minutes=5 * i) for i in range(10)]
+        rare = [now - timedelta(days=30 * i) for i in range(10)]
+        ok = [now - timedelta(minutes=20 * i) for i in range(10)]
+
+        self.scheduler.sync(FEEDS)
+        self.scheduler.pop_due()
+        for url, dates in zip(FEEDS, [busy, rare, ok]):
+            self.scheduler.reschedule(url, dates)
+
+        self.assertEqual(self.scheduler.intervals[FEEDS[0]], 300)
+        self.assertEqual(self.scheduler.intervals[FEEDS[1]], 3600)
+        self.assertAlmostEqual(self.scheduler.intervals[FEEDS[2]], 1200, delta=1)
+        self.assertEqual(self.scheduler.pop_due(time.time() + 301), [FEEDS[0]])
+
+    def test_bounds_and_jitter(self):
+        scheduler = FeedScheduler(
+            min_interval=60, max_interval=100, jitter=0.5, default_interval=80
+        )
+        scheduler.sync(FEEDS)
+        scheduler.pop_due()
+        for _ in range(5):
+            for url in FEEDS:
+                scheduler.due[url] = None
+                scheduler.reschedule(url)
+
+        for url in FEEDS:
+            self.assertEqual(scheduler.intervals[url], 100)
+            self.assertLessEqual(scheduler.due[url], time.time() + 150)
+            self.assertGreaterEqual(scheduler.due[url], time.time() + 49)
+
+    def test_deleted_feed(self):
+        self.scheduler.sync(FEEDS)
+        self.scheduler.sync(FEEDS[1:])
+        self.assertEqual(sorted(self.scheduler.pop_due()), FEEDS[1:])
+
+        self.scheduler.reschedule(FEEDS[0])
+        self.assertEqual(len(self.scheduler), 2)
+
+    def test_postpone(self):
+        self.scheduler.sync(FEEDS)
+        self.scheduler.pop_due()
+        self.scheduler.postpone(FEEDS[0], 100)
+
+        self.assertAlmostEqual(self.scheduler.wait_time(), 100, delta=1)
+        self.assertEqual(self.scheduler.intervals[FEEDS[0]], 600)
+
+
+class Breaker(unittest.TestCase):
+    def test_breaker(self):
+        breaker = CircuitBreaker(threshold=3, cooldown=100)
+        for _ in range(2):
+            breaker.failure(FEEDS[0])
+        self.assertEqual(breaker.open_for(FEEDS[0]), 0)
+
+        breaker.failure('https://A.com/atom')
+        self.assertAlmostEqual(breaker.open_for(FEEDS[0]), 100, delta=1)
+        self.assertEqual(breaker.open_for(FEEDS[1]), 0)
+
+        breaker.success(FEEDS[0])
+        self.assertEqual(breaker.open_for(FEEDS[0]), 0)
+
+    def test_half_open(self):
+        breaker = CircuitBreaker(threshold=3, cooldown=100)
+        for _ in range(3):
+            breaker.failure(FEEDS[0])
+        later = time.time() + 101
+        self.assertEqual(breaker.open_for(FEEDS[0], later), 0)
+
+        breaker.failure(FEEDS[0])
+        self.assertGreater(breaker.open_for(FEEDS[0]), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
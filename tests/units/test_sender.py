@@ -0,0 +1,253 @@
+from datetime import datetime, timedelta
+import pathlib
+import queue
+import sys
+import threading
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+BASE_DIR = pathlib.Path(__file__).resolve().parent.parent.parent
+if str(BASE_DIR) not in sys.path:
+    sys.path.append(str(BASE_DIR))
+
+from kaban.sender import TokenBucket, SenderThread
+from kaban.database import OutboxDB
+
+from tests.fixtures.fixtures import MockDB, reset_mock
+
+
+class Bucket(unittest.TestCase):
+    def test_rate(self):
+        bucket = TokenBucket(rate=10, capacity=2)
+        now = bucket.stamp
+        self.assertEqual(bucket.wait_time(now), 0)
+        bucket.take(now)
+        bucket.take(now)
+        self.assertAlmostEqual(bucket.wait_time(now), 0.1)
+        self.assertAlmostEqual(bucket.wait_time(now + 0.05), 0.05)
+        self.assertAlmostEqual(bucket.wait_time(now + 0.1), 0)
+        self.assertFalse(bucket.is_full(now + 0.1))
+        self.assertTrue(bucket.is_full(now + 1))
+
+
+class Sender(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.sender = SenderThread()
+        self.sender.outbox = queue.Queue()
+        self.sender.global_bucket = TokenBucket(rate=100)
+        self.sender.chat_rate = 20
+        self.sender.more_rows = False
+        self.sender.deliver = Mock(side_effect=self.deliver)
+        self.sender.exit = Mock()
+
+    def deliver(self, bot, uid, text, attempt):
+        self.sent.append((time.monotonic(), uid, text))
+        return True, None
+
+    def test_limits(self):
+        for i in range(5):
+            self.sender.outbox.put(('bot', 1, f'one-{i}'))
+        for uid in range(2, 12):
+            self.sender.outbox.put(('bot', uid, f'other-{uid}'))
+        self.sender.start()
+        self.sender.stop()
+
+        self.assertEqual(len(self.sent), 15)
+        self.sender.exit.assert_not_called()
+        # the order within a chat is kept
+        self.assertEqual([text for _, uid, text in self.sent if uid == 1],
+                         [f'one-{i}' for i in range(5)])
+
+        # one message to a chat in 1/20 s, a message in 1/100 s in all
+        times = [t for t, uid, _ in self.sent if uid == 1]
+        for a, b in zip(times, times[1:]):
+            self.assertGreaterEqual(b - a, 0.05 - 0.005)
+        times = [t for t, _, _ in self.sent]
+        for a, b in zip(times, times[1:]):
+            self.assertGreaterEqual(b - a, 0.01 - 0.005)
+
+        # the other chats don't wait for the first one
+        last_other = max(i for i, (_, uid, _) in enumerate(self.sent) if uid != 1)
+        self.assertLess(last_other, 14)
+
+    def test_retry(self):
+        attempts = []
+
+        def deliver(bot, uid, text, attempt):
+            attempts.append((time.monotonic(), uid, text, attempt))
+            if text == 'first' and attempt < 2: return False, 0.1
+            return True, None
+
+        self.sender.deliver = Mock(side_effect=deliver)
+        self.sender.outbox.put(('bot', 1, 'first'))
+        self.sender.outbox.put(('bot', 1, 'second'))
+        self.sender.outbox.put(('bot', 2, 'other'))
+        self.sender.start()
+        time.sleep(0.5)
+        self.sender.stop()
+
+        self.assertEqual(
+            [(uid, text, attempt) for _, uid, text, attempt in attempts],
+            [(1, 'first', 0), (2, 'other', 0), (1, 'first', 1), (1, 'first', 2), (1, 'second', 0)]
+        )
+        # the other chat doesn't wait for the retries
+        self.assertLess(attempts[1][0] - attempts[0][0], 0.05)
+        self.assertGreaterEqual(attempts[2][0] - attempts[0][0], 0.1)
+
+    def test_stop_sends_the_rest(self):
+        self.sender.start()
+        time.sleep(0.05)
+        for i in range(3):
+            self.sender.outbox.put(('bot', 1, f'bye-{i}'))
+        self.sender.stop()
+        self.assertEqual([text for _, _, text in self.sent], ['bye-0', 'bye-1', 'bye-2'])
+        self.assertFalse(self.sender.is_alive())
+
+
+@patch('kaban.sender.log')
+@patch('kaban.sender.SQLSession')
+class Outbox(MockDB):
+    def setUp(self):
+        super().setUp()
+        with self.SQLSession() as session:
+            session.query(OutboxDB).delete()
+            session.commit()
+        self.sent = []
+        self.sender = SenderThread('bot')
+        self.sender.outbox = queue.Queue()
+        self.sender.global_bucket = TokenBucket(rate=100)
+        self.sender.chat_rate = 20
+        self.sender.batch_size = 2
+        self.sender.deliver = Mock(side_effect=self.deliver)
+        self.sender.exit = Mock()
+
+    def deliver(self, bot, uid, text, attempt):
+        self.sent.append((bot, uid, text))
+        # the third chat has blocked the bot
+        return uid != 3, None
+
+    def add_rows(self, uids, start=0):
+        with self.SQLSession() as session:
+            session.add_all(OutboxDB(uid=uid, text=f'post-{i}') for i, uid in enumerate(uids, start))
+            session.commit()
+
+    def test_batches(self, mock_session, mock_log):
+        mock_session.side_effect = self.SQLSession
+        self.add_rows([1, 1, 2, 3, 1])
+        self.sender.start()
+        time.sleep(0.3)
+        # the updater adds some more
+        self.add_rows([2], start=5)
+        self.sender.outbox.put(None)
+        time.sleep(0.3)
+        self.sender.stop()
+
+        self.assertEqual(sorted(self.sent, key=lambda sent: sent[2]), [
+            ('bot', 1, 'post-0'), ('bot', 1, 'post-1'), ('bot', 2, 'post-2'),
+            ('bot', 3, 'post-3'), ('bot', 1, 'post-4'), ('bot', 2, 'post-5')
+        ])
+        self.assertEqual([text for _, uid, text in self.sent if uid == 1],
+                         ['post-0', 'post-1', 'post-4'])
+        self.sender.exit.assert_not_called()
+        with self.SQLSession() as session:
+            rows = session.query(OutboxDB.uid, OutboxDB.text, OutboxDB.dead_at).all()
+        self.assertEqual([(uid, text) for uid, text, _ in rows], [(3, 'post-3')])
+        self.assertIsNotNone(rows[0][2])
+        mock_log.warning.assert_called_once()
+
+        reset_mock(mock_session, mock_log)
+
+    def test_drained_table(self, mock_session, mock_log):
+        mock_session.side_effect = self.SQLSession
+        self.add_rows([1, 2])
+        self.sender.start()
+        time.sleep(0.3)
+        with self.SQLSession() as session:
+            self.assertEqual(session.query(OutboxDB).count(), 0)
+
+        # the ids of the delivered posts aren't given out again
+        self.add_rows([1, 2], start=2)
+        self.sender.outbox.put(None)
+        time.sleep(0.3)
+        self.sender.stop()
+
+        self.assertEqual(sorted(text for _, _, text in self.sent),
+                         ['post-0', 'post-1', 'post-2', 'post-3'])
+        with self.SQLSession() as session:
+            self.assertEqual(session.query(OutboxDB).count(), 0)
+
+        reset_mock(mock_session, mock_log)
+
+    def test_stop_keeps_rows(self, mock_session, mock_log):
+        mock_session.side_effect = self.SQLSession
+        self.add_rows([1, 1, 1])
+        self.sender.chat_rate = 1
+        self.sender.start()
+        time.sleep(0.2)
+        self.sender.stop()
+
+        self.assertEqual(self.sent, [('bot', 1, 'post-0')])
+        with self.SQLSession() as session:
+            texts = [text for text, in session.query(OutboxDB.text).order_by(OutboxDB.id)]
+        self.assertEqual(texts, ['post-1', 'post-2'])
+
+        # the next start picks them up
+        self.sender = SenderThread('bot')
+        self.sender.deliver = Mock(side_effect=self.deliver)
+        self.sender.chat_rate = 20
+        self.sender.outbox = queue.Queue()
+        self.sender.start()
+        time.sleep(0.3)
+        self.sender.stop()
+        self.assertEqual([text for _, _, text in self.sent], ['post-0', 'post-1', 'post-2'])
+        with self.SQLSession() as session:
+            self.assertEqual(session.query(OutboxDB).count(), 0)
+
+        reset_mock(mock_session, mock_log)
+
+    def test_deleted_user(self, mock_session, mock_log):
+        mock_session.side_effect = self.SQLSession
+        self.add_rows([1, 1, 1])
+        self.sender.chat_rate = 5
+        self.sender.start()
+        time.sleep(0.1)
+
+        # delete_user takes the rows away and tells the sender
+        with self.SQLSession() as session:
+            session.query(OutboxDB).filter(OutboxDB.uid == 1).delete()
+            session.commit()
+        self.sender.outbox.put((None, 1, None))
+        self.sender.outbox.put(('bot', 1, 'hello'))
+        time.sleep(0.5)
+        self.sender.stop()
+
+        self.assertEqual(self.sent, [('bot', 1, 'post-0'), ('bot', 1, 'hello')])
+        self.assertEqual(self.sender.rows_taken, 0)
+        mock_log.warning.assert_not_called()
+
+        reset_mock(mock_session, mock_log)
+
+    def test_dead_retention(self, mock_session, mock_log):
+        mock_session.side_effect = self.SQLSession
+        now = datetime.now()
+        with self.SQLSession() as session:
+            session.add(OutboxDB(uid=3, text='old', dead_at=now - timedelta(days=8)))
+            session.add(OutboxDB(uid=3, text='recent', dead_at=now - timedelta(days=1)))
+            session.commit()
+        self.add_rows([3])
+        self.sender.dead_ttl = 7 * 24 * 3600
+        self.sender.start()
+        time.sleep(0.2)
+        self.sender.stop()
+
+        with self.SQLSession() as session:
+            texts = [text for text, in session.query(OutboxDB.text).order_by(OutboxDB.id)]
+        self.assertEqual(texts, ['recent', 'post-0'])
+
+        reset_mock(mock_session, mock_log)
+
+
+if __name__ == '__main__':
+    unittest.main()
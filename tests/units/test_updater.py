@@ -1,12 +1,15 @@
 from copy import deepcopy
 from datetime import datetime
+import gc
 import hashlib
 import pathlib
 import requests
+import sqlalchemy
 import sys
 import threading
 import time
 import unittest
+import weakref
 from unittest.mock import Mock, patch, mock_open, ANY
 
 BASE_DIR = pathlib.Path(__file__).resolve().parent.parent.parent
@@ -14,31 +17,46 @@ if str(BASE_DIR) not in sys.path:
     sys.path.append(str(BASE_DIR))
 
 from kaban.updater import UpdaterThread
-from kaban.database import FeedsDB
-from kaban.settings import EXIT_EVENT
+from kaban.scheduler import FeedScheduler
+from kaban.database import (
+    FeedsDB, FeedStateDB, SeenPostsDB, PendingPostsDB, OutboxDB, SUBSCRIPTION
+)
+from kaban.helpers import post_digest, compact_post, Post
+from kaban.fetcher import FEED_CACHE, feed_key
+from kaban.settings import EXIT_EVENT, UPDATE_FEEDS_EVENT, FeedNotModified
 
 from tests.fixtures.fixtures import reset_mock, MockDB, TEST_DB, MOCK_FEED, MOCK_POST
 
 
+def load(upd: UpdaterThread, new_posts: dict = None) -> dict:
+    """ Collects all the new posts streamed by _load(). """
+    new_posts = {} if new_posts is None else new_posts
+    for posts in upd._load():
+        for uid, feeds in posts.items():
+            new_posts.setdefault(uid, {}).update(feeds)
+    return new_posts
+
+
 @patch('kaban.updater.info')
 @patch('kaban.updater.log')
 @patch('kaban.updater.exit_signal')
 @patch('kaban.updater.send_message')
-@patch('kaban.updater.send_a_post')
-@patch('kaban.updater.feedparser')
+@patch('kaban.updater.post_text', return_value='post')
+@patch('kaban.fetcher.fetch_feed')
 @patch('kaban.updater.SQLSession')
 class SetUpdater(MockDB):
-    def test_normal_case(self, mock_session, mock_feedparser, *args):
+    def test_normal_case(self, mock_session, mock_fetch, *args):
         mock_session.return_value = self.SQLSession()
-        mock_feedparser.parse.return_value = deepcopy(MOCK_FEED)
+        mock_fetch.return_value = deepcopy(MOCK_FEED)
 
         upd = UpdaterThread(Mock())
         upd.notifications = Mock()
         upd.notifications.exists.return_value = False
-        upd._updater = Mock()
+        upd._updater = Mock(return_value='post')
 
         upd.start()
         EXIT_EVENT.set()
+        UPDATE_FEEDS_EVENT.set()
         time.sleep(0.1)
         upd.stop()
 
@@ -47,7 +65,7 @@ class SetUpdater(MockDB):
         for i, call in enumerate(upd._updater.call_args_list):
             self.assertEqual(TEST_DB[i]['feed'], call.args[1])
 
-        reset_mock(mock_session, mock_feedparser, *args)
+        reset_mock(mock_session, mock_fetch, *args)
 
     def test_exception(self, *args):
         upd = UpdaterThread(Mock())
@@ -63,13 +81,14 @@ class SetUpdater(MockDB):
     def tearDown(self):
         if EXIT_EVENT.is_set():
             EXIT_EVENT.clear()
+        UPDATE_FEEDS_EVENT.clear()
 
 
 @patch('kaban.updater.info')
 @patch('kaban.updater.log')
 @patch('kaban.updater.exit_signal')
 @patch('kaban.updater.send_message')
-@patch('kaban.updater.send_a_post')
+@patch('kaban.updater.post_text', return_value='post')
 @patch('kaban.updater.SQLSession')
 class WithInternet(MockDB):
     try: requests.get('https://core.telegram.org/')
@@ -87,6 +106,7 @@ class WithInternet(MockDB):
         upd.start()
         if test_event.wait(10):
             EXIT_EVENT.set()
+            UPDATE_FEEDS_EVENT.set()
             time.sleep(0.1)
         upd.stop()
         mock_poster.assert_called()
@@ -96,6 +116,7 @@ class WithInternet(MockDB):
     def tearDown(self):
         if EXIT_EVENT.is_set():
             EXIT_EVENT.clear()
+        UPDATE_FEEDS_EVENT.clear()
 
 
 @patch('kaban.updater.info')
@@ -125,10 +146,10 @@ class Note(MockDB):
 
 
 @patch('kaban.updater.log')
-@patch('kaban.updater.feedparser')
+@patch('kaban.fetcher.fetch_feed')
 @patch('kaban.updater.SQLSession')
 class Loader(MockDB):
-    def test_normal_case(self, mock_session, mock_feedparser, foo):
+    def test_normal_case(self, mock_session, mock_fetch, foo):
         uids = []
         for entry in TEST_DB:
             uid = entry['uid']
@@ -137,35 +158,130 @@ class Loader(MockDB):
 
         mock_feed = deepcopy(MOCK_FEED)
         mock_post = mock_feed.entries[0]
-        title_hash = hashlib.md5(
-            mock_post.title.strip().encode()
-        ).hexdigest()
+        digest = post_digest(mock_post)
 
-        mock_feedparser.parse.return_value = mock_feed
+        mock_fetch.return_value = mock_feed
         mock_session.return_value = self.SQLSession()
 
         new_posts = {}
         upd = UpdaterThread(Mock())
-        upd._load(new_posts)
+        load(upd, new_posts)
 
         self.assertEqual(len(new_posts), len(uids))
         for uid in new_posts:
             for feed in new_posts[uid]:
                 post = new_posts[uid][feed][0]
-                self.assertEqual(post['title'], title_hash)
-                self.assertEqual(post['post'], mock_post)
+                self.assertEqual(post['digest'], digest)
+                self.assertEqual(post['post'], compact_post(mock_post))
+
+        reset_mock(mock_session, mock_fetch, foo)
+
+    def test_single_query(self, mock_session, mock_fetch, foo):
+        mock_fetch.return_value = deepcopy(MOCK_FEED)
+        mock_session.return_value = self.SQLSession()
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if 'FROM feeds' in statement: statements.append(statement)
+        sqlalchemy.event.listen(self.db, 'before_cursor_execute', count)
+        try:
+            new_posts = {}
+            load(UpdaterThread(Mock()), new_posts)
+        finally:
+            sqlalchemy.event.remove(self.db, 'before_cursor_execute', count)
+
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('feeds.id = ', statements[0])
+        self.assertEqual(sum(len(feeds) for feeds in new_posts.values()), len(TEST_DB))
+
+        reset_mock(mock_session, mock_fetch, foo)
+
+    def test_not_due(self, mock_session, mock_fetch, foo):
+        mock_fetch.return_value = deepcopy(MOCK_FEED)
+        mock_session.return_value = self.SQLSession()
+
+        upd = UpdaterThread(Mock())
+        load(upd)
+        self.assertEqual(mock_fetch.call_count, len(TEST_DB))
+
+        mock_fetch.reset_mock()
+        new_posts = {}
+        load(upd, new_posts)
+        mock_fetch.assert_not_called()
+        self.assertEqual(new_posts, {})
+        self.assertGreater(upd.scheduler.wait_time(), 0)
 
-        reset_mock(mock_session, mock_feedparser, foo)
+        reset_mock(mock_session, mock_fetch, foo)
 
-    def test_exception_case(self, mock_session, mock_feedparser, mock_log):
+    def test_parsed_feeds_are_freed(self, mock_session, mock_fetch, foo):
+        mock_session.return_value = self.SQLSession()
+        parsed_feeds = {}
+
+        def fetch(url, *args):
+            parsed_feed = deepcopy(MOCK_FEED)
+            # unseen by the earlier tests, so there is something to mail
+            parsed_feed.entries[0].id = f'{url}#{id(parsed_feed)}'
+            parsed_feeds[feed_key(url)] = weakref.ref(parsed_feed)
+            return parsed_feed
+        mock_fetch.side_effect = fetch
+
+        mailed = set()
+
+        def assert_freed(*args):
+            gc.collect()
+            self.assertTrue(all(parsed_feeds[key]() is None for key in mailed))
+            return 'post'
+
+        upd = UpdaterThread(Mock())
+        upd.post_text = Mock(side_effect=assert_freed)
+        posts_count = 0
+        for new_posts in upd._load():
+            mailed.update(feed_key(feed) for feeds in new_posts.values() for feed in feeds)
+            posts_count += sum(len(posts) for feeds in new_posts.values() for posts in feeds.values())
+            # only the compact posts live on during the mailing
+            upd._forward(new_posts)
+        self.assertEqual(posts_count, len(TEST_DB))
+        self.assertEqual(upd.post_text.call_count, posts_count)
+        self.assertEqual(len(FEED_CACHE), 0)
+        self.assertEqual(len(parsed_feeds), len(TEST_DB))
+        self.assertEqual(mailed, set(parsed_feeds))
+
+        reset_mock(mock_session, mock_fetch, foo)
+
+    def test_compact_posts(self, *args):
+        entries = []
+        for day in (15, 14, 13, 12):
+            entry = deepcopy(MOCK_POST)
+            entry.published_parsed = (2022, 1, day, 12, 0, 0, 0, 0, -1)
+            entries.append(entry)
+
+        posts = UpdaterThread._compact_posts(entries, datetime(2022, 1, 13, 18))
+        self.assertEqual(len(posts), 3)
+        self.assertTrue(all(isinstance(post, Post) for post in posts))
+        self.assertEqual(len(UpdaterThread._compact_posts(entries, None)), 4)
+
+    def test_worker_processes(self, mock_session, mock_fetch, foo):
+        mock_session.return_value = self.SQLSession()
+        upd = UpdaterThread(Mock())
+        upd.workers = Mock()
+        upd.workers.fetch.return_value = deepcopy(MOCK_FEED)
+
+        new_posts = load(upd)
+        mock_fetch.assert_not_called()
+        self.assertEqual(upd.workers.fetch.call_count, len(TEST_DB))
+        self.assertEqual(sum(len(feeds) for feeds in new_posts.values()), len(TEST_DB))
+
+        reset_mock(mock_session, mock_fetch, foo)
+
+    def test_exception_case(self, mock_session, mock_fetch, mock_log):
         mock_session.return_value = self.SQLSession()
         mock_feed = deepcopy(MOCK_FEED)
         mock_feed.entries = None
-        mock_feedparser.parse.return_value = mock_feed
+        mock_fetch.return_value = mock_feed
 
         upd = UpdaterThread(Mock())
         upd._populate_list_of_posts = Mock()
-        upd._load({})
+        load(upd)
 
         upd._populate_list_of_posts.assert_not_called()
         mock_log.warning.assert_called()
@@ -173,41 +289,451 @@ class Loader(MockDB):
         result = mock_log.warning.call_args_list[0].args[0]
         self.assertIn('failed to load feed', result)
 
-        mock_feedparser.parse.side_effect = Exception
-        upd._load({})
+        mock_fetch.side_effect = Exception
+        upd = UpdaterThread(Mock())
+        upd._populate_list_of_posts = Mock()
+        load(upd)
         upd._populate_list_of_posts.assert_not_called()
         result = mock_log.warning.call_args_list[-1].args[0]
-        self.assertIn('feedparser fail', result)
+        self.assertIn('failed to fetch feed', result)
+
+        reset_mock(mock_session, mock_fetch, mock_log)
+
+
+@patch('kaban.updater.log')
+@patch('kaban.fetcher.fetch_feed')
+@patch('kaban.updater.SQLSession')
+class SharedFeed(MockDB):
+    def test_one_fetch_per_feed(self, mock_session, mock_fetch, foo):
+        with self.SQLSession() as session:
+            session.add(FeedsDB(
+                uid=4242, feed='HTTPS://Feeds.FeedBurner.com/PythonInsider',
+                last_check=TEST_DB[0]['last_check']
+            ))
+            session.commit()
+
+        mock_feed = deepcopy(MOCK_FEED)
+        mock_fetch.return_value = mock_feed
+        mock_session.return_value = self.SQLSession()
+
+        new_posts = {}
+        upd = UpdaterThread(Mock())
+        load(upd, new_posts)
+
+        self.assertEqual(mock_fetch.call_count, len(TEST_DB))
+        self.assertEqual(len(new_posts[4242]), 1)
+        for posts in new_posts[4242].values():
+            self.assertEqual(posts[0]['post'], compact_post(mock_feed.entries[0]))
+        self.assertEqual(len(new_posts[TEST_DB[0]['uid']][TEST_DB[0]['feed']]), 1)
+
+        reset_mock(mock_session, mock_fetch, foo)
+
+    def test_stored_url_is_fetched(self, mock_session, mock_fetch, foo):
+        feed = 'https://example.com/feed/'
+        with self.SQLSession() as session:
+            for uid, spelling in ((4243, feed), (4244, 'http://example.com/feed')):
+                session.add(FeedsDB(uid=uid, feed=spelling, last_check=TEST_DB[0]['last_check']))
+            session.commit()
+
+        mock_feed = deepcopy(MOCK_FEED)
+        mock_feed.moved_to = feed
+        mock_fetch.return_value = mock_feed
+        mock_session.return_value = self.SQLSession()
+
+        upd = UpdaterThread(Mock())
+        new_posts = load(upd)
+        fetched = [c.args[0] for c in mock_fetch.call_args_list]
+        self.assertEqual(fetched.count(feed), 1)
+        self.assertNotIn('http://example.com/feed', fetched)
+        self.assertEqual(len(new_posts[4244]['http://example.com/feed']), 1)
+        # only the spelling that was redirected is rewritten
+        self.assertEqual(len(upd.moved[feed_key(feed)][1]), 1)
+
+        reset_mock(mock_session, mock_fetch, foo)
+
+
+@patch('kaban.updater.log')
+@patch('kaban.fetcher.fetch_feed')
+@patch('kaban.updater.SQLSession')
+class Validators(MockDB):
+    def test_conditional_get(self, mock_session, mock_fetch, mock_log):
+        mock_feed = deepcopy(MOCK_FEED)
+        mock_feed.etag = '"v1"'
+        mock_feed.modified = 'Thu, 13 Jan 2022 12:00:00 GMT'
+        mock_feed.body_hash = b'0123456789abcdef'
+        changed_feed = TEST_DB[0]['feed']
+
+        def fetch(url, etag=None, modified=None, body_hash=None, since=None):
+            if url == changed_feed: return mock_feed
+            else: raise FeedNotModified
+        mock_fetch.side_effect = fetch
+        mock_session.return_value = self.SQLSession()
+
+        new_posts = {}
+        upd = UpdaterThread(Mock())
+        load(upd, new_posts)
+        upd._save_feed_states()
+
+        mock_log.warning.assert_not_called()
+        self.assertEqual(len(new_posts[TEST_DB[0]['uid']][changed_feed]), 1)
+        for uid in new_posts:
+            for feed, posts in new_posts[uid].items():
+                if feed != changed_feed: self.assertEqual(posts, [])
+
+        with self.SQLSession() as session:
+            state = session.query(FeedStateDB).filter(FeedStateDB.url == feed_key(changed_feed)).first()
+            self.assertEqual(state.etag, mock_feed.etag)
+            self.assertEqual(state.modified, mock_feed.modified)
+            self.assertEqual(state.body_hash, mock_feed.body_hash)
+
+        # the next poll is a conditional GET, not a cache hit
+        mock_fetch.reset_mock()
+        load(UpdaterThread(Mock()))
+        mock_fetch.assert_any_call(
+            changed_feed, mock_feed.etag, mock_feed.modified, mock_feed.body_hash, ANY
+        )
+
+        reset_mock(mock_session, mock_fetch, mock_log)
+
+
+@patch('kaban.updater.log')
+@patch('kaban.updater.send_message')
+@patch('kaban.helpers.SQLSession')
+@patch('kaban.fetcher.fetch_feed')
+@patch('kaban.updater.SQLSession')
+class Health(MockDB):
+    def test_backoff(self, mock_session, mock_fetch, mock_helpers_session, *args):
+        mock_session.return_value = self.SQLSession()
+        dead_feed = TEST_DB[0]['feed']
+
+        def fetch(url, *validators):
+            if url == dead_feed: raise ConnectionError(url)
+            return deepcopy(MOCK_FEED)
+        mock_fetch.side_effect = fetch
+
+        upd = UpdaterThread(Mock())
+        load(upd)
+        upd._save_feed_states()
+        self.assertGreaterEqual(upd.scheduler.due[feed_key(dead_feed)], time.time() + upd.retry_base - 1)
+
+        with self.SQLSession() as session:
+            state = session.query(FeedStateDB).filter(FeedStateDB.url == feed_key(dead_feed)).first()
+            self.assertEqual(state.failures, 1)
+            self.assertEqual(state.last_error, 'ConnectionError')
+            self.assertGreater(state.retry_at, datetime.now())
+
+        # a restart doesn't reset the retry time
+        mock_fetch.reset_mock()
+        load(UpdaterThread(Mock()))
+        self.assertNotIn(dead_feed, [c.args[0] for c in mock_fetch.call_args_list])
+
+        # a success resets the failures
+        upd = UpdaterThread(Mock())
+        upd._hold_back_failing = Mock()
+        mock_fetch.side_effect = None
+        mock_fetch.return_value = deepcopy(MOCK_FEED)
+        load(upd)
+        upd._save_feed_states()
+        with self.SQLSession() as session:
+            state = session.query(FeedStateDB).filter(FeedStateDB.url == feed_key(dead_feed)).first()
+            self.assertEqual(state.failures, 0)
+            self.assertIsNone(state.retry_at)
+
+        reset_mock(mock_session, mock_fetch, mock_helpers_session, *args)
+
+    def test_prune(self, mock_session, mock_fetch, mock_helpers_session, mock_sender, mock_log):
+        mock_session.return_value = self.SQLSession()
+        mock_helpers_session.return_value = self.SQLSession()
+        dead_feed = TEST_DB[2]['feed']
+
+        def fetch(url, *validators):
+            if url == dead_feed: raise ConnectionError(url)
+            return deepcopy(MOCK_FEED)
+        mock_fetch.side_effect = fetch
+
+        upd = UpdaterThread(Mock())
+        upd.max_failures = 1
+        load(upd)
+        upd._save_feed_states()
 
-        reset_mock(mock_session, mock_feedparser, mock_log)
+        mock_sender.assert_called_once_with(upd.bot, TEST_DB[2]['uid'], ANY)
+        self.assertIn(dead_feed, mock_sender.call_args.args[2])
+        with self.SQLSession() as session:
+            self.assertEqual(session.query(FeedsDB).filter(FeedsDB.feed == dead_feed).count(), 0)
+            self.assertEqual(session.query(FeedStateDB).filter(FeedStateDB.url == feed_key(dead_feed)).count(), 0)
+            self.assertEqual(session.query(FeedsDB).count(), len(TEST_DB) - 1)
+
+        reset_mock(mock_session, mock_fetch, mock_helpers_session, mock_sender, mock_log)
+
+    def test_circuit_breaker(self, mock_session, mock_fetch, *args):
+        mock_session.return_value = self.SQLSession()
+        mock_fetch.side_effect = ConnectionError
+
+        upd = UpdaterThread(Mock())
+        upd.breaker.threshold = 2
+        load(upd)
+        self.assertGreater(upd.breaker.open_for(TEST_DB[1]['feed']), 0)
+
+        # the feeds of the host are held back without a download
+        mock_fetch.reset_mock()
+        upd._load_feed_states = Mock(return_value={})
+        upd.scheduler = FeedScheduler()
+        load(upd)
+        fetched = [c.args[0] for c in mock_fetch.call_args_list]
+        self.assertNotIn(TEST_DB[1]['feed'], fetched)
+        self.assertIn(TEST_DB[0]['feed'], fetched)
+
+        reset_mock(mock_session, mock_fetch, *args)
+
+
+@patch('kaban.updater.info')
+@patch('kaban.fetcher.fetch_feed')
+@patch('kaban.updater.SQLSession')
+class Redirects(MockDB):
+    def test_moved_feeds(self, mock_session, mock_fetch, foo):
+        mock_session.return_value = self.SQLSession()
+        new_url = 'https://www.wired.com/feed/rss'
+        with self.SQLSession() as session:
+            session.add(FeedsDB(uid=TEST_DB[2]['uid'], feed=new_url))
+            session.commit()
 
+        def fetch(url, *args):
+            mock_feed = deepcopy(MOCK_FEED)
+            if url in (TEST_DB[1]['feed'], TEST_DB[2]['feed']):
+                mock_feed.moved_to = new_url
+            return mock_feed
+        mock_fetch.side_effect = fetch
 
-@patch('kaban.updater.send_a_post')
+        upd = UpdaterThread(Mock())
+        load(upd)
+        upd._save_feed_states()
+
+        with self.SQLSession() as session:
+            moved = session.query(FeedsDB.uid).filter(FeedsDB.feed == new_url).all()
+            self.assertEqual(sorted(moved), sorted([(TEST_DB[1]['uid'],), (TEST_DB[2]['uid'],)]))
+            for data in TEST_DB[1:3]:
+                old = session.query(FeedsDB).filter(FeedsDB.feed == data['feed']).count()
+                self.assertEqual(old, 0)
+            states = session.query(FeedStateDB.url).filter(FeedStateDB.url == feed_key(new_url)).all()
+            self.assertEqual(len(states), 1)
+
+        # both of them are fetched only once now
+        mock_fetch.reset_mock()
+        FEED_CACHE.clear()
+        load(UpdaterThread(Mock()))
+        fetched = [c.args[0] for c in mock_fetch.call_args_list]
+        self.assertEqual(fetched.count(new_url), 1)
+
+        reset_mock(mock_session, mock_fetch, foo)
+
+
+@patch('kaban.updater.info')
+@patch('kaban.updater.post_text', return_value='post')
+@patch('kaban.fetcher.fetch_feed')
+@patch('kaban.updater.SQLSession')
+class Checkpoints(MockDB):
+    def test_pending_posts(self, mock_session, mock_fetch, mock_poster, foo):
+        mock_session.return_value = self.SQLSession()
+        mock_fetch.side_effect = lambda *args: deepcopy(MOCK_FEED)
+
+        # the posts are found, but the bot stops before the mailing
+        load(UpdaterThread(Mock()))
+        with self.SQLSession() as session:
+            self.assertEqual(session.query(PendingPostsDB).count(), len(TEST_DB))
+
+        # they aren't found again
+        FEED_CACHE.clear()
+        self.assertFalse(any(load(UpdaterThread(Mock())).get(data['uid'], {}).get(data['feed'])
+                             for data in TEST_DB))
+
+        with self.SQLSession() as session:
+            seen = session.query(SeenPostsDB).count()
+        upd = UpdaterThread(Mock())
+        upd._resume()
+        self.assertEqual(mock_poster.call_count, len(TEST_DB))
+        post = mock_poster.call_args.args[0]
+        self.assertEqual(post.title, MOCK_POST.title)
+        self.assertEqual(post, compact_post(MOCK_POST))
+        with self.SQLSession() as session:
+            self.assertEqual(session.query(PendingPostsDB).count(), 0)
+            self.assertEqual(session.query(SeenPostsDB).count(), seen + len(TEST_DB))
+
+        reset_mock(mock_session, mock_fetch, mock_poster, foo)
+
+    def test_schedule(self, mock_session, mock_fetch, mock_poster, foo):
+        mock_session.return_value = self.SQLSession()
+        mock_fetch.side_effect = lambda *args: deepcopy(MOCK_FEED)
+
+        load(UpdaterThread(Mock()))
+        with self.SQLSession() as session:
+            polls = session.query(FeedStateDB.next_poll).all()
+            self.assertTrue(polls)
+            self.assertTrue(all(poll > datetime.now() for poll, in polls))
+
+        # a restart polls only the feeds that are due
+        FEED_CACHE.clear()
+        mock_fetch.reset_mock()
+        upd = UpdaterThread(Mock())
+        upd._resume()
+        load(upd)
+        mock_fetch.assert_not_called()
+
+        reset_mock(mock_session, mock_fetch, mock_poster, foo)
+
+
+@patch('kaban.updater.post_text', return_value='post')
+@patch('kaban.fetcher.fetch_feed')
+@patch('kaban.updater.SQLSession')
+class Streaming(MockDB):
+    def test_first_feed_first(self, mock_session, mock_fetch, mock_poster):
+        mock_session.return_value = self.SQLSession()
+        events = []
+
+        def fetch(url, *validators):
+            if url != TEST_DB[0]['feed']:
+                time.sleep(0.3)
+            events.append(('fetched', url))
+            return deepcopy(MOCK_FEED)
+        mock_fetch.side_effect = fetch
+
+        def render(post, entry, feed):
+            events.append(('sent', feed))
+            return 'post'
+        mock_poster.side_effect = render
+
+        upd = UpdaterThread(Mock())
+        for new_posts in upd._load():
+            upd._forward(new_posts)
+
+        self.assertEqual(events[:2], [('fetched', TEST_DB[0]['feed']), ('sent', TEST_DB[0]['feed'])])
+        self.assertEqual(len([e for e in events if e[0] == 'sent']), len(TEST_DB))
+
+        reset_mock(mock_session, mock_fetch, mock_poster)
+
+
+@patch('kaban.updater.post_text', return_value='post')
 @patch('kaban.updater.SQLSession')
 class Sender(MockDB):
     def test_normal_case(self, mock_session, mock_poster):
         mock_session.return_value = self.SQLSession()
-        mock_post = deepcopy(MOCK_POST)
-        post_published = datetime.fromtimestamp(
-            time.mktime(mock_post.published_parsed)
-        )
-        upd_post = {'title': 'test-title', 'post': mock_post}
+        mock_post = compact_post(MOCK_POST)
+        post_published = datetime.fromtimestamp(mock_post.published)
+        with self.SQLSession() as session:
+            entry = session.query(*SUBSCRIPTION).filter(
+                FeedsDB.uid == TEST_DB[0]['uid'],
+                FeedsDB.feed == TEST_DB[0]['feed']
+            ).first()
+            last_row = session.query(sqlalchemy.func.max(OutboxDB.id)).scalar() or 0
+        upd_post = {'digest': b'test-digest-0123', 'post': mock_post, 'entry': entry}
         upd = UpdaterThread(Mock())
 
-        upd._updater(TEST_DB[0]['uid'], TEST_DB[0]['feed'], upd_post)
+        upd._forward({TEST_DB[0]['uid']: {TEST_DB[0]['feed']: [upd_post]}})
         mock_poster.assert_called_once()
-        mock_poster.assert_called_with(ANY, mock_post, ANY, TEST_DB[0]['feed'])
+        mock_poster.assert_called_with(mock_post, entry, TEST_DB[0]['feed'])
 
         with self.SQLSession() as session:
             db_entry = session.query(FeedsDB).filter(
                 FeedsDB.uid == TEST_DB[0]['uid'],
                 FeedsDB.feed == TEST_DB[0]['feed']
             ).first()
-            self.assertIn('test-title', db_entry.last_posts)
             self.assertEqual(post_published, db_entry.last_check)
+            outbox = session.query(OutboxDB.uid, OutboxDB.text).filter(OutboxDB.id > last_row).all()
+            self.assertEqual(outbox, [(TEST_DB[0]['uid'], 'post')])
+            seen = session.query(SeenPostsDB).filter(
+                SeenPostsDB.entry_id == entry.id,
+                SeenPostsDB.digest == b'test-digest-0123'
+            ).first()
+            self.assertIsNotNone(seen)
+
+        reset_mock(mock_session, mock_poster)
+
+    def test_batches(self, mock_session, mock_poster):
+        mock_session.return_value = self.SQLSession()
+        with self.SQLSession() as session:
+            entry = session.query(*SUBSCRIPTION).filter(
+                FeedsDB.uid == TEST_DB[1]['uid'],
+                FeedsDB.feed == TEST_DB[1]['feed']
+            ).first()
+        posts = [
+            {'digest': f'batch-digest-{i:03}'.encode(), 'post': compact_post(MOCK_POST), 'entry': entry}
+            for i in range(25)
+        ]
+        upd = UpdaterThread(Mock())
+        upd.batch_size = 10
+        upd._save_posts = Mock(wraps=upd._save_posts)
+
+        upd._forward({TEST_DB[1]['uid']: {TEST_DB[1]['feed']: posts}})
+        self.assertEqual(mock_poster.call_count, 25)
+        self.assertEqual(
+            [len(call.args[0]) for call in upd._save_posts.call_args_list], [10, 10, 5]
+        )
+        with self.SQLSession() as session:
+            count = session.query(SeenPostsDB).filter(SeenPostsDB.entry_id == entry.id).count()
+            self.assertEqual(count, min(upd.posts_to_store, 25))
 
         reset_mock(mock_session, mock_poster)
 
 
+@patch('kaban.updater.post_text', return_value='post')
+@patch('kaban.fetcher.fetch_feed')
+@patch('kaban.updater.SQLSession')
+class SeenPosts(MockDB):
+    def test_seen_posts(self, mock_session, mock_fetch, mock_poster):
+        mock_session.return_value = self.SQLSession()
+        feed = TEST_DB[0]['feed']
+        with self.SQLSession() as session:
+            session.add(FeedStateDB(url=feed_key(feed), posts_to_store=2))
+            session.commit()
+
+        posts = []
+        for i in range(3):
+            post = deepcopy(MOCK_POST)
+            post.link = f'https://example.com/{i}'
+            posts.append(post)
+        legacy = deepcopy(MOCK_POST)
+        legacy.link = 'https://example.com/legacy'
+        legacy.title = 'legacy'
+        with self.SQLSession() as session:
+            session.query(FeedsDB).filter(FeedsDB.feed == feed).update(
+                {'last_posts': hashlib.md5(b'legacy').hexdigest()}
+            )
+            session.commit()
+
+        mock_feed = deepcopy(MOCK_FEED)
+        mock_feed.entries = posts + [legacy, posts[0]]
+        mock_fetch.return_value = mock_feed
+
+        upd = UpdaterThread(Mock())
+        new_posts = {}
+        load(upd, new_posts)
+        self.assertEqual(
+            [p['post'] for p in new_posts[TEST_DB[0]['uid']][feed]],
+            [compact_post(p) for p in posts]
+        )
+        upd._forward(new_posts)
+
+        with self.SQLSession() as session:
+            entry = session.query(FeedsDB).filter(FeedsDB.feed == feed).first()
+            self.assertEqual(entry.last_posts, '')
+            digests = session.query(SeenPostsDB.digest).filter(
+                SeenPostsDB.entry_id == entry.id
+            ).order_by(SeenPostsDB.id)
+            self.assertEqual(
+                [d for d, in digests], [post_digest(p) for p in reversed(posts[:2])]
+            )
+            # all the posts have the same date
+            entry.last_check = TEST_DB[0]['last_check']
+            session.commit()
+
+        new_posts = {}
+        load(UpdaterThread(Mock()), new_posts)
+        self.assertEqual(
+            [p['post'] for p in new_posts[TEST_DB[0]['uid']][feed]],
+            [compact_post(posts[2]), compact_post(legacy)]
+        )
+
+        reset_mock(mock_session, mock_fetch, mock_poster)
+
+
 if __name__ == '__main__':
     unittest.main()
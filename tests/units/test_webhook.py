@@ -1,5 +1,7 @@
+from collections import deque
 from copy import copy
 import pathlib
+import queue
 import requests
 import signal
 import sys
@@ -14,20 +16,22 @@ if str(BASE_DIR) not in sys.path:
 from kaban import flask_config
 from kaban.helpers import exit_signal
 from kaban.webhook import WebhookThread
+from kaban.sender import SenderThread, TokenBucket
 from kaban.database import WebhookDB
 from kaban.settings import (
     HOOK_READY_TO_WORK, NEW_MESSAGES_EVENT,
-    WEBHOOK_ENDPOINT, BANNED
+    WEBHOOK_ENDPOINT, BANNED, USERS, HELP, CMD_HELP, CMD_LIST, CMD_CANCEL
 )
-from tests.fixtures.fixtures import MockDB, reset_mock, TG_REQUEST
+from tests.fixtures.fixtures import MockDB, reset_mock, make_request, TEST_DB, TG_REQUEST
 
 
+@patch('kaban.webhook.WEBSUB')
 @patch('kaban.webhook.exit_signal')
 @patch('kaban.webhook.subprocess')
 @patch('kaban.webhook.telebot')
 @patch('kaban.webhook.ngrok')
 class SetHook(unittest.TestCase):
-    def test_tunnel_only(self, mock_ngrok, mock_telebot, mock_subprocess, foo):
+    def test_tunnel_only(self, mock_ngrok, mock_telebot, mock_subprocess, foo, mock_websub):
         mock_tunnel = Mock()
         mock_tunnel.public_url = 'https://example.com'
         mock_ngrok.connect.return_value = mock_tunnel
@@ -38,6 +42,7 @@ class SetHook(unittest.TestCase):
         server._set_webhook()
 
         mock_ngrok.connect.assert_called_once()
+        mock_websub.start.assert_called_once_with('https://example.com')
         mock_telebot.TeleBot().remove_webhook.assert_called_once()
         mock_subprocess.check_output.assert_called_once()
 
@@ -46,9 +51,9 @@ class SetHook(unittest.TestCase):
         result_tunnel = result[8]
         self.assertIn(f'example.com{WEBHOOK_ENDPOINT}', result_tunnel)
 
-        reset_mock(mock_ngrok, mock_telebot, mock_subprocess, foo)
+        reset_mock(mock_ngrok, mock_telebot, mock_subprocess, foo, mock_websub)
 
-    def test_normal_case(self, mock_ngrok, foo, mock_subprocess, bar):
+    def test_normal_case(self, mock_ngrok, foo, mock_subprocess, bar, baz):
         mock_tunnel = Mock()
         mock_tunnel.public_url = 'https://example.com'
         mock_ngrok.connect.return_value = mock_tunnel
@@ -61,9 +66,9 @@ class SetHook(unittest.TestCase):
             hook.shutdown()
         hook.stop()
 
-        reset_mock(mock_ngrok, foo, mock_subprocess, bar)
+        reset_mock(mock_ngrok, foo, mock_subprocess, bar, baz)
 
-    def test_exception_case(self, foo, bar, mock_subprocess, baz):
+    def test_exception_case(self, foo, bar, mock_subprocess, baz, qux):
         mock_subprocess.check_output.return_value = 'Raise me.'.encode()
         hook = WebhookThread(flask_config.get_app())
 
@@ -72,7 +77,7 @@ class SetHook(unittest.TestCase):
         with self.assertRaises(Exception):
             hook.stop()
 
-        reset_mock(foo, bar, mock_subprocess, baz)
+        reset_mock(foo, bar, mock_subprocess, baz, qux)
 
     def tearDown(self):
         if HOOK_READY_TO_WORK.is_set():
@@ -136,6 +141,92 @@ class FlaskConfig(MockDB):
             del BANNED[:]
 
 
+@patch('kaban.flask_config.WEBHOOK_REPLY', True)
+@patch('kaban.helpers.SQLSession')
+@patch('kaban.flask_config.SQLSession')
+class QuickReply(MockDB):
+    def setUp(self):
+        super().setUp()
+        NEW_MESSAGES_EVENT.clear()
+        self.users = dict(USERS)
+        USERS.clear()
+        self.sender = SenderThread()
+        self.sender.outbox = queue.Queue()
+        self.sender.global_bucket = TokenBucket(rate=100, capacity=10)
+        self.sender.more_rows = False
+
+    def post(self, text: str, sender=True):
+        app = flask_config.get_app(self.sender if sender else None).test_client()
+        return app.post(WEBHOOK_ENDPOINT, data=make_request(text),
+                        headers={'content-type': 'application/json'})
+
+    def queued(self) -> int:
+        with self.SQLSession() as session:
+            return session.query(WebhookDB).count()
+
+    def dequeue(self):
+        with self.SQLSession() as session:
+            session.query(WebhookDB).delete()
+            session.commit()
+        NEW_MESSAGES_EVENT.clear()
+
+    def test_reply(self, mock_session, mock_helpers_session):
+        mock_session.side_effect = mock_helpers_session.side_effect = self.SQLSession
+        uid = int(TEST_DB[-1]['uid'])
+
+        response = self.post(CMD_HELP)
+        self.assertEqual(response.get_json(), {'method': 'sendMessage', 'chat_id': uid, 'text': HELP})
+        self.assertEqual(self.queued(), 0)
+        self.assertFalse(NEW_MESSAGES_EVENT.is_set())
+
+        # the chat's limit is spent
+        response = self.post(CMD_LIST)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(self.queued(), 1)
+        self.dequeue()
+
+        self.sender.chat_buckets.clear()
+        response = self.post(CMD_LIST)
+        self.assertIn(TEST_DB[-1]['feed'], response.get_json()['text'])
+        self.sender.chat_buckets.clear()
+
+        # the sender has messages for the chat
+        self.sender.chats[uid] = deque([('bot', 'post', 0, None)])
+        response = self.post(CMD_HELP)
+        self.assertEqual(response.data, b'')
+        self.dequeue()
+        self.sender.chats.clear()
+
+        # /cancel changes the USERS, only the receiver does that
+        USERS[uid] = {'AWAITING_FEED': True, 'POTENTIAL_FEED': None}
+        response = self.post(CMD_CANCEL)
+        self.assertEqual(response.data, b'')
+        self.assertIn(uid, USERS)
+        self.dequeue()
+        USERS.clear()
+
+        # there's no fast path without the sender
+        response = self.post(CMD_HELP, sender=False)
+        self.assertEqual(response.data, b'')
+        self.dequeue()
+
+        # the rest goes through the receiver
+        response = self.post('/add')
+        self.assertEqual(response.data, b'')
+        self.assertEqual(self.queued(), 1)
+        # and nothing overtakes it
+        response = self.post(CMD_HELP)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(self.queued(), 2)
+
+        reset_mock(mock_session, mock_helpers_session)
+
+    def tearDown(self):
+        NEW_MESSAGES_EVENT.clear()
+        USERS.clear()
+        USERS.update(self.users)
+
+
 if __name__ == '__main__':
     signal.signal(signal.SIGINT, exit_signal)
     signal.signal(signal.SIGTSTP, exit_signal)
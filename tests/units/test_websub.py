@@ -0,0 +1,215 @@
+from copy import deepcopy
+from datetime import datetime
+import hashlib
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import pathlib
+import sys
+import threading
+import time
+import unittest
+from unittest.mock import Mock, patch
+from urllib.parse import parse_qs, urlsplit
+
+BASE_DIR = pathlib.Path(__file__).resolve().parent.parent.parent
+if str(BASE_DIR) not in sys.path:
+    sys.path.append(str(BASE_DIR))
+
+from kaban import flask_config, websub
+from kaban.updater import UpdaterThread
+from kaban.database import FeedStateDB, PushedFeedsDB
+from kaban.fastparser import fast_parse
+from kaban.fetcher import FEED_CACHE, feed_key
+from kaban.settings import UPDATE_FEEDS_EVENT, WEBSUB_ENDPOINT
+
+from tests.fixtures.fixtures import reset_mock, MockDB, TEST_DB, MOCK_FEED
+from tests.units.test_updater import load
+
+
+PUSHED_RSS = b"""<?xml version="1.0"?>
+<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom"><channel><title>test</title>
+<atom:link rel="hub" href="https://hub.example.com/"/>
+<atom:link rel="self" href="https://example.com/topic"/>
+<item><title>pushed-post</title><link>https://example.com/pushed</link>
+<pubDate>Fri, 13 Jan 2023 12:00:00 +0000</pubDate>
+<atom:link rel="enclosure" href="https://example.com/pushed.mp3"/></item>
+</channel></rss>"""
+
+
+class StandInHub(BaseHTTPRequestHandler):
+    """ Accepts every subscription and remembers it. """
+    requests = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.requests.append({k: v[0] for k, v in parse_qs(body.decode()).items()})
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args): pass
+
+
+def sign(secret: str, body: bytes) -> str:
+    return 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+class Signature(unittest.TestCase):
+    def test_check_signature(self):
+        self.assertTrue(websub.check_signature('secret', b'body', sign('secret', b'body')))
+        sha1 = 'sha1=' + hmac.new(b'secret', b'body', hashlib.sha1).hexdigest()
+        self.assertTrue(websub.check_signature('secret', b'body', sha1))
+
+        self.assertFalse(websub.check_signature('secret', b'body!', sign('secret', b'body')))
+        self.assertFalse(websub.check_signature('other', b'body', sign('secret', b'body')))
+        self.assertFalse(websub.check_signature('secret', b'body', 'md5=00'))
+        self.assertFalse(websub.check_signature('secret', b'body', None))
+
+
+class HubLinks(unittest.TestCase):
+    def test_feed_links(self):
+        parsed_feed = fast_parse(PUSHED_RSS)
+        links = {link.rel: link.href for link in parsed_feed.feed.links}
+        self.assertEqual(links, {'hub': 'https://hub.example.com/', 'self': 'https://example.com/topic'})
+
+
+@patch('kaban.websub.info')
+@patch('kaban.flask_config.info')
+@patch('kaban.updater.info')
+@patch('kaban.updater.post_text', return_value='post')
+@patch('kaban.fetcher.fetch_feed')
+@patch('kaban.flask_config.SQLSession')
+@patch('kaban.websub.SQLSession')
+@patch('kaban.updater.SQLSession')
+class PushedFeeds(MockDB):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.hub = ThreadingHTTPServer(('127.0.0.1', 0), StandInHub)
+        threading.Thread(target=cls.hub.serve_forever, daemon=True).start()
+        cls.hub_url = f'http://127.0.0.1:{cls.hub.server_port}/'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.hub.shutdown()
+        cls.hub.server_close()
+
+    def test_push(self, mock_session, mock_websub_session, mock_app_session, mock_fetch, *args):
+        for mock in (mock_session, mock_websub_session, mock_app_session):
+            mock.side_effect = self.SQLSession
+        feed, topic = TEST_DB[0]['feed'], 'https://example.com/topic'
+
+        def fetch(url, *args):
+            mock_feed = deepcopy(MOCK_FEED)
+            if url == feed:
+                mock_feed.hub, mock_feed.topic = self.hub_url, topic
+            return mock_feed
+        mock_fetch.side_effect = fetch
+
+        # the feed is polled and subscribed
+        upd = UpdaterThread(Mock())
+        upd.websub = websub.WebSub()
+        upd.websub.base_url = 'https://bot.example.com'
+        load(upd)
+        self.assertEqual(len(StandInHub.requests), 1)
+        subscription = StandInHub.requests[0]
+        self.assertEqual(subscription['hub.mode'], 'subscribe')
+        self.assertEqual(subscription['hub.topic'], topic)
+        callback = urlsplit(subscription['hub.callback']).path
+
+        # the hub verifies the intent
+        app = flask_config.get_app().test_client()
+        response = app.get(callback, query_string={
+            'hub.mode': 'subscribe', 'hub.topic': 'https://example.com/other', 'hub.challenge': 'abc'
+        })
+        self.assertEqual(response.status_code, 404)
+        response = app.get(callback, query_string={
+            'hub.mode': 'subscribe', 'hub.topic': topic,
+            'hub.challenge': 'abc', 'hub.lease_seconds': str(5 * 24 * 3600)
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b'abc')
+        with self.SQLSession() as session:
+            state = session.query(FeedStateDB).filter(FeedStateDB.url == feed_key(feed)).first()
+            self.assertGreater(state.lease_until, datetime.now())
+            self.assertEqual(callback, f'{WEBSUB_ENDPOINT}/{state.websub_token}')
+
+        # nobody else can end it or start it again
+        for mode in ('unsubscribe', 'denied', 'subscribe'):
+            response = app.get(callback, query_string={'hub.mode': mode, 'hub.topic': topic})
+            self.assertEqual(response.status_code, 404)
+        response = app.get(f'{WEBSUB_ENDPOINT}/{state.id}', query_string={
+            'hub.mode': 'unsubscribe', 'hub.topic': topic
+        })
+        self.assertEqual(response.status_code, 404)
+
+        # and pushes the feed
+        UPDATE_FEEDS_EVENT.clear()
+        response = app.post(callback, data=PUSHED_RSS, headers={'X-Hub-Signature': sign('wrong', PUSHED_RSS)})
+        self.assertEqual(response.status_code, 202)
+        self.assertFalse(UPDATE_FEEDS_EVENT.is_set())
+        response = app.post(callback, data=PUSHED_RSS, headers={
+            'X-Hub-Signature': sign(subscription['hub.secret'], PUSHED_RSS),
+            'Content-Type': 'application/rss+xml'
+        })
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(UPDATE_FEEDS_EVENT.is_set())
+        UPDATE_FEEDS_EVENT.clear()
+
+        # a chunked push has no length, it's cut off all the same
+        with patch('kaban.flask_config.FEED_MAX_SIZE', len(PUSHED_RSS) - 1):
+            response = app.post(callback, input_stream=io.BytesIO(PUSHED_RSS), headers={
+                'X-Hub-Signature': sign(subscription['hub.secret'], PUSHED_RSS),
+                'Transfer-Encoding': 'chunked'
+            }, environ_overrides={'wsgi.input_terminated': True})
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(UPDATE_FEEDS_EVENT.is_set())
+
+        # a restart goes through the pushed content, the feed isn't polled
+        mock_fetch.reset_mock()
+        new_posts = load(UpdaterThread(Mock()))
+        self.assertEqual(new_posts[TEST_DB[0]['uid']][feed][0]['post'].title, 'pushed-post')
+        self.assertNotIn(feed, [c.args[0] for c in mock_fetch.call_args_list])
+        with self.SQLSession() as session:
+            self.assertEqual(session.query(PushedFeedsDB).count(), 0)
+
+        # the lease lapses, the feed goes back to the polling
+        with self.SQLSession() as session:
+            state = session.query(FeedStateDB).filter(FeedStateDB.url == feed_key(feed)).first()
+            state.lease_until = datetime.fromtimestamp(time.time() - 1)
+            session.commit()
+        FEED_CACHE.clear()
+        mock_fetch.reset_mock()
+        load(UpdaterThread(Mock()))
+        self.assertIn(feed, [c.args[0] for c in mock_fetch.call_args_list])
+
+        reset_mock(mock_session, mock_websub_session, mock_app_session, mock_fetch, *args)
+
+    def test_new_address(self, mock_session, mock_websub_session, mock_app_session, mock_fetch, *args):
+        mock_websub_session.side_effect = self.SQLSession
+        lease = datetime.fromtimestamp(time.time() + 3600)
+        with self.SQLSession() as session:
+            for url, base in (('//example.com/old', 'https://old.example.com'),
+                              ('//example.com/new', 'https://bot.example.com')):
+                session.add(FeedStateDB(
+                    url=url, hub=self.hub_url, topic=url, websub_secret='secret',
+                    websub_token=url, websub_base=base, lease_until=lease
+                ))
+            session.commit()
+
+        hub = websub.WebSub()
+        hub.start('https://bot.example.com')
+        self.assertEqual(hub.base_url, 'https://bot.example.com')
+        with self.SQLSession() as session:
+            leases = dict(session.query(FeedStateDB.url, FeedStateDB.lease_until).filter(
+                FeedStateDB.url.in_(['//example.com/old', '//example.com/new'])
+            ))
+        # the old callback is dead, the feed is polled again
+        self.assertEqual(leases, {'//example.com/old': None, '//example.com/new': lease})
+
+        reset_mock(mock_session, mock_websub_session, mock_app_session, mock_fetch, *args)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+from http.server import ThreadingHTTPServer
+import pathlib
+import sys
+import threading
+import unittest
+
+import feedparser
+
+BASE_DIR = pathlib.Path(__file__).resolve().parent.parent.parent
+if str(BASE_DIR) not in sys.path:
+    sys.path.append(str(BASE_DIR))
+
+from kaban import fetcher, workers
+from kaban.client import HTTP_METRICS
+from kaban.settings import FeedNotModified
+
+from tests.units.test_fetcher import RSS
+from tests.units.test_client import FeedHandler
+
+
+class Compact(unittest.TestCase):
+    def test_normal_case(self):
+        parsed_feed = feedparser.parse(RSS)
+        parsed_feed['etag'] = '"v1"'
+        result = workers.compact(parsed_feed)
+
+        self.assertEqual(result.etag, '"v1"')
+        self.assertEqual(list(result.feed), ['links'])
+        post = result.entries[0]
+        self.assertEqual(post.title, 'post-1')
+        self.assertEqual(post.link, 'https://example.com/1')
+        self.assertEqual(post.published_parsed, parsed_feed.entries[0].published_parsed)
+        self.assertNotIn('title_detail', post)
+
+
+class FeedWorkers(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FeedHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f'http://127.0.0.1:{cls.server.server_port}/rss'
+        cls.workers = workers.FeedWorkers(processes=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.workers.shutdown()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        fetcher.FEED_CACHE.clear()
+
+    def test_download_in_threads(self):
+        host = f'127.0.0.1:{self.server.server_port}'
+        before = HTTP_METRICS.report().get(host, {}).get('requests', 0)
+        parsed_feed = self.workers.fetch(self.url)
+
+        # the download is made and measured by the updater's process
+        self.assertEqual(HTTP_METRICS.report()[host]['requests'], before + 1)
+        self.assertEqual(parsed_feed.entries[0].title, 'post-1')
+        self.assertEqual(parsed_feed.href, self.url)
+        self.assertIsNotNone(parsed_feed.body_hash)
+
+    def test_fetch(self):
+        urls = [f'{self.url}?{i}' for i in range(6)]
+        results = dict(fetcher.iter_feeds(urls, workers=6, fetch=self.workers.fetch))
+
+        self.assertEqual(set(results), set(urls))
+        for url in urls:
+            self.assertEqual(results[url].entries[0].title, 'post-1')
+            self.assertEqual(results[url].href, url)
+
+    def test_not_modified(self):
+        parsed_feed = self.workers.fetch(self.url)
+        fetcher.FEED_CACHE.clear()
+        with self.assertRaises(FeedNotModified):
+            self.workers.fetch(self.url, body_hash=parsed_feed.body_hash)
+
+
+if __name__ == '__main__':
+    unittest.main()